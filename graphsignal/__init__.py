@@ -1,4 +1,4 @@
-from typing import Any, Union, Optional
+from typing import Any, Union, Optional, Sequence
 import time
 import sys
 import os
@@ -12,14 +12,19 @@ from graphsignal.version import __version__
 from graphsignal.agent import Agent
 from graphsignal.workload_run import WorkloadRun
 from graphsignal.uploader import Uploader
+from graphsignal.trace_spill import TraceSpill
+from graphsignal.profiling_slots import ProfilingSlots, device_scope
 from graphsignal.usage.process_reader import ProcessReader
 from graphsignal.usage.nvml_reader import NvmlReader
 from graphsignal.proto import profiles_pb2
+from graphsignal import profile_scheduler
 from graphsignal import profilers
 
 logger = logging.getLogger('graphsignal')
 
 _agent = None
+# error in the fork handler of the child, logged on first use
+_fork_error = None
 
 
 def _check_configured():
@@ -27,10 +32,19 @@ def _check_configured():
     if not _agent:
         raise ValueError(
             'Graphsignal profiler not configured, call graphsignal.configure() first')
+    if _fork_error is not None:
+        _log_fork_error()
+
+
+def _log_fork_error():
+    global _fork_error
+    fork_error = _fork_error
+    _fork_error = None
+    logger.error('Error reinitializing Graphsignal profiler after fork', exc_info=fork_error)
 
 
 def _check_and_set_arg(
-        name, value, is_str=False, is_int=False, is_bool=False, required=True):
+        name, value, is_str=False, is_int=False, is_float=False, is_bool=False, required=True):
     env_name = 'GRAPHSIGNAL_{0}'.format(name.upper())
 
     if not value and env_name in os.environ:
@@ -41,6 +55,11 @@ def _check_and_set_arg(
                     value = int(value)
                 except:
                     raise ValueError('Invalid format, expected integer: {0}'.format(name))
+            elif is_float:
+                try:
+                    value = float(value)
+                except:
+                    raise ValueError('Invalid format, expected float: {0}'.format(name))
             elif is_bool:
                 value = bool(value)
 
@@ -54,6 +73,9 @@ def _check_and_set_arg(
         elif is_int:
             if not isinstance(value, int):
                 raise ValueError('Invalid format, expected integer: {0}'.format(name))
+        elif is_float:
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError('Invalid format, expected float: {0}'.format(name))
         elif is_bool:
             if not isinstance(value, bool):
                 raise ValueError('Invalid format, expected boolean: {0}'.format(name))
@@ -69,7 +91,17 @@ def configure(
         node_rank: Optional[int] = None,
         local_rank: Optional[int] = None,
         debug_mode: Optional[bool] = False,
-        disable_op_profiler: Optional[bool] = False) -> None:
+        disable_op_profiler: Optional[bool] = False,
+        spool_dir: Optional[str] = None,
+        spill_traces: Optional[bool] = False,
+        trace_spill_dir: Optional[str] = None,
+        collector_socket: Optional[str] = None,
+        overhead_budget: Optional[float] = None,
+        profiling_slots: Optional[int] = None,
+        profiling_slots_scope: Optional[str] = None,
+        profiling_lock_dir: Optional[str] = None,
+        sample_process_usage: Optional[bool] = False,
+        sample_device_usage: Optional[bool] = False) -> None:
     global _agent
 
     if _agent:
@@ -88,6 +120,22 @@ def configure(
     node_rank = _check_and_set_arg('node_rank', node_rank, is_int=True, required=False)
     local_rank = _check_and_set_arg('local_rank', local_rank, is_int=True, required=False)
     disable_op_profiler = _check_and_set_arg('disable_op_profiler', disable_op_profiler, is_bool=True, required=False)
+    spool_dir = _check_and_set_arg('spool_dir', spool_dir, is_str=True, required=False)
+    spill_traces = _check_and_set_arg('spill_traces', spill_traces, is_bool=True, required=False)
+    trace_spill_dir = _check_and_set_arg('trace_spill_dir', trace_spill_dir, is_str=True, required=False)
+    collector_socket = _check_and_set_arg('collector_socket', collector_socket, is_str=True, required=False)
+    overhead_budget = _check_and_set_arg('overhead_budget', overhead_budget, is_float=True, required=False)
+    if overhead_budget is not None and not 0 < overhead_budget < 1:
+        raise ValueError('configure: invalid argument: overhead_budget, expected fraction of wall time between 0 and 1')
+    profiling_slots = _check_and_set_arg('profiling_slots', profiling_slots, is_int=True, required=False)
+    if profiling_slots is not None and profiling_slots < 1:
+        raise ValueError('configure: invalid argument: profiling_slots, expected positive integer')
+    profiling_slots_scope = _check_and_set_arg('profiling_slots_scope', profiling_slots_scope, is_str=True, required=False)
+    if profiling_slots_scope and profiling_slots_scope not in ('node', 'device'):
+        raise ValueError('configure: invalid argument: profiling_slots_scope, expected node or device')
+    profiling_lock_dir = _check_and_set_arg('profiling_lock_dir', profiling_lock_dir, is_str=True, required=False)
+    sample_process_usage = _check_and_set_arg('sample_process_usage', sample_process_usage, is_bool=True, required=False)
+    sample_device_usage = _check_and_set_arg('sample_device_usage', sample_device_usage, is_bool=True, required=False)
 
     if not run_id:
         run_id = _uuid_sha1()
@@ -105,13 +153,35 @@ def configure(
     _agent.local_rank = local_rank if local_rank is not None else -1
     _agent.global_rank = global_rank if global_rank is not None else -1
     _agent.disable_op_profiler = disable_op_profiler
+    _agent.overhead_budget = overhead_budget
     _agent.debug_mode = debug_mode
+    if spill_traces or trace_spill_dir:
+        try:
+            _agent.trace_spill = TraceSpill(trace_spill_dir)
+            _agent.trace_spill.setup()
+        except Exception:
+            logger.error('Error setting up trace spill directory, keeping traces in memory', exc_info=True)
+            _agent.trace_spill = None
+    if profiling_slots:
+        try:
+            scope = device_scope(local_rank) if profiling_slots_scope == 'device' else 'node'
+            _agent.profiling_slots = ProfilingSlots(profiling_slots, lock_dir=profiling_lock_dir, scope=scope)
+            _agent.profiling_slots.setup()
+            profile_scheduler.set_profiling_slots(_agent.profiling_slots)
+        except Exception:
+            logger.error('Error setting up profiling slots, profiling is not coordinated with other processes', exc_info=True)
+            _agent.profiling_slots = None
     _agent.uploader = Uploader()
-    _agent.uploader.configure()
-    _agent.process_reader = ProcessReader()
+    _agent.uploader.configure(spool_dir=spool_dir, collector_socket=collector_socket)
+    _agent.process_reader = ProcessReader(sample_usage=sample_process_usage)
     _agent.process_reader.setup()
-    _agent.nvml_reader = NvmlReader()
-    _agent.nvml_reader.setup()
+    _agent.nvml_reader = NvmlReader(sample_usage=sample_device_usage)
+    # device usage is read once per node by the collector
+    if not collector_socket:
+        _agent.nvml_reader.setup()
+    elif sample_device_usage:
+        logger.warning('Device usage is read by the collector when collector_socket is set, '
+            'sample_device_usage is ignored; start the collector with --sample-device-usage instead')
 
     _agent.current_run = WorkloadRun()
     _agent.current_run.start_ms = int(time.time() * 1e3)
@@ -152,6 +222,12 @@ def shutdown() -> None:
     global _agent
     atexit.unregister(shutdown)
     _agent.current_run.end(block=True)
+    _agent.uploader.shutdown()
+    if _agent.trace_spill:
+        _agent.trace_spill.shutdown()
+    if _agent.profiling_slots:
+        profile_scheduler.set_profiling_slots(None)
+        _agent.profiling_slots.release()
     _agent.process_reader.shutdown()
     _agent.nvml_reader.shutdown()
     _agent = None
@@ -192,6 +268,57 @@ def log_metric(name: str, value: Union[int, float]) -> None:
     _agent.current_run.add_metric(name, value)
 
 
+def record_inferences(
+        durations_us: Sequence[Union[int, float]],
+        batch_sizes: Optional[Sequence[int]] = None,
+        span_name: Optional[str] = None) -> None:
+    _check_configured()
+
+    if durations_us is None or not hasattr(durations_us, '__len__'):
+        raise ValueError('record_inferences: missing or invalid argument: durations_us')
+
+    if batch_sizes is not None:
+        if not hasattr(batch_sizes, '__len__') or len(batch_sizes) != len(durations_us):
+            raise ValueError('record_inferences: invalid argument: batch_sizes, expected same length as durations_us')
+
+    if span_name is not None and not isinstance(span_name, str):
+        raise ValueError('record_inferences: invalid argument: span_name')
+
+    if len(durations_us) == 0:
+        return
+
+    if span_name is not None:
+        span_name, _ = _agent.current_run.span_scheduler(span_name)
+
+    _agent.current_run.update_inference_stats_many(durations_us, batch_sizes=batch_sizes, span_name=span_name)
+
+
+def _reset_after_fork():
+    global _fork_error
+    # clear state inherited by children of preforking servers, threads and
+    # resources of the child are created on first use
+    profile_scheduler.reset_after_fork()
+
+    if not _agent:
+        return
+
+    try:
+        _agent.worker_id = _uuid_sha1(size=12)
+        _agent.current_run.reset_after_fork()
+        _agent.uploader.reset_after_fork()
+        _agent.process_reader.reset_after_fork()
+        _agent.nvml_reader.reset_after_fork()
+        if _agent.trace_spill:
+            _agent.trace_spill.reset_after_fork()
+    except Exception as exc:
+        # logging locks may be held by threads of the parent
+        _fork_error = exc
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 def generate_uuid() -> None:
     return _uuid_sha1()    
 
@@ -216,6 +343,7 @@ __all__ = [
     'add_tag',
     'log_param',
     'log_metric',
+    'record_inferences',
     'generate_uuid',
     'profilers'
 ]
\ No newline at end of file
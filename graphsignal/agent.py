@@ -9,7 +9,10 @@ class Agent:
         self.local_rank = None
         self.debug_mode = None
         self.disable_op_profiler = False
+        self.overhead_budget = None
         self.uploader = None
+        self.trace_spill = None
+        self.profiling_slots = None
         self.process_reader = None
         self.nvml_reader = None
         self.current_run = None
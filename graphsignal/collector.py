@@ -0,0 +1,199 @@
+import logging
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import socketserver
+
+import graphsignal
+from graphsignal.proto import profiles_pb2
+from graphsignal.profile_spool import RECORD_HEADER
+from graphsignal.uploader import CollectorClient
+
+logger = logging.getLogger('graphsignal')
+
+
+class Collector:
+    # Receives profiles from worker processes on the node over a Unix socket
+    # and uploads them in batches with a single uploader.
+    FLUSH_MAX_PROFILES = 100
+    FLUSH_MAX_BYTES = int(10 * 1e6)
+    FLUSH_INTERVAL_SEC = 10
+    USAGE_REFRESH_SEC = 10
+    MAX_RECORD_BYTES = int(100 * 1e6)
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.received_count = 0
+        self.connection_count = 0
+        self._server = None
+        self._server_thread = None
+        self._pending_count = 0
+        self._pending_bytes = 0
+        self._pending_lock = threading.Lock()
+        self._usage = None
+        self._usage_read_sec = None
+        self._usage_lock = threading.Lock()
+
+    def start(self):
+        graphsignal._agent.uploader.set_flush_interval(self.FLUSH_INTERVAL_SEC)
+
+        # socket of a previous collector
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        collector = self
+
+        class CollectorRequestHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                collector._handle_connection(self.request)
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, CollectorRequestHandler)
+        self._server.daemon_threads = True
+        self._server_thread = threading.Thread(target=self._server.serve_forever, name='graphsignal-collector')
+        self._server_thread.daemon = True
+        self._server_thread.start()
+
+        logger.debug('Collector listening on %s', self.socket_path)
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._server_thread.join()
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+        graphsignal._agent.uploader.flush()
+
+    def add_profiles(self, profiles):
+        uploader = graphsignal._agent.uploader
+        usage = self._read_usage()
+        profiles_bytes = 0
+        for profile in profiles:
+            if usage is not None:
+                profile.node_usage.MergeFrom(usage.node_usage)
+                if len(profile.device_usage) == 0:
+                    profile.device_usage.extend(usage.device_usage)
+                    graphsignal._agent.nvml_reader.read_samples(profile)
+            profiles_bytes += profile.ByteSize()
+            uploader.upload_profile(profile)
+
+        with self._pending_lock:
+            self.received_count += len(profiles)
+            self._pending_count += len(profiles)
+            self._pending_bytes += profiles_bytes
+            should_flush = (
+                self._pending_count >= self.FLUSH_MAX_PROFILES or
+                self._pending_bytes >= self.FLUSH_MAX_BYTES)
+            if should_flush:
+                self._pending_count = 0
+                self._pending_bytes = 0
+        if should_flush:
+            uploader.flush_in_thread()
+
+    def _read_usage(self):
+        # node and device usage is read once per refresh interval for all workers,
+        # process usage is read by each worker
+        now = time.monotonic()
+        with self._usage_lock:
+            if self._usage_read_sec is None or now - self._usage_read_sec >= self.USAGE_REFRESH_SEC:
+                self._usage_read_sec = now
+                try:
+                    usage_profile = profiles_pb2.MLProfile()
+                    graphsignal._agent.process_reader.read(usage_profile)
+                    graphsignal._agent.nvml_reader.read(usage_profile)
+                    self._usage = usage_profile
+                except Exception:
+                    logger.error('Error reading node usage', exc_info=True)
+                    self._usage = None
+            return self._usage
+
+    def _handle_connection(self, sock):
+        # connections are handled in separate threads
+        with self._pending_lock:
+            self.connection_count += 1
+        batch = []
+        try:
+            while True:
+                header = _recv_exactly(sock, RECORD_HEADER.size)
+                if header is None:
+                    return
+                record_size, = RECORD_HEADER.unpack(header)
+                if record_size == 0:
+                    self.add_profiles(batch)
+                    batch = []
+                    sock.sendall(CollectorClient.ACK)
+                    continue
+                if record_size > self.MAX_RECORD_BYTES:
+                    logger.error('Profile record too big: %d', record_size)
+                    return
+                data = _recv_exactly(sock, record_size)
+                if data is None:
+                    return
+                profile = profiles_pb2.MLProfile()
+                profile.ParseFromString(data)
+                batch.append(profile)
+        except OSError:
+            logger.debug('Collector connection error', exc_info=True)
+        except Exception:
+            logger.error('Error receiving profiles', exc_info=True)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m graphsignal.collector',
+        description='Graphsignal collector, uploads profiles for worker processes on this node.')
+    parser.add_argument('--socket', dest='socket_path',
+        default=os.environ.get('GRAPHSIGNAL_COLLECTOR_SOCKET', '/tmp/graphsignal-collector.sock'),
+        help='Unix socket path, workers set the same path with collector_socket or GRAPHSIGNAL_COLLECTOR_SOCKET')
+    parser.add_argument('--api-key', dest='api_key', default=None)
+    parser.add_argument('--spool-dir', dest='spool_dir', default=None)
+    parser.add_argument('--sample-device-usage', dest='sample_device_usage', action='store_true',
+        help='sample device usage in the background, workers with collector_socket do not read devices')
+    parser.add_argument('--debug', dest='debug_mode', action='store_true')
+    args = parser.parse_args(argv)
+
+    # the collector uploads itself
+    os.environ.pop('GRAPHSIGNAL_COLLECTOR_SOCKET', None)
+
+    if args.debug_mode and len(logger.handlers) == 0:
+        logger.addHandler(logging.StreamHandler(sys.stdout))
+
+    graphsignal.configure(
+        api_key=args.api_key,
+        workload_name='graphsignal-collector',
+        spool_dir=args.spool_dir,
+        debug_mode=args.debug_mode,
+        sample_device_usage=args.sample_device_usage)
+
+    collector = Collector(args.socket_path)
+    collector.start()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            time.sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        collector.stop()
+        graphsignal.shutdown()
+
+
+if __name__ == '__main__':
+    main()
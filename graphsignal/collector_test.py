@@ -0,0 +1,173 @@
+import unittest
+import logging
+import sys
+import os
+import time
+import tempfile
+import shutil
+import multiprocessing
+from unittest.mock import patch
+
+import graphsignal
+from graphsignal.uploader import Uploader
+from graphsignal.collector import Collector
+from graphsignal.proto import profiles_pb2
+
+logger = logging.getLogger('graphsignal')
+
+
+class CollectorTest(unittest.TestCase):
+    def setUp(self):
+        if len(logger.handlers) == 0:
+            logger.addHandler(logging.StreamHandler(sys.stdout))
+        graphsignal.configure(
+            api_key='k1',
+            workload_name='graphsignal-collector',
+            debug_mode=True)
+        graphsignal._agent.uploader.clear()
+        self.socket_dir = tempfile.mkdtemp(prefix='graphsignal-test-')
+        self.socket_path = os.path.join(self.socket_dir, 'collector.sock')
+
+    def tearDown(self):
+        graphsignal._agent.uploader.clear()
+        graphsignal.shutdown()
+        shutil.rmtree(self.socket_dir)
+
+    @patch.object(Uploader, '_post')
+    def test_send_profiles(self, mocked_post):
+        received = []
+        def side_effect(endpoint, data):
+            upload_request = profiles_pb2.UploadRequest()
+            upload_request.ParseFromString(b''.join(data()))
+            received.extend(upload_request.ml_profiles)
+            return profiles_pb2.UploadResponse().SerializeToString()
+        mocked_post.side_effect = side_effect
+
+        collector = Collector(self.socket_path)
+        collector.start()
+        try:
+            worker_uploader = Uploader()
+            worker_uploader.AUTO_FLUSH_INTERVAL_SEC = 0
+            worker_uploader.configure(collector_socket=self.socket_path)
+            for i in range(5):
+                profile = profiles_pb2.MLProfile()
+                profile.workload_name = 'w{0}'.format(i)
+                worker_uploader.upload_profile(profile)
+            worker_uploader.flush()
+            worker_uploader.upload_profile(profiles_pb2.MLProfile(workload_name='w5'))
+            worker_uploader.flush()
+            worker_uploader.shutdown()
+
+            self.assertEqual(worker_uploader.queue_depth(), 0)
+            self.assertEqual(collector.received_count, 6)
+            self.assertEqual(collector.connection_count, 1)
+            mocked_post.assert_not_called()
+        finally:
+            collector.stop()
+
+        # collector uploads all profiles in one request
+        mocked_post.assert_called_once()
+        self.assertEqual([p.workload_name for p in received], ['w0', 'w1', 'w2', 'w3', 'w4', 'w5'])
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    @patch.object(Uploader, '_post')
+    def test_collector_unavailable(self, mocked_post):
+        worker_uploader = Uploader()
+        worker_uploader.AUTO_FLUSH_INTERVAL_SEC = 0
+        worker_uploader.configure(collector_socket=self.socket_path)
+        worker_uploader.upload_profile(profiles_pb2.MLProfile())
+        worker_uploader.flush()
+
+        # profiles are kept for retry
+        self.assertEqual(worker_uploader.queue_depth(), 1)
+        self.assertEqual(worker_uploader.failed_count, 1)
+        mocked_post.assert_not_called()
+
+    def test_usage(self):
+        usage_profile = profiles_pb2.MLProfile()
+        usage_profile.node_usage.num_devices = 1
+        device_usage = usage_profile.device_usage.add()
+        device_usage.device_name = 'gpu1'
+        def read_devices(profile):
+            profile.MergeFrom(usage_profile)
+        def read_node(profile):
+            profile.node_usage.hostname = 'h1'
+            profile.node_usage.mem_total = 100
+            profile.process_usage.process_id = '1'
+
+        collector = Collector(self.socket_path)
+        with patch.object(graphsignal._agent.nvml_reader, 'read', side_effect=read_devices) as mocked_nvml_read, \
+                patch.object(graphsignal._agent.process_reader, 'read', side_effect=read_node) as mocked_process_read:
+            worker_profile = profiles_pb2.MLProfile()
+            worker_profile.process_usage.process_id = '2'
+            collector.add_profiles([worker_profile] + [profiles_pb2.MLProfile() for _ in range(9)])
+            collector.add_profiles([profiles_pb2.MLProfile()])
+            # usage is read once for all profiles
+            mocked_nvml_read.assert_called_once()
+            mocked_process_read.assert_called_once()
+
+        uploader = graphsignal._agent.uploader
+        self.assertEqual(uploader.queue_depth(), 11)
+        for profile in uploader.buffer:
+            self.assertEqual(profile.device_usage[0].device_name, 'gpu1')
+            self.assertEqual(profile.node_usage.num_devices, 1)
+            self.assertEqual(profile.node_usage.hostname, 'h1')
+            self.assertEqual(profile.node_usage.mem_total, 100)
+        # process usage is read by the worker
+        self.assertEqual(uploader.buffer[0].process_usage.process_id, '2')
+        self.assertEqual(uploader.buffer[1].process_usage.process_id, '')
+
+    def test_worker_device_usage(self):
+        graphsignal.shutdown()
+        with self.assertLogs(logger, level='WARNING') as logs:
+            graphsignal.configure(
+                api_key='k1',
+                workload_name='w1',
+                collector_socket=self.socket_path,
+                sample_device_usage=True)
+        self.assertIn('sample_device_usage is ignored', logs.output[0])
+        self.assertFalse(graphsignal._agent.nvml_reader._is_initialized)
+
+    @patch.object(Uploader, '_post',
+                  return_value=profiles_pb2.UploadResponse().SerializeToString())
+    def test_multi_process(self, mocked_post):
+        num_workers = 8
+        num_profiles = 200
+
+        collector = Collector(self.socket_path)
+        collector.start()
+        try:
+            context = multiprocessing.get_context('spawn')
+            start_sec = time.time()
+            workers = [
+                context.Process(target=_run_worker, args=(self.socket_path, num_profiles))
+                for _ in range(num_workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join(timeout=60)
+                self.assertEqual(worker.exitcode, 0)
+            took_sec = time.time() - start_sec
+        finally:
+            collector.stop()
+
+        self.assertEqual(collector.received_count, num_workers * num_profiles)
+        self.assertEqual(collector.connection_count, num_workers)
+        logger.debug('Collected %d profiles from %d workers in %.3f sec with %d uploads, instead of %d',
+            collector.received_count, num_workers, took_sec, mocked_post.call_count,
+            num_workers * num_profiles // graphsignal.current_run().AUTO_FLUSH_MAX_PROFILES)
+        self.assertTrue(mocked_post.call_count <= num_workers * num_profiles // Collector.FLUSH_MAX_PROFILES + 1)
+
+
+def _run_worker(socket_path, num_profiles):
+    graphsignal.configure(
+        api_key='k1',
+        workload_name='w1',
+        collector_socket=socket_path)
+    for _ in range(num_profiles):
+        profile = profiles_pb2.MLProfile()
+        profile.workload_name = 'w1'
+        profile.process_usage.process_id = str(os.getpid())
+        graphsignal._agent.uploader.upload_profile(profile)
+    graphsignal._agent.uploader.flush()
+    graphsignal.shutdown()
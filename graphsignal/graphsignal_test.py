@@ -2,9 +2,16 @@ import unittest
 import logging
 import sys
 import os
+import time
+import signal
+import threading
 from unittest.mock import patch, Mock
 
 import graphsignal
+from graphsignal import profile_scheduler
+from graphsignal.uploader import Uploader
+from graphsignal.inference_span import start_inference_span
+from graphsignal.proto import profiles_pb2
 
 logger = logging.getLogger('graphsignal')
 
@@ -61,3 +68,158 @@ class GraphsignalTest(unittest.TestCase):
         self.assertEqual(graphsignal._agent.local_rank, 2)
         self.assertEqual(graphsignal._agent.global_rank, 3)
         self.assertEqual(graphsignal._agent.debug_mode, True)
+
+    def test_record_inferences(self):
+        graphsignal.record_inferences([10, 20, 30], batch_sizes=[1, 2, 3])
+        graphsignal.record_inferences([40])
+
+        stats = graphsignal.current_run().inference_stats
+        self.assertEqual(graphsignal.current_run().total_inference_count, 4)
+        self.assertEqual(stats.inference_count, 4)
+        self.assertEqual(stats.sample_count, 6)
+        self.assertEqual(stats.total_time_us, 100)
+        self.assertEqual(stats.inference_time_avg_us(), 25)
+        self.assertEqual(stats.inference_time_p95_us(), 40)
+
+        with self.assertRaises(ValueError):
+            graphsignal.record_inferences(None)
+        with self.assertRaises(ValueError):
+            graphsignal.record_inferences([10, 20], batch_sizes=[1])
+
+    def test_record_inferences_many(self):
+        num_records = 5000
+        durations_us = [i % 1000 + 1 for i in range(num_records)]
+        graphsignal.record_inferences(durations_us)
+        for _ in range(num_records):
+            span = start_inference_span()
+            span.stop()
+
+        current_run = graphsignal.current_run()
+        self.assertEqual(current_run.total_inference_count, 2 * num_records)
+
+    @patch.object(Uploader, 'upload_profile')
+    def test_record_inferences_overhead(self, mocked_upload_profile):
+        num_records = 1000000
+        durations_us = [i % 1000 + 1 for i in range(num_records)]
+
+        start_ns = time.perf_counter_ns()
+        graphsignal.record_inferences(durations_us)
+        bulk_ns = time.perf_counter_ns() - start_ns
+
+        start_ns = time.perf_counter_ns()
+        for _ in range(num_records):
+            span = start_inference_span()
+            span.stop()
+        span_ns = time.perf_counter_ns() - start_ns
+
+        # benchmark only, timing depends on the machine
+        logger.debug('Recording %d inferences took: bulk %fs, per span %fs',
+            num_records, bulk_ns / 1e9, span_ns / 1e9)
+
+        self.assertEqual(graphsignal.current_run().total_inference_count, 2 * num_records)
+
+    def test_record_inferences_invalid(self):
+        graphsignal.record_inferences(
+            [10, -1, float('nan'), float('inf'), 30], batch_sizes=[1, 2, 3, 4, 5])
+
+        # invalid durations are skipped
+        stats = graphsignal.current_run().inference_stats
+        self.assertEqual(graphsignal.current_run().total_inference_count, 2)
+        self.assertEqual(stats.inference_count, 2)
+        self.assertEqual(stats.sample_count, 6)
+        self.assertEqual(stats.total_time_us, 40)
+
+    def test_fork_error(self):
+        with patch.object(graphsignal._agent.current_run, 'reset_after_fork', side_effect=Exception('ex1')), \
+                patch.object(logger, 'error') as mocked_error:
+            graphsignal._reset_after_fork()
+            # not logged in the fork handler
+            mocked_error.assert_not_called()
+
+            graphsignal.current_run()
+            graphsignal.current_run()
+            mocked_error.assert_called_once()
+            self.assertEqual(str(mocked_error.call_args[1]['exc_info']), 'ex1')
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'fork is not supported')
+    @patch.object(Uploader, '_post',
+                  return_value=profiles_pb2.UploadResponse().SerializeToString())
+    def test_fork(self, mocked_post):
+        from graphsignal.profilers.generic import profile_inference
+
+        # stream locks of log handlers may be held by other threads at fork time
+        log_level = logger.level
+        logger.setLevel(logging.WARNING)
+        self.addCleanup(logger.setLevel, log_level)
+
+        uploader = graphsignal._agent.uploader
+        stopped = threading.Event()
+        def run_load():
+            while not stopped.is_set():
+                with profile_inference():
+                    pass
+                uploader.upload_profile(profiles_pb2.MLProfile())
+                uploader.flush_in_thread()
+        threads = [threading.Thread(target=run_load) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        parent_worker_id = graphsignal._agent.worker_id
+        try:
+            for _ in range(10):
+                # fork while locks are held by other threads
+                profiling_lock = profile_scheduler._profiling_lock
+                profiling_lock.acquire()
+                uploader.buffer_lock.acquire()
+                graphsignal.current_run()._shards_lock.acquire()
+                pid = os.fork()
+                if pid == 0:
+                    exit_code = 1
+                    try:
+                        exit_code = _check_forked_child(parent_worker_id)
+                    finally:
+                        os._exit(exit_code)
+                graphsignal.current_run()._shards_lock.release()
+                uploader.buffer_lock.release()
+                profiling_lock.release()
+
+                self.assertEqual(_wait_pid(pid, timeout=10), 0)
+        finally:
+            stopped.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(graphsignal._agent.worker_id, parent_worker_id)
+
+
+def _check_forked_child(parent_worker_id):
+    from graphsignal.profilers.generic import profile_inference
+
+    if graphsignal._agent.worker_id == parent_worker_id:
+        return 2
+    with profile_inference(ensure_profile=True):
+        pass
+    if graphsignal.current_run().total_inference_count != 1:
+        return 3
+    uploader = graphsignal._agent.uploader
+    uploader.upload_profile(profiles_pb2.MLProfile())
+    uploader.flush()
+    if uploader.queue_depth() != 0:
+        return 4
+    graphsignal.upload(block=True)
+    if uploader._worker is None or not uploader._worker.is_alive():
+        return 5
+    return 0
+
+
+def _wait_pid(pid, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        waited_pid, status = os.waitpid(pid, os.WNOHANG)
+        if waited_pid == pid:
+            return os.WEXITSTATUS(status)
+        time.sleep(0.01)
+    # child is deadlocked
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    return None
@@ -1,37 +1,61 @@
-from typing import Union
+from typing import Union, Optional
 import logging
 import time
 from threading import Lock
 import traceback
+import contextvars
 
 import graphsignal
 from graphsignal.proto import profiles_pb2
 
 logger = logging.getLogger('graphsignal')
 
+# profiled span of the current thread or asyncio task
+_current_span = contextvars.ContextVar('graphsignal_current_span', default=None)
+
 
 class InferenceSpan:
     __slots__ = [
+        '_current_run',
         '_operation_profiler',
         '_context',
+        '_span_name',
+        '_profile_scheduler',
         '_is_scheduled',
         '_is_profiling',
         '_profile',
         '_stop_lock',
         '_batch_size',
-        '_start_us',
-        '_metrics'
+        '_start_ns',
+        '_profiling_start_ns',
+        '_metrics',
+        '_context_token'
     ]
 
     def __init__(self, 
             batch_size=None, 
             ensure_profile=False, 
             operation_profiler=None,
-            context=None):
+            context=None,
+            current_run=None,
+            is_scheduled=None,
+            span_name=None):
         if batch_size is not None and not isinstance(batch_size, int):
                 raise ValueError('Invalid batch_size')
         self._batch_size = batch_size
 
+        if current_run is None:
+            current_run = graphsignal.current_run()
+        self._current_run = current_run
+
+        if span_name is not None:
+            if not isinstance(span_name, str):
+                raise ValueError('Invalid span_name')
+            span_name, self._profile_scheduler = current_run.span_scheduler(span_name)
+        else:
+            self._profile_scheduler = current_run.profile_scheduler
+        self._span_name = span_name
+
         self._operation_profiler = operation_profiler
         self._context = context
         self._is_scheduled = False
@@ -39,22 +63,28 @@ class InferenceSpan:
         self._profile = None
         self._stop_lock = Lock()
         self._metrics = None
+        self._context_token = None
+        self._profiling_start_ns = None
 
-        current_run = graphsignal.current_run()
+        if is_scheduled is None:
+            is_scheduled = self._profile_scheduler.lock(ensure=ensure_profile)
 
-        if current_run.profile_scheduler.lock(ensure=ensure_profile):
-            if logger.isEnabledFor(logging.DEBUG):
-                profiling_start_ts = time.time()
+        if is_scheduled:
+            profiling_start_ns = time.perf_counter_ns()
 
             self._is_scheduled = True
             self._profile = profiles_pb2.MLProfile()
             self._profile.workload_name = graphsignal._agent.workload_name
             self._profile.worker_id = graphsignal._agent.worker_id
-            self._profile.run_id = graphsignal.current_run().run_id
-            self._profile.run_start_ms = graphsignal.current_run().start_ms
+            self._profile.run_id = current_run.run_id
+            self._profile.run_start_ms = current_run.start_ms
             self._profile.node_usage.node_rank = graphsignal._agent.node_rank 
             self._profile.process_usage.global_rank = graphsignal._agent.global_rank 
             self._profile.process_usage.local_rank = graphsignal._agent.local_rank 
+            if span_name is not None:
+                param = self._profile.params.add()
+                param.name = 'span_name'
+                param.value = span_name
 
             try:
                 graphsignal._agent.process_reader.start()
@@ -68,26 +98,36 @@ class InferenceSpan:
                     self._operation_profiler.start(self._profile, self._context)
                     self._is_profiling = True
                 except Exception as exc:
-                    current_run.profile_scheduler.unlock()
                     self._is_profiling = False
                     self._add_profiler_exception(exc)
                     logger.error('Error starting profiler', exc_info=True)
 
-            self._profile.start_us = _timestamp_us()
+            self._profile.start_us = current_run.timestamp_us(time.perf_counter_ns())
 
+            self._start_ns = time.perf_counter_ns()
+            self._profiling_start_ns = profiling_start_ns
             if logger.isEnabledFor(logging.DEBUG):
-                logger.debug('Profiling start took: %fs', time.time() - profiling_start_ts)
-
-        self._start_us = _timestamp_us()
+                logger.debug('Profiling start took: %fs', (self._start_ns - profiling_start_ns) / 1e9)
+        else:
+            self._start_ns = time.perf_counter_ns()
 
     def __enter__(self):
+        self._context_token = _current_span.set(self)
         return self
 
     def __exit__(self, *exc):
         self.stop()
+        _reset_current_span(self._context_token)
+        self._context_token = None
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
 
     def stop(self) -> None:
-        stop_us = _timestamp_us()
+        stop_ns = time.perf_counter_ns()
 
         with self._stop_lock:
             if self._is_scheduled:
@@ -98,31 +138,33 @@ class InferenceSpan:
                         logger.error('Error stopping profiler', exc_info=True)
                         self._add_profiler_exception(exc)
 
-            current_run = graphsignal.current_run()
-
-            current_run.inc_total_inference_count()
+            current_run = self._current_run
 
             # only measure if not profiling to exclude spans with profiler overhead
             if not self._is_profiling:
-                current_run.update_inference_stats(
-                    stop_us - self._start_us,
-                    batch_size=self._batch_size)
+                current_run.record_inference(
+                    (stop_ns - self._start_ns) // 1000,
+                    batch_size=self._batch_size,
+                    span_name=self._span_name)
+            else:
+                current_run.inc_total_inference_count()
 
             if self._is_scheduled:
-                if logger.isEnabledFor(logging.DEBUG):
-                    profiling_stop_ts = time.time()
-
-                self._profile.end_us = stop_us
+                self._profile.end_us = current_run.timestamp_us(stop_ns)
 
                 self._profile.inference_stats.inference_count = current_run.total_inference_count
-                stats = current_run.inference_stats
+                stats = current_run.collect_inference_stats(span_name=self._span_name)
                 self._profile.inference_stats.inference_time_p95_us = stats.inference_time_p95_us()
                 self._profile.inference_stats.inference_time_avg_us = stats.inference_time_avg_us()
                 self._profile.inference_stats.inference_rate = stats.inference_rate()
                 self._profile.inference_stats.sample_rate = stats.sample_rate()
+                if stats.inference_count > 0:
+                    for percentile in stats.REPORTED_PERCENTILES:
+                        metric = self._profile.metrics.add()
+                        metric.name = 'inference_time_p{0}_us'.format(str(percentile).replace('.', ''))
+                        metric.value = stats.inference_time_percentile_us(percentile)
                 if self._batch_size:
                     self._profile.inference_stats.batch_size = self._batch_size
-                current_run.reset_inference_stats()
 
                 try:
                     graphsignal._agent.process_reader.read(self._profile)
@@ -133,13 +175,20 @@ class InferenceSpan:
 
                 current_run.add_profile(self._profile)
 
+                # profiling overhead is the start and stop time plus latency
+                # added to the span compared to the average unprofiled span
+                profiling_stop_ns = time.perf_counter_ns()
+                overhead_ns = (self._start_ns - self._profiling_start_ns) + (profiling_stop_ns - stop_ns)
+                if self._is_profiling:
+                    overhead_ns += max(stop_ns - self._start_ns - stats.inference_time_avg_us() * 1000, 0)
+
                 self._is_scheduled = False
                 self._is_profiling = False
                 self._profile = None
-                current_run.profile_scheduler.unlock()
+                self._profile_scheduler.unlock(overhead_sec=overhead_ns / 1e9)
 
                 if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug('Profiling stop took: %fs', time.time() - profiling_stop_ts)
+                    logger.debug('Profiling stop took: %fs', (profiling_stop_ns - stop_ns) / 1e9)
 
     def set_batch_size(self, batch_size: int) -> None:
         if not isinstance(batch_size, int):
@@ -156,5 +205,98 @@ class InferenceSpan:
                     profiler_error.stack_trace = ''.join(frames)
 
 
-def _timestamp_us():
-    return int(time.time() * 1e6)
+class UnscheduledInferenceSpan:
+    _is_scheduled = False
+    _is_profiling = False
+    _profile = None
+
+    __slots__ = [
+        '_current_run',
+        '_span_name',
+        '_batch_size',
+        '_start_ns'
+    ]
+
+    def __init__(self, current_run, batch_size=None, span_name=None):
+        if batch_size is not None and not isinstance(batch_size, int):
+            raise ValueError('Invalid batch_size')
+        self._batch_size = batch_size
+        self._current_run = current_run
+        self._span_name = span_name
+        self._start_ns = time.perf_counter_ns()
+
+    # not set as the current span, which only tracks profiled spans
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+
+    def stop(self) -> None:
+        stop_ns = time.perf_counter_ns()
+
+        self._current_run.record_inference(
+            (stop_ns - self._start_ns) // 1000,
+            batch_size=self._batch_size,
+            span_name=self._span_name)
+
+    def set_batch_size(self, batch_size: int) -> None:
+        if not isinstance(batch_size, int):
+            raise ValueError('Invalid batch_size')
+        self._batch_size = batch_size
+
+    def _add_profiler_exception(self, exc):
+        pass
+
+
+# span returned by start_inference_span, profiled or only measured
+AnyInferenceSpan = Union[InferenceSpan, UnscheduledInferenceSpan]
+
+
+def start_inference_span(
+        batch_size=None,
+        ensure_profile=False,
+        operation_profiler=None,
+        context=None,
+        span_name=None) -> AnyInferenceSpan:
+    current_run = graphsignal.current_run()
+
+    if span_name is not None:
+        if not isinstance(span_name, str):
+            raise ValueError('Invalid span_name')
+        span_name, profile_scheduler = current_run.span_scheduler(span_name)
+    else:
+        profile_scheduler = current_run.profile_scheduler
+
+    # most spans are not profiled, only measured, so skip the profiling
+    # bookkeeping (stop lock, profile and reader setup) for them
+    if not profile_scheduler.lock(ensure=ensure_profile):
+        return UnscheduledInferenceSpan(current_run, batch_size=batch_size, span_name=span_name)
+
+    return InferenceSpan(
+        batch_size=batch_size,
+        operation_profiler=operation_profiler,
+        context=context,
+        current_run=current_run,
+        is_scheduled=True,
+        span_name=span_name)
+
+
+def current_span() -> Optional[AnyInferenceSpan]:
+    return _current_span.get()
+
+
+def _reset_current_span(token):
+    if token is None:
+        return
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        # span exited in a different context than it was entered in
+        _current_span.set(None)
@@ -2,11 +2,13 @@ import unittest
 import logging
 import sys
 import time
+import asyncio
 from unittest.mock import patch, Mock
 
 import graphsignal
 from graphsignal.proto import profiles_pb2
-from graphsignal.inference_span import InferenceSpan
+from graphsignal.inference_span import InferenceSpan, UnscheduledInferenceSpan, start_inference_span, current_span
+from graphsignal.profile_scheduler import ProfileScheduler
 from graphsignal.profilers.tensorflow import TensorflowProfiler
 from graphsignal.usage.process_reader import ProcessReader
 from graphsignal.usage.nvml_reader import NvmlReader
@@ -81,10 +83,11 @@ class InferenceSpanTest(unittest.TestCase):
         self.assertEqual(profile.params[0].value, 'v2')
         self.assertEqual(profile.params[1].name, 'n3')
         self.assertEqual(profile.params[1].value, 'v3')
-        self.assertEqual(profile.metrics[0].name, 'm1')
-        self.assertEqual(profile.metrics[0].value, 2.2)
-        self.assertEqual(profile.metrics[1].name, 'm3')
-        self.assertEqual(profile.metrics[1].value, 3)
+        metrics = {metric.name: metric.value for metric in profile.metrics}
+        self.assertEqual(metrics['m1'], 2.2)
+        self.assertEqual(metrics['m3'], 3)
+        self.assertTrue(metrics['inference_time_p50_us'] > 0)
+        self.assertTrue(metrics['inference_time_p999_us'] >= metrics['inference_time_p50_us'])
         self.assertEqual(profile.node_usage.node_rank, -1)
         self.assertEqual(profile.process_usage.local_rank, 1)
         self.assertEqual(profile.process_usage.global_rank, 1)
@@ -138,3 +141,197 @@ class InferenceSpanTest(unittest.TestCase):
         self.assertTrue(profile.end_us > 0)
         self.assertEqual(profile.profiler_errors[0].message, 'ex1')
         self.assertNotEqual(profile.profiler_errors[0].stack_trace, '')
+
+    @patch.object(ProfileScheduler, 'lock', return_value=False)
+    def test_start_unscheduled(self, mocked_lock):
+        span = start_inference_span(
+            batch_size=128,
+            operation_profiler=TensorflowProfiler())
+        self.assertIsInstance(span, UnscheduledInferenceSpan)
+        self.assertFalse(span._is_scheduled)
+        span.set_batch_size(256)
+        time.sleep(0.01)
+        span.stop()
+
+        current_run = graphsignal.current_run()
+        self.assertEqual(current_run.total_inference_count, 1)
+        self.assertEqual(current_run.inference_stats.inference_count, 1)
+        self.assertEqual(current_run.inference_stats.sample_count, 256)
+        self.assertTrue(current_run.inference_stats.inference_time_avg_us() >= 10000)
+
+    @patch.object(TensorflowProfiler, 'start', return_value=True)
+    @patch.object(TensorflowProfiler, 'stop', return_value=True)
+    @patch.object(ProcessReader, 'read')
+    @patch.object(NvmlReader, 'read')
+    @patch.object(ProfileScheduler, 'unlock')
+    @patch.object(ProfileScheduler, 'lock', return_value=False)
+    @patch.object(Uploader, 'upload_profile')
+    def test_unscheduled_fast_path(self, mocked_upload_profile, mocked_lock, mocked_unlock,
+                                   mocked_nvml_read, mocked_host_read, mocked_stop, mocked_start):
+        profiler = TensorflowProfiler()
+        for _ in range(100):
+            with start_inference_span(operation_profiler=profiler) as span:
+                self.assertIsInstance(span, UnscheduledInferenceSpan)
+
+        # unscheduled spans are only measured
+        self.assertEqual(mocked_lock.call_count, 100)
+        mocked_unlock.assert_not_called()
+        mocked_start.assert_not_called()
+        mocked_stop.assert_not_called()
+        mocked_host_read.assert_not_called()
+        mocked_nvml_read.assert_not_called()
+        graphsignal.upload(block=True)
+        mocked_upload_profile.assert_not_called()
+        self.assertEqual(graphsignal.current_run().total_inference_count, 100)
+        self.assertEqual(graphsignal.current_run().inference_stats.inference_count, 100)
+
+    @patch.object(TensorflowProfiler, 'start', return_value=True)
+    @patch.object(TensorflowProfiler, 'stop', return_value=True)
+    @patch.object(ProcessReader, 'read')
+    @patch.object(NvmlReader, 'read')
+    @patch.object(Uploader, 'upload_profile')
+    def test_span_overhead(self, mocked_upload_profile, mocked_nvml_read, mocked_host_read,
+                           mocked_stop, mocked_start):
+        profiler = TensorflowProfiler()
+
+        num_sampled = 100
+        with patch.object(ProfileScheduler, 'lock', new=lambda self, ensure=False: True):
+            start_ns = time.perf_counter_ns()
+            for _ in range(num_sampled):
+                with start_inference_span(operation_profiler=profiler):
+                    pass
+            sampled_ns = (time.perf_counter_ns() - start_ns) / num_sampled
+
+        num_unsampled = 100000
+        with patch.object(ProfileScheduler, 'lock', new=lambda self, ensure=False: False):
+            start_ns = time.perf_counter_ns()
+            for _ in range(num_unsampled):
+                with start_inference_span(operation_profiler=profiler):
+                    pass
+            unsampled_ns = (time.perf_counter_ns() - start_ns) / num_unsampled
+
+        # benchmark only, timing depends on the machine
+        logger.debug('Span overhead: sampled %d ns/span, unsampled %d ns/span', sampled_ns, unsampled_ns)
+
+        self.assertEqual(mocked_start.call_count, num_sampled)
+        self.assertEqual(graphsignal.current_run().total_inference_count, num_sampled + num_unsampled)
+
+    @patch.object(ProcessReader, 'read')
+    @patch.object(NvmlReader, 'read')
+    @patch.object(Uploader, 'upload_profile')
+    def test_clock_step(self, mocked_upload_profile, mocked_nvml_read, mocked_host_read):
+        wall_time = time.time()
+
+        span = InferenceSpan(ensure_profile=True)
+        # wall clock is stepped back by an hour during the span
+        with patch.object(time, 'time', return_value=wall_time - 3600), \
+                patch.object(time, 'time_ns', return_value=int((wall_time - 3600) * 1e9)):
+            time.sleep(0.01)
+            span.stop()
+
+        graphsignal.upload()
+        profile = mocked_upload_profile.call_args[0][0]
+
+        self.assertTrue(profile.start_us >= int(wall_time * 1e6) - 1e6)
+        self.assertTrue(profile.end_us - profile.start_us >= 10000)
+        self.assertTrue(profile.end_us - profile.start_us < 1e6)
+        self.assertTrue(profile.inference_stats.inference_time_avg_us >= 10000)
+        self.assertTrue(profile.inference_stats.inference_time_avg_us < 1e6)
+
+    @patch.object(TensorflowProfiler, 'start', return_value=True)
+    @patch.object(TensorflowProfiler, 'stop', return_value=True)
+    @patch.object(ProcessReader, 'read')
+    @patch.object(NvmlReader, 'read')
+    @patch.object(Uploader, 'upload_profile')
+    def test_async_spans(self, mocked_upload_profile, mocked_nvml_read, mocked_host_read,
+                         mocked_stop, mocked_start):
+        profiler = TensorflowProfiler()
+        durations_ns = []
+
+        async def handle_request(delay):
+            async with start_inference_span(operation_profiler=profiler, ensure_profile=True) as span:
+                # only the profiled span is tracked
+                expected_span = span if span._is_scheduled else None
+                self.assertIs(current_span(), expected_span)
+                start_ns = time.perf_counter_ns()
+                await asyncio.sleep(delay)
+                self.assertIs(current_span(), expected_span)
+                span.set_batch_size(1)
+                durations_ns.append(time.perf_counter_ns() - start_ns)
+            self.assertIsNone(current_span())
+
+        async def handle_requests():
+            await asyncio.gather(*[handle_request(0.01 * (i % 5 + 1)) for i in range(50)])
+
+        asyncio.run(handle_requests())
+        graphsignal.upload()
+
+        self.assertIsNone(current_span())
+        # overlapping spans are measured, but only one is profiled at a time
+        self.assertEqual(mocked_start.call_count, 1)
+        self.assertEqual(mocked_stop.call_count, 1)
+        self.assertEqual(len(durations_ns), 50)
+        self.assertEqual(graphsignal.current_run().total_inference_count, 50)
+        stats = graphsignal.current_run().inference_stats
+        self.assertEqual(stats.inference_count, 49)
+        self.assertTrue(stats.inference_time_avg_us() >= 10000)
+        self.assertTrue(stats.inference_time_avg_us() < 50000)
+
+    @patch.object(ProcessReader, 'read')
+    @patch.object(NvmlReader, 'read')
+    @patch.object(ProfileScheduler, 'lock', return_value=True)
+    def test_current_span_nested(self, mocked_lock, mocked_nvml_read, mocked_host_read):
+        self.assertIsNone(current_span())
+        with start_inference_span() as span1:
+            self.assertIs(current_span(), span1)
+            with start_inference_span() as span2:
+                self.assertIs(current_span(), span2)
+            self.assertIs(current_span(), span1)
+        self.assertIsNone(current_span())
+
+    @patch.object(ProfileScheduler, 'lock', return_value=False)
+    def test_current_span_unscheduled(self, mocked_lock):
+        with start_inference_span() as span:
+            self.assertIsInstance(span, UnscheduledInferenceSpan)
+            self.assertIsNone(current_span())
+
+    @patch.object(ProcessReader, 'read')
+    @patch.object(NvmlReader, 'read')
+    @patch.object(Uploader, 'upload_profile')
+    def test_span_names(self, mocked_upload_profile, mocked_nvml_read, mocked_host_read):
+        for i in range(1000):
+            with start_inference_span(span_name='classify'):
+                pass
+            if i % 100 == 0:
+                with start_inference_span(span_name='generate'):
+                    time.sleep(0.001)
+        graphsignal.upload()
+
+        profiles = [call[0][0] for call in mocked_upload_profile.call_args_list]
+        span_names = [
+            {param.name: param.value for param in profile.params}.get('span_name')
+            for profile in profiles]
+        # the rare span is profiled on its own schedule
+        self.assertEqual(span_names.count('generate'), 3)
+        self.assertTrue(span_names.count('classify') > 3)
+
+        generate_profile = profiles[span_names.index('generate', 1)]
+        self.assertTrue(generate_profile.inference_stats.inference_time_avg_us >= 1000)
+        classify_profile = profiles[span_names.index('classify', 1)]
+        self.assertTrue(classify_profile.inference_stats.inference_time_avg_us < 1000)
+
+    @patch.object(TensorflowProfiler, 'start', return_value=True)
+    @patch.object(TensorflowProfiler, 'stop')
+    @patch.object(Uploader, 'upload_profile')
+    def test_profiling_overhead(self, mocked_upload_profile, mocked_stop, mocked_start):
+        mocked_stop.side_effect = lambda profile, context: time.sleep(0.02)
+        scheduler = graphsignal.current_run().profile_scheduler
+
+        for _ in range(10):
+            with start_inference_span():
+                time.sleep(0.001)
+        with start_inference_span(ensure_profile=True, operation_profiler=TensorflowProfiler()):
+            time.sleep(0.001)
+
+        # profiler stop time is included
+        self.assertTrue(scheduler.total_overhead_sec >= 0.02)
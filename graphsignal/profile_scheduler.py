@@ -7,19 +7,54 @@ logger = logging.getLogger('graphsignal')
 
 # global profiling lock
 _profiling_lock = Lock()
+# optional profiling slots shared with other processes on the node
+_profiling_slots = None
+
+
+def set_profiling_slots(profiling_slots):
+    global _profiling_slots
+    _profiling_slots = profiling_slots
+
+
+def reset_after_fork():
+    # the lock may have been held by a thread of the parent process
+    global _profiling_lock
+    _profiling_lock = Lock()
+    if _profiling_slots:
+        _profiling_slots.reset_after_fork()
+
 
 class ProfileScheduler:
     MAX_ENSURED_SPANS = 10
     PREDEFINED_SPANS = [1, 5, 10, 25, 100, 250, 1000]
     MIN_INTERVAL_SEC = 60
     MIN_INTERVAL_SPANS = 20
+    # adaptive scheduling, used if overhead budget is set
+    MIN_ADAPTIVE_INTERVAL_SEC = 1
+    MAX_ADAPTIVE_INTERVAL_SEC = 600
+    OVERHEAD_SMOOTHING = 0.3
+    # the clock is read at least every MAX_CHECK_SPANS spans, so that a drop
+    # in span rate does not delay profiles
+    MAX_CHECK_SPANS = 20
 
-    def __init__(self):
+    def __init__(self, overhead_budget=None):
         self._current_span = -1
         self._ensured_inference_count = 0
         self._last_profiled_ts = None
         self._last_profiled_span = None
         self._span_filter = {span for span in ProfileScheduler.PREDEFINED_SPANS}
+        # fraction of wall time to spend on profiling
+        self.overhead_budget = overhead_budget
+        # number of schedulers sharing the budget
+        self.overhead_shares = 1
+        self.profile_cost_sec = None
+        self.total_overhead_sec = 0
+        self._pending_overhead_sec = 0
+        self._next_profile_ts = None
+        self._next_check_span = 0
+        self._check_spans = 0
+        self._last_adaptive_ts = None
+        self._last_adaptive_span = None
 
     def lock(self, ensure=False):
         self._current_span += 1
@@ -34,25 +69,84 @@ class ProfileScheduler:
             if self._ensured_inference_count <= ProfileScheduler.MAX_ENSURED_SPANS:
                 should_acquire = True
 
-        if self._current_span + 1 in self._span_filter:
-            should_acquire = True
-
-        if self._last_profiled_ts:
-            last_interval_sec = time.time() - self._last_profiled_ts
-            last_interval_spans = self._current_span - self._last_profiled_span
-            if last_interval_sec > self.MIN_INTERVAL_SEC and last_interval_spans > self.MIN_INTERVAL_SPANS:
-                self._span_filter = {} # switch to interval-based profiling
+        if self.overhead_budget:
+            if self._is_adaptive_due():
+                should_acquire = True
+        else:
+            if self._current_span + 1 in self._span_filter:
                 should_acquire = True
 
+            # check span interval first to avoid reading time on every span
+            if self._last_profiled_ts and self._current_span - self._last_profiled_span > self.MIN_INTERVAL_SPANS:
+                last_interval_sec = time.time() - self._last_profiled_ts
+                if last_interval_sec > self.MIN_INTERVAL_SEC:
+                    self._span_filter = {} # switch to interval-based profiling
+                    should_acquire = True
+
         if should_acquire:
-            _profiling_lock.acquire(blocking=False)
+            if not _profiling_lock.acquire(blocking=False):
+                return False
+            if _profiling_slots and not _profiling_slots.acquire():
+                _profiling_lock.release()
+                return False
             return True
         else:
             return False
 
-    def unlock(self):
+    def unlock(self, overhead_sec=None):
         if not _profiling_lock.locked():
             return
         self._last_profiled_ts = time.time()
         self._last_profiled_span = self._current_span
+        if overhead_sec is not None:
+            self.record_overhead(overhead_sec)
+        if self.overhead_budget:
+            self._schedule_next_profile()
+        if _profiling_slots:
+            _profiling_slots.release()
         _profiling_lock.release()
+
+    def record_overhead(self, overhead_sec):
+        # latency added to profiled spans and CPU spent on converting and uploading profiles
+        self._pending_overhead_sec += overhead_sec
+        self.total_overhead_sec += overhead_sec
+
+    def _is_adaptive_due(self):
+        # the first span is profiled to measure profiling cost
+        if self._next_profile_ts is None:
+            return True
+        if self._current_span < self._next_check_span:
+            return False
+        if time.monotonic() >= self._next_profile_ts:
+            return True
+        # check more often when getting close to the next profile
+        self._check_spans //= 2
+        self._next_check_span = self._current_span + 1 + self._check_spans
+        return False
+
+    def _schedule_next_profile(self):
+        cost_sec = self._pending_overhead_sec
+        self._pending_overhead_sec = 0
+        if self.profile_cost_sec is None:
+            self.profile_cost_sec = cost_sec
+        else:
+            self.profile_cost_sec += self.OVERHEAD_SMOOTHING * (cost_sec - self.profile_cost_sec)
+
+        # profile as often as the overhead budget allows
+        interval_sec = min(max(
+            self.profile_cost_sec * self.overhead_shares / self.overhead_budget,
+            self.MIN_ADAPTIVE_INTERVAL_SEC),
+            self.MAX_ADAPTIVE_INTERVAL_SEC)
+
+        # estimate spans until the next profile to avoid reading time on every span
+        now = time.monotonic()
+        self._check_spans = 0
+        if self._last_adaptive_ts is not None and now > self._last_adaptive_ts:
+            span_rate = (self._current_span - self._last_adaptive_span) / (now - self._last_adaptive_ts)
+            self._check_spans = min(int(span_rate * interval_sec * 0.5), self.MAX_CHECK_SPANS)
+        self._next_check_span = self._current_span + 1 + self._check_spans
+        self._last_adaptive_ts = now
+        self._last_adaptive_span = self._current_span
+        self._next_profile_ts = now + interval_sec
+
+        logger.debug('Profiling cost %.4fs, next profile in %.1fs', self.profile_cost_sec, interval_sec)
@@ -58,3 +58,77 @@ class ProfileSchedulerTest(unittest.TestCase):
         self.assertTrue(scheduler.lock(ensure=True))
         scheduler.unlock()
 
+
+    def test_adaptive(self):
+        scheduler = ProfileScheduler(overhead_budget=0.01)
+        self.assertTrue(scheduler.lock())
+        scheduler.unlock(overhead_sec=0.05)
+        self.assertEqual(scheduler.profile_cost_sec, 0.05)
+        # 0.05s cost within 1% of wall time
+        self.assertAlmostEqual(scheduler._next_profile_ts - time.monotonic(), 5, delta=0.1)
+        for _ in range(100):
+            self.assertFalse(scheduler.lock())
+            scheduler.unlock()
+
+        scheduler._next_profile_ts = time.monotonic() - 1
+        self.assertTrue(scheduler.lock())
+        scheduler.record_overhead(0.01)
+        scheduler.unlock(overhead_sec=0.09)
+        self.assertAlmostEqual(scheduler.profile_cost_sec, 0.05 + ProfileScheduler.OVERHEAD_SMOOTHING * 0.05)
+
+    def test_adaptive_bounds(self):
+        scheduler = ProfileScheduler(overhead_budget=0.01)
+        self.assertTrue(scheduler.lock())
+        scheduler.unlock(overhead_sec=0)
+        self.assertAlmostEqual(scheduler._next_profile_ts - time.monotonic(),
+            ProfileScheduler.MIN_ADAPTIVE_INTERVAL_SEC, delta=0.1)
+
+        scheduler = ProfileScheduler(overhead_budget=0.01)
+        self.assertTrue(scheduler.lock())
+        scheduler.unlock(overhead_sec=100)
+        self.assertAlmostEqual(scheduler._next_profile_ts - time.monotonic(),
+            ProfileScheduler.MAX_ADAPTIVE_INTERVAL_SEC, delta=0.1)
+
+    def test_adaptive_overhead(self):
+        # simulated 2ms spans, profiled spans cost 50ms
+        overhead_budget = 0.005
+        clock = [1000.0]
+        with patch('graphsignal.profile_scheduler.time.monotonic', new=lambda: clock[0]):
+            scheduler = ProfileScheduler(overhead_budget=overhead_budget)
+            profiled_count = 0
+            overhead_sec = 0
+            for _ in range(1000000):
+                clock[0] += 0.002
+                if scheduler.lock():
+                    profiled_count += 1
+                    clock[0] += 0.05
+                    overhead_sec += 0.05
+                    scheduler.unlock(overhead_sec=0.05)
+            wall_sec = clock[0] - 1000.0
+
+        logger.debug('Profiled %d spans, overhead %.3f%% of wall time', profiled_count, overhead_sec / wall_sec * 100)
+        self.assertTrue(profiled_count > 10)
+        self.assertTrue(overhead_sec / wall_sec <= overhead_budget * 1.1)
+
+    def test_adaptive_rate_drop(self):
+        # 10k spans per second, then 1 span per second for an hour
+        overhead_budget = 0.01
+        clock = [1000.0]
+        with patch('graphsignal.profile_scheduler.time.monotonic', new=lambda: clock[0]):
+            scheduler = ProfileScheduler(overhead_budget=overhead_budget)
+            for _ in range(100000):
+                clock[0] += 0.0001
+                if scheduler.lock():
+                    scheduler.unlock(overhead_sec=0.1)
+
+            profiled_count = 0
+            for _ in range(3600):
+                clock[0] += 1
+                if scheduler.lock():
+                    profiled_count += 1
+                    scheduler.unlock(overhead_sec=0.1)
+
+        # 0.1s cost within 1% of wall time, every 10 seconds
+        logger.debug('Profiled %d spans in an hour after span rate drop', profiled_count)
+        self.assertTrue(profiled_count > 300)
+
@@ -0,0 +1,214 @@
+import logging
+import os
+import time
+import struct
+import glob
+import uuid
+
+from graphsignal.proto import profiles_pb2
+
+logger = logging.getLogger('graphsignal')
+
+SEGMENT_SUFFIX = '.seg'
+TEMP_SUFFIX = '.tmp'
+CLAIMED_SUFFIX = '.claimed'
+RECORD_HEADER = struct.Struct('>I')
+
+_owner_pid = None
+_owner_id = None
+
+
+class ProfileSpool:
+    MAX_SPOOL_BYTES = int(100 * 1e6)
+    MAX_SEGMENT_BYTES = int(5 * 1e6)
+
+    def __init__(self, spool_dir, max_spool_bytes=None, max_segment_bytes=None):
+        self.spool_dir = spool_dir
+        self.max_spool_bytes = max_spool_bytes or ProfileSpool.MAX_SPOOL_BYTES
+        self.max_segment_bytes = max_segment_bytes or ProfileSpool.MAX_SEGMENT_BYTES
+        self.evicted_count = 0
+
+    def setup(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._recover()
+
+    def write(self, profiles):
+        # each batch is written to new segments, which only become visible
+        # to readers after they are completely written and renamed
+        records = []
+        records_bytes = 0
+        for profile in profiles:
+            data = profile.SerializeToString()
+            if records and records_bytes + len(data) > self.max_segment_bytes:
+                self._write_segment(records)
+                records = []
+                records_bytes = 0
+            records.append(data)
+            records_bytes += RECORD_HEADER.size + len(data)
+        if records:
+            self._write_segment(records)
+
+        self._evict()
+
+    def claim_segments(self):
+        claimed_paths = []
+        for segment_path in self._list(SEGMENT_SUFFIX):
+            claimed_path = '{0}.{1}{2}'.format(segment_path, _owner(), CLAIMED_SUFFIX)
+            try:
+                os.rename(segment_path, claimed_path)
+                claimed_paths.append(claimed_path)
+            except OSError:
+                # claimed by another process
+                pass
+        return claimed_paths
+
+    def read_segment(self, claimed_path):
+        profiles = []
+        with open(claimed_path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            record_size, = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            if offset + record_size > len(data):
+                logger.debug('Truncated record in spool segment %s', claimed_path)
+                break
+            profile = profiles_pb2.MLProfile()
+            profile.ParseFromString(data[offset:offset + record_size])
+            profiles.append(profile)
+            offset += record_size
+        return profiles
+
+    def remove_segment(self, claimed_path):
+        try:
+            os.remove(claimed_path)
+        except OSError:
+            logger.debug('Error removing spool segment %s', claimed_path, exc_info=True)
+
+    def release_segment(self, claimed_path):
+        try:
+            os.rename(claimed_path, _segment_path(claimed_path))
+        except OSError:
+            logger.debug('Error releasing spool segment %s', claimed_path, exc_info=True)
+
+    def size(self):
+        total_bytes = 0
+        for segment_path in self._list(SEGMENT_SUFFIX):
+            try:
+                total_bytes += os.path.getsize(segment_path)
+            except OSError:
+                pass
+        return total_bytes
+
+    def has_segments(self):
+        return len(self._list(SEGMENT_SUFFIX)) > 0
+
+    def _write_segment(self, records):
+        segment_name = 'segment-{0:020d}-{1}'.format(time.time_ns(), _owner())
+        temp_path = os.path.join(self.spool_dir, segment_name + TEMP_SUFFIX)
+        with open(temp_path, 'wb') as f:
+            for data in records:
+                f.write(RECORD_HEADER.pack(len(data)))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, os.path.join(self.spool_dir, segment_name + SEGMENT_SUFFIX))
+
+    def _evict(self):
+        segment_paths = self._list(SEGMENT_SUFFIX)
+        segment_sizes = []
+        total_bytes = 0
+        for segment_path in segment_paths:
+            try:
+                segment_size = os.path.getsize(segment_path)
+            except OSError:
+                segment_size = 0
+            segment_sizes.append(segment_size)
+            total_bytes += segment_size
+
+        # oldest segments first
+        for segment_path, segment_size in zip(segment_paths, segment_sizes):
+            if total_bytes <= self.max_spool_bytes:
+                break
+            try:
+                os.remove(segment_path)
+                total_bytes -= segment_size
+                self.evicted_count += 1
+                logger.debug('Evicted spool segment %s', segment_path)
+            except OSError:
+                pass
+
+    def _recover(self):
+        # segments left by crashed or exited processes
+        for claimed_path in self._list(CLAIMED_SUFFIX):
+            if not _is_owner_alive(_claimed_owner(claimed_path)):
+                self.release_segment(claimed_path)
+        for temp_path in self._list(TEMP_SUFFIX):
+            if not _is_owner_alive(_temp_owner(temp_path)):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def _list(self, suffix):
+        return sorted(glob.glob(os.path.join(self.spool_dir, 'segment-*' + suffix)))
+
+
+def _segment_path(claimed_path):
+    return claimed_path[:-len(CLAIMED_SUFFIX)].rsplit('.', 1)[0]
+
+
+def _claimed_owner(claimed_path):
+    try:
+        return claimed_path[:-len(CLAIMED_SUFFIX)].rsplit('.', 1)[1]
+    except IndexError:
+        return None
+
+
+def _temp_owner(temp_path):
+    return '-'.join(temp_path[:-len(TEMP_SUFFIX)].rsplit('-', 2)[1:])
+
+
+def _owner():
+    # PID and start time of this process, PIDs alone are reused, e.g. PID 1
+    # in a restarted container
+    global _owner_pid, _owner_id
+    pid = os.getpid()
+    if _owner_pid != pid:
+        start_time = _process_start_time(pid) or uuid.uuid4().hex[:12]
+        _owner_id = '{0}-{1}'.format(pid, start_time)
+        _owner_pid = pid
+    return _owner_id
+
+
+def _process_start_time(pid):
+    try:
+        with open('/proc/{0}/stat'.format(pid), 'rb') as f:
+            stat = f.read()
+        # fields after the command name, which may contain spaces
+        return stat[stat.rfind(b')') + 2:].split()[19].decode()
+    except (OSError, IndexError):
+        return None
+
+
+def _is_owner_alive(owner):
+    try:
+        pid_str, start_time = owner.split('-')
+        pid = int(pid_str)
+    except (AttributeError, ValueError):
+        return False
+    if pid == os.getpid():
+        # files of this process are left over by a previous spool or by an
+        # earlier process with the same PID
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    # the PID may belong to another process now
+    current_start_time = _process_start_time(pid)
+    if current_start_time is not None and current_start_time != start_time:
+        return False
+    return True
@@ -0,0 +1,153 @@
+import unittest
+import logging
+import sys
+import os
+import tempfile
+import shutil
+import subprocess
+
+from graphsignal.profile_spool import ProfileSpool, _owner, _process_start_time
+from graphsignal.proto import profiles_pb2
+
+logger = logging.getLogger('graphsignal')
+
+
+class ProfileSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp(prefix='graphsignal-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_write_read(self):
+        spool = ProfileSpool(self.spool_dir)
+        spool.setup()
+
+        profiles = []
+        for i in range(5):
+            profile = profiles_pb2.MLProfile()
+            profile.workload_name = 'w{0}'.format(i)
+            profiles.append(profile)
+        spool.write(profiles)
+        self.assertTrue(spool.has_segments())
+        self.assertTrue(spool.size() > 0)
+
+        claimed_paths = spool.claim_segments()
+        self.assertEqual(len(claimed_paths), 1)
+        self.assertFalse(spool.has_segments())
+        self.assertEqual(spool.claim_segments(), [])
+
+        read_profiles = spool.read_segment(claimed_paths[0])
+        self.assertEqual([p.workload_name for p in read_profiles], ['w0', 'w1', 'w2', 'w3', 'w4'])
+
+        spool.remove_segment(claimed_paths[0])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_segments(self):
+        spool = ProfileSpool(self.spool_dir, max_segment_bytes=1000)
+        spool.setup()
+
+        profiles = []
+        for i in range(10):
+            profile = profiles_pb2.MLProfile()
+            profile.trace_data = b'0' * 400
+            profiles.append(profile)
+        spool.write(profiles)
+
+        claimed_paths = spool.claim_segments()
+        self.assertEqual(len(claimed_paths), 5)
+        read_count = sum([len(spool.read_segment(path)) for path in claimed_paths])
+        self.assertEqual(read_count, 10)
+
+    def test_evict_oldest(self):
+        spool = ProfileSpool(self.spool_dir, max_spool_bytes=2500, max_segment_bytes=1000)
+        spool.setup()
+
+        for i in range(5):
+            profile = profiles_pb2.MLProfile()
+            profile.workload_name = 'w{0}'.format(i)
+            profile.trace_data = b'0' * 900
+            spool.write([profile])
+
+        self.assertTrue(spool.size() <= 2500)
+        self.assertEqual(spool.evicted_count, 3)
+        claimed_paths = spool.claim_segments()
+        names = [spool.read_segment(path)[0].workload_name for path in claimed_paths]
+        self.assertEqual(names, ['w3', 'w4'])
+
+    def test_truncated_record(self):
+        spool = ProfileSpool(self.spool_dir)
+        spool.setup()
+
+        profile = profiles_pb2.MLProfile()
+        profile.workload_name = 'w1'
+        spool.write([profile, profile])
+        claimed_path = spool.claim_segments()[0]
+        with open(claimed_path, 'r+b') as f:
+            f.truncate(os.path.getsize(claimed_path) - 1)
+
+        self.assertEqual(len(spool.read_segment(claimed_path)), 1)
+
+    def test_recover(self):
+        spool = ProfileSpool(self.spool_dir)
+        spool.setup()
+        spool.write([profiles_pb2.MLProfile()])
+        claimed_path = spool.claim_segments()[0]
+
+        # simulate segment claimed by a crashed process
+        dead_owner = '{0}-1'.format(2 ** 22 + 1)
+        os.rename(claimed_path, claimed_path.replace('.{0}.'.format(_owner()), '.{0}.'.format(dead_owner)))
+        with open(os.path.join(self.spool_dir, 'segment-00000000000000000001-{0}.tmp'.format(dead_owner)), 'wb') as f:
+            f.write(b'partial')
+
+        spool = ProfileSpool(self.spool_dir)
+        spool.setup()
+        self.assertEqual(len(spool.claim_segments()), 1)
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+
+    def test_recover_same_pid(self):
+        spool = ProfileSpool(self.spool_dir)
+        spool.setup()
+        spool.write([profiles_pb2.MLProfile()])
+        claimed_path = spool.claim_segments()[0]
+
+        # restarted process got the PID of the process that claimed the segment
+        previous_owner = '{0}-previous'.format(os.getpid())
+        os.rename(claimed_path, claimed_path.replace('.{0}.'.format(_owner()), '.{0}.'.format(previous_owner)))
+        with open(os.path.join(self.spool_dir, 'segment-00000000000000000001-{0}.tmp'.format(previous_owner)), 'wb') as f:
+            f.write(b'partial')
+
+        spool = ProfileSpool(self.spool_dir)
+        spool.setup()
+        self.assertTrue(spool.has_segments())
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+
+        # leftover claims of this process are released as well
+        spool.claim_segments()
+        spool = ProfileSpool(self.spool_dir)
+        spool.setup()
+        self.assertTrue(spool.has_segments())
+
+    @unittest.skipIf(not os.path.exists('/proc/self/stat'), 'no /proc')
+    def test_recover_live_owner(self):
+        spool = ProfileSpool(self.spool_dir)
+        spool.setup()
+        spool.write([profiles_pb2.MLProfile()])
+        spool.write([profiles_pb2.MLProfile()])
+        claimed_paths = spool.claim_segments()
+
+        process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+        try:
+            live_owner = '{0}-{1}'.format(process.pid, _process_start_time(process.pid))
+            reused_owner = '{0}-1'.format(process.pid)
+            os.rename(claimed_paths[0], claimed_paths[0].replace('.{0}.'.format(_owner()), '.{0}.'.format(live_owner)))
+            os.rename(claimed_paths[1], claimed_paths[1].replace('.{0}.'.format(_owner()), '.{0}.'.format(reused_owner)))
+
+            # only the segment claimed by the process that still runs is kept claimed
+            spool = ProfileSpool(self.spool_dir)
+            spool.setup()
+            self.assertEqual(len(spool.claim_segments()), 1)
+        finally:
+            process.kill()
+            process.wait()
+
@@ -11,7 +11,7 @@ logger = logging.getLogger('graphsignal')
 
 import graphsignal
 from graphsignal.proto import profiles_pb2
-from graphsignal.inference_span import InferenceSpan
+from graphsignal.inference_span import AnyInferenceSpan, start_inference_span
 from graphsignal.profilers.operation_profiler import OperationProfiler
 
 logger = logging.getLogger('graphsignal')
@@ -66,10 +66,12 @@ _profiler = GenericProfiler()
 
 def profile_inference(
         batch_size: Optional[int] = None,
-        ensure_profile: Optional[bool] = False) -> InferenceSpan:
+        ensure_profile: Optional[bool] = False,
+        span_name: Optional[str] = None) -> AnyInferenceSpan:
     graphsignal._check_configured()
 
-    return InferenceSpan(
+    return start_inference_span(
         batch_size=batch_size,
         ensure_profile=ensure_profile,
-        operation_profiler=_profiler)
+        operation_profiler=_profiler,
+        span_name=span_name)
@@ -8,7 +8,7 @@ import graphsignal
 from graphsignal.proto import profiles_pb2
 from graphsignal.proto_utils import parse_semver
 from graphsignal.profilers.tensorflow import TensorflowProfiler
-from graphsignal.inference_span import InferenceSpan
+from graphsignal.inference_span import start_inference_span
 
 logger = logging.getLogger('graphsignal')
 
@@ -56,7 +56,7 @@ class GraphsignalCallback(Callback):
 
     def _start_profiler(self):
         if not self._span:
-            self._span = InferenceSpan(
+            self._span = start_inference_span(
                 batch_size=self._batch_size,
                 operation_profiler=self._profiler)
 
@@ -3,7 +3,6 @@ import logging
 import os
 import sys
 import time
-import gzip
 import atexit
 import threading
 import onnxruntime
@@ -11,9 +10,10 @@ import onnxruntime
 import graphsignal
 from graphsignal.proto_utils import parse_semver
 from graphsignal.proto import profiles_pb2
-from graphsignal.inference_span import InferenceSpan
+from graphsignal.inference_span import AnyInferenceSpan, start_inference_span
 from graphsignal.profilers.operation_profiler import OperationProfiler
 from graphsignal.profilers.profiler_utils import create_log_dir, remove_log_dir, find_and_read
+from graphsignal.trace_spill import set_trace_file
 
 logger = logging.getLogger('graphsignal')
 
@@ -66,9 +66,7 @@ class ONNXRuntimeProfiler(OperationProfiler):
                 if os.path.getsize(self._first_trace_path) > 50 * 1e6:
                     raise Exception('Trace file too big')
 
-                with open(self._first_trace_path) as f:
-                    trace_json = f.read()
-                    profile.trace_data = gzip.compress(trace_json.encode())
+                set_trace_file(profile, self._first_trace_path)
             except Exception as e:
                 logger.error('Error exporting Chrome trace', exc_info=True)
 
@@ -112,11 +110,13 @@ def initialize_profiler(session_options: onnxruntime.SessionOptions):
 def profile_inference(
         session: onnxruntime.InferenceSession,
         batch_size: Optional[int] = None,
-        ensure_profile: Optional[bool] = False) -> InferenceSpan:
+        ensure_profile: Optional[bool] = False,
+        span_name: Optional[str] = None) -> AnyInferenceSpan:
     graphsignal._check_configured()
 
-    return InferenceSpan(
+    return start_inference_span(
         batch_size=batch_size,
         ensure_profile=ensure_profile,
         operation_profiler=_profiler,
-        context=session)
+        context=session,
+        span_name=span_name)
@@ -12,6 +12,7 @@ from graphsignal.profilers.tensorflow_proto import kernel_stats_pb2
 from graphsignal.profilers.tensorflow_proto import memory_profile_pb2
 
 from graphsignal.proto import profiles_pb2
+from graphsignal.trace_spill import set_trace_data
 
 logger = logging.getLogger('graphsignal')
 
@@ -56,7 +57,7 @@ def convert_tensorflow_profile(log_dir, profile):
         decompress=False,
         max_size=5 * 1e6)
     if trace_json_gz:
-        profile.trace_data = trace_json_gz
+        set_trace_data(profile, trace_json_gz)
 
     # Operation stats
     tf_stats_data = find_and_read(
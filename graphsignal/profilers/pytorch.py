@@ -3,7 +3,6 @@ import logging
 import os
 import sys
 import time
-import gzip
 import torch
 from torch.autograd import DeviceType
 import torch.distributed
@@ -11,9 +10,10 @@ import torch.distributed
 import graphsignal
 from graphsignal.proto_utils import parse_semver
 from graphsignal.proto import profiles_pb2
-from graphsignal.inference_span import InferenceSpan
+from graphsignal.inference_span import AnyInferenceSpan, start_inference_span
 from graphsignal.profilers.operation_profiler import OperationProfiler
 from graphsignal.profilers.profiler_utils import create_log_dir, remove_log_dir
+from graphsignal.trace_spill import set_trace_file
 
 logger = logging.getLogger('graphsignal')
 
@@ -145,9 +145,7 @@ class PyTorchProfiler(OperationProfiler):
             if os.path.getsize(trace_path) > 50 * 1e6:
                 raise Exception('Trace file too big')
 
-            with open(trace_path) as f:
-                trace_json = f.read()
-                profile.trace_data = gzip.compress(trace_json.encode())
+            set_trace_file(profile, trace_path)
         except Exception as e:
             logger.error('Error exporting Chrome trace', exc_info=True)
         finally:
@@ -161,10 +159,12 @@ _profiler = PyTorchProfiler()
 
 def profile_inference(
         batch_size: Optional[int] = None,
-        ensure_profile: Optional[bool] = False) -> InferenceSpan:
+        ensure_profile: Optional[bool] = False,
+        span_name: Optional[str] = None) -> AnyInferenceSpan:
     graphsignal._check_configured()
 
-    return InferenceSpan(
+    return start_inference_span(
         batch_size=batch_size,
         ensure_profile=ensure_profile,
-        operation_profiler=_profiler)
+        operation_profiler=_profiler,
+        span_name=span_name)
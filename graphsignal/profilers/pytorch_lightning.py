@@ -9,7 +9,7 @@ import graphsignal
 from graphsignal.proto import profiles_pb2
 from graphsignal.proto_utils import parse_semver
 from graphsignal.profilers.pytorch import PyTorchProfiler
-from graphsignal.inference_span import InferenceSpan
+from graphsignal.inference_span import start_inference_span
 
 logger = logging.getLogger('graphsignal')
 
@@ -85,7 +85,7 @@ class GraphsignalCallback(Callback):
 
     def _start_profiler(self, trainer):
         if not self._span:
-            self._span = InferenceSpan(
+            self._span = start_inference_span(
                 batch_size=self._batch_size,
                 operation_profiler=self._profiler)
 
@@ -9,7 +9,7 @@ import tensorflow as tf
 import graphsignal
 from graphsignal.proto_utils import parse_semver, compare_semver
 from graphsignal.proto import profiles_pb2
-from graphsignal.inference_span import InferenceSpan
+from graphsignal.inference_span import AnyInferenceSpan, start_inference_span
 from graphsignal.profilers.operation_profiler import OperationProfiler
 from graphsignal.profilers.profiler_utils import create_log_dir, remove_log_dir, convert_tensorflow_profile
 
@@ -95,10 +95,12 @@ _profiler = TensorflowProfiler()
 
 def profile_inference(
         batch_size: Optional[int] = None,
-        ensure_profile: Optional[bool] = False) -> InferenceSpan:
+        ensure_profile: Optional[bool] = False,
+        span_name: Optional[str] = None) -> AnyInferenceSpan:
     graphsignal._check_configured()
 
-    return InferenceSpan(
+    return start_inference_span(
         batch_size=batch_size,
         ensure_profile=ensure_profile,
-        operation_profiler=_profiler)
+        operation_profiler=_profiler,
+        span_name=span_name)
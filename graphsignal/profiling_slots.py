@@ -0,0 +1,96 @@
+import logging
+import os
+import time
+import random
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('graphsignal')
+
+
+class ProfilingSlots:
+    # Limits the number of processes on a node, or on a device, that profile
+    # at the same time. A slot is a locked file, the lock is released by the
+    # OS when the process holding it exits or crashes.
+    RETRY_INTERVAL_SEC = 1
+
+    def __init__(self, num_slots, lock_dir=None, scope='node'):
+        self.num_slots = num_slots
+        self.lock_dir = lock_dir
+        self.scope = scope
+        self.acquired_count = 0
+        self.contended_count = 0
+        self._fd = None
+        self._retry_ts = 0
+
+    def setup(self):
+        if fcntl is None:
+            raise RuntimeError('File locks are not supported on this platform')
+        if not self.lock_dir:
+            self.lock_dir = os.path.join(tempfile.gettempdir(), 'graphsignal-profiling')
+        os.makedirs(self.lock_dir, exist_ok=True)
+        logger.debug('Using %d profiling slots for %s in %s', self.num_slots, self.scope, self.lock_dir)
+
+    def reset_after_fork(self):
+        # the lock file description is shared with the parent, closing the
+        # inherited descriptor does not release the parent's slot
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._retry_ts = 0
+
+    def acquire(self):
+        if self._fd is not None:
+            return False
+
+        # do not retry locking on every span while all slots are taken
+        now = time.monotonic()
+        if now < self._retry_ts:
+            return False
+
+        # start from a random slot to spread processes across slot files
+        first_slot = random.randrange(self.num_slots)
+        for i in range(self.num_slots):
+            slot = (first_slot + i) % self.num_slots
+            lock_path = os.path.join(self.lock_dir, '{0}-{1}.lock'.format(self.scope, slot))
+            try:
+                fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+            except OSError:
+                logger.debug('Error opening profiling slot file %s', lock_path, exc_info=True)
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            self._fd = fd
+            self.acquired_count += 1
+            return True
+
+        self._retry_ts = now + self.RETRY_INTERVAL_SEC
+        self.contended_count += 1
+        return False
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+
+def device_scope(local_rank=None):
+    # physical device of the process, shared by processes using the same device
+    visible_devices = [device.strip() for device in os.environ.get('CUDA_VISIBLE_DEVICES', '').split(',') if device.strip()]
+    if len(visible_devices) == 1:
+        device = visible_devices[0]
+    elif local_rank is not None and local_rank >= 0:
+        device = visible_devices[local_rank] if local_rank < len(visible_devices) else str(local_rank)
+    else:
+        return 'node'
+    return 'device-{0}'.format(''.join(c if c.isalnum() or c == '-' else '_' for c in device))
@@ -0,0 +1,112 @@
+import unittest
+import logging
+import sys
+import os
+import signal
+import tempfile
+import shutil
+import multiprocessing
+from unittest.mock import patch
+
+import graphsignal
+from graphsignal import profile_scheduler
+from graphsignal.profile_scheduler import ProfileScheduler
+from graphsignal.profiling_slots import ProfilingSlots, device_scope
+
+logger = logging.getLogger('graphsignal')
+
+
+class ProfilingSlotsTest(unittest.TestCase):
+    def setUp(self):
+        if len(logger.handlers) == 0:
+            logger.addHandler(logging.StreamHandler(sys.stdout))
+        self.lock_dir = tempfile.mkdtemp(prefix='graphsignal-test-')
+        graphsignal.configure(
+            api_key='k1',
+            workload_name='w1',
+            profiling_slots=1,
+            profiling_lock_dir=self.lock_dir,
+            debug_mode=True)
+
+    def tearDown(self):
+        graphsignal.shutdown()
+        shutil.rmtree(self.lock_dir)
+
+    def test_acquire_release(self):
+        slots1 = ProfilingSlots(2, lock_dir=self.lock_dir)
+        slots1.setup()
+        slots2 = ProfilingSlots(2, lock_dir=self.lock_dir)
+        slots2.setup()
+        slots3 = ProfilingSlots(2, lock_dir=self.lock_dir)
+        slots3.setup()
+
+        self.assertTrue(slots1.acquire())
+        self.assertTrue(slots2.acquire())
+        self.assertFalse(slots3.acquire())
+        self.assertEqual(slots3.contended_count, 1)
+
+        slots1.release()
+        # retry is delayed after contention
+        self.assertFalse(slots3.acquire())
+        slots3._retry_ts = 0
+        self.assertTrue(slots3.acquire())
+
+        slots2.release()
+        slots3.release()
+
+    def test_scheduler(self):
+        other_process_slots = ProfilingSlots(1, lock_dir=self.lock_dir)
+        other_process_slots.setup()
+        self.assertTrue(other_process_slots.acquire())
+
+        scheduler = ProfileScheduler()
+        self.assertFalse(scheduler.lock(ensure=True))
+        # process lock is not held if no slot is available
+        self.assertFalse(profile_scheduler._profiling_lock.locked())
+
+        other_process_slots.release()
+        graphsignal._agent.profiling_slots._retry_ts = 0
+        self.assertTrue(scheduler.lock(ensure=True))
+        self.assertFalse(other_process_slots.acquire())
+        scheduler.unlock()
+        other_process_slots._retry_ts = 0
+        self.assertTrue(other_process_slots.acquire())
+        other_process_slots.release()
+
+    def test_holder_crash(self):
+        context = multiprocessing.get_context('spawn')
+        ready = context.Event()
+        holder = context.Process(target=_hold_slot, args=(self.lock_dir, ready))
+        holder.start()
+        try:
+            self.assertTrue(ready.wait(timeout=30))
+            slots = ProfilingSlots(1, lock_dir=self.lock_dir)
+            slots.setup()
+            self.assertFalse(slots.acquire())
+
+            # the slot is released when the holder is killed
+            os.kill(holder.pid, signal.SIGKILL)
+            holder.join(timeout=30)
+            slots._retry_ts = 0
+            self.assertTrue(slots.acquire())
+            slots.release()
+        finally:
+            if holder.is_alive():
+                holder.kill()
+
+    def test_device_scope(self):
+        with patch.dict(os.environ, {'CUDA_VISIBLE_DEVICES': '3'}):
+            self.assertEqual(device_scope(), 'device-3')
+        with patch.dict(os.environ, {'CUDA_VISIBLE_DEVICES': '2,3'}):
+            self.assertEqual(device_scope(local_rank=1), 'device-3')
+            self.assertEqual(device_scope(), 'node')
+        with patch.dict(os.environ, {'CUDA_VISIBLE_DEVICES': 'GPU-5b1c/0'}):
+            self.assertEqual(device_scope(), 'device-GPU-5b1c_0')
+
+
+def _hold_slot(lock_dir, ready):
+    slots = ProfilingSlots(1, lock_dir=lock_dir)
+    slots.setup()
+    slots.acquire()
+    ready.set()
+    signal.pause()
@@ -0,0 +1,158 @@
+import math
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class QuantileSketch:
+    # Logarithmically bucketed sketch (DDSketch), estimates of any quantile
+    # are within RELATIVE_ACCURACY of the true value as long as no buckets
+    # are collapsed, i.e. the value range is within MAX_BUCKETS buckets.
+    RELATIVE_ACCURACY = 0.01
+    MAX_BUCKETS = 2048
+
+    __slots__ = [
+        'relative_accuracy',
+        'count',
+        'zero_count',
+        'min',
+        'max',
+        'buckets',
+        '_gamma',
+        '_multiplier'
+    ]
+
+    def __init__(self, relative_accuracy=None):
+        if relative_accuracy is None:
+            relative_accuracy = QuantileSketch.RELATIVE_ACCURACY
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('Invalid relative_accuracy')
+        self.relative_accuracy = relative_accuracy
+        self.count = 0
+        self.zero_count = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self._gamma)
+
+    def __getstate__(self):
+        return (self.relative_accuracy, self.count, self.zero_count, self.min, self.max, self.buckets)
+
+    def __setstate__(self, state):
+        relative_accuracy, count, zero_count, min_value, max_value, buckets = state
+        self.__init__(relative_accuracy)
+        self.count = count
+        self.zero_count = zero_count
+        self.min = min_value
+        self.max = max_value
+        self.buckets = buckets
+
+    def add(self, value, count=1):
+        if self.count == 0:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += count
+
+        if value <= 0:
+            self.zero_count += count
+            return
+
+        index = math.ceil(math.log(value) * self._multiplier)
+        buckets = self.buckets
+        if index in buckets:
+            buckets[index] += count
+        else:
+            buckets[index] = count
+            if len(buckets) > QuantileSketch.MAX_BUCKETS:
+                self._collapse()
+
+    def add_many(self, values):
+        if np is None:
+            for value in values:
+                self.add(value)
+            return
+
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+
+        min_value = values.min().item()
+        max_value = values.max().item()
+        if self.count == 0:
+            self.min = min_value
+            self.max = max_value
+        else:
+            self.min = min(self.min, min_value)
+            self.max = max(self.max, max_value)
+        self.count += values.size
+
+        positive_values = values[values > 0]
+        self.zero_count += values.size - positive_values.size
+
+        indexes, counts = np.unique(
+            np.ceil(np.log(positive_values) * self._multiplier).astype(np.int64),
+            return_counts=True)
+        buckets = self.buckets
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            buckets[index] = buckets.get(index, 0) + count
+        if len(buckets) > QuantileSketch.MAX_BUCKETS:
+            self._collapse()
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different relative accuracy')
+
+        if self.count == 0:
+            self.min = other.min
+            self.max = other.max
+        else:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.count += other.count
+        self.zero_count += other.zero_count
+
+        buckets = self.buckets
+        for index, count in other.buckets.items():
+            buckets[index] = buckets.get(index, 0) + count
+        if len(buckets) > QuantileSketch.MAX_BUCKETS:
+            self._collapse()
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0
+        if q < 0 or q > 1:
+            raise ValueError('Invalid quantile')
+
+        rank = int(q * self.count)
+        if rank <= 0:
+            return self.min
+        if rank >= self.count - 1:
+            return self.max
+
+        seen_count = self.zero_count
+        if seen_count > rank:
+            return max(self.min, 0)
+        for index in sorted(self.buckets.keys()):
+            seen_count += self.buckets[index]
+            if seen_count > rank:
+                value = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def _collapse(self):
+        # merge lowest buckets to keep memory bounded, preserving tail accuracy
+        indexes = sorted(self.buckets.keys())
+        num_collapsed = len(indexes) - QuantileSketch.MAX_BUCKETS + 1
+        collapsed_count = 0
+        for index in indexes[:num_collapsed]:
+            collapsed_count += self.buckets.pop(index)
+        target_index = indexes[num_collapsed]
+        self.buckets[target_index] += collapsed_count
@@ -0,0 +1,88 @@
+import unittest
+import logging
+import sys
+import random
+import pickle
+
+from graphsignal.quantile_sketch import QuantileSketch
+
+logger = logging.getLogger('graphsignal')
+
+
+class QuantileSketchTest(unittest.TestCase):
+    def test_quantile(self):
+        sketch = QuantileSketch()
+        values = [random.expovariate(1 / 10000) + 1 for _ in range(10000)]
+        for value in values:
+            sketch.add(value)
+
+        values.sort()
+        self.assertEqual(sketch.count, 10000)
+        self.assertEqual(sketch.min, values[0])
+        self.assertEqual(sketch.max, values[-1])
+        for q in (0.5, 0.9, 0.95, 0.99, 0.999):
+            expected = values[int(q * len(values))]
+            self.assertTrue(abs(sketch.quantile(q) - expected) <= expected * sketch.relative_accuracy * 1.01)
+
+    def test_quantile_empty(self):
+        sketch = QuantileSketch()
+        self.assertEqual(sketch.quantile(0.95), 0)
+
+    def test_quantile_zeros(self):
+        sketch = QuantileSketch()
+        for value in (0, 0, 0, 10):
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertEqual(sketch.quantile(0.99), 10)
+
+    def test_add_many(self):
+        sketch1 = QuantileSketch()
+        sketch2 = QuantileSketch()
+        values = [0] + [random.randint(1, 100000) for _ in range(10000)]
+        for value in values:
+            sketch1.add(value)
+        sketch2.add_many(values)
+
+        self.assertEqual(sketch1.count, sketch2.count)
+        self.assertEqual(sketch1.zero_count, sketch2.zero_count)
+        self.assertEqual(sketch1.min, sketch2.min)
+        self.assertEqual(sketch1.max, sketch2.max)
+        self.assertEqual(sketch1.buckets, sketch2.buckets)
+
+    def test_merge(self):
+        sketch1 = QuantileSketch()
+        sketch2 = QuantileSketch()
+        merged = QuantileSketch()
+        for value in range(1, 1001):
+            sketch1.add(value)
+            merged.add(value)
+        for value in range(5000, 6001):
+            sketch2.add(value)
+            merged.add(value)
+
+        # e.g. sketch received from another process
+        sketch2 = pickle.loads(pickle.dumps(sketch2))
+
+        sketch1.merge(sketch2)
+        self.assertEqual(sketch1.count, merged.count)
+        self.assertEqual(sketch1.min, 1)
+        self.assertEqual(sketch1.max, 6000)
+        for q in (0.1, 0.5, 0.95):
+            self.assertEqual(sketch1.quantile(q), merged.quantile(q))
+
+    def test_merge_different_accuracy(self):
+        sketch1 = QuantileSketch()
+        sketch2 = QuantileSketch(relative_accuracy=0.05)
+        sketch2.add(1)
+        with self.assertRaises(ValueError):
+            sketch1.merge(sketch2)
+
+    def test_max_buckets(self):
+        sketch = QuantileSketch()
+        value = 1.0
+        for _ in range(QuantileSketch.MAX_BUCKETS * 2):
+            sketch.add(value)
+            value *= 1.05
+        self.assertTrue(len(sketch.buckets) <= QuantileSketch.MAX_BUCKETS)
+        self.assertEqual(sketch.count, QuantileSketch.MAX_BUCKETS * 2)
+        self.assertEqual(sketch.quantile(1), sketch.max)
@@ -0,0 +1,154 @@
+import logging
+import os
+import gzip
+import shutil
+import tempfile
+import multiprocessing.util
+
+import graphsignal
+
+logger = logging.getLogger('graphsignal')
+
+# Spilled trace data is replaced by a reference to the trace file. Trace data
+# is always gzip compressed, so the reference cannot be mistaken for it.
+TRACE_FILE_MARKER = b'\x00graphsignal-trace-file\x00'
+TMPFS_DIR = '/dev/shm'
+
+
+class TraceSpill:
+    MIN_TRACE_BYTES = int(1e5)
+
+    def __init__(self, spill_dir=None):
+        self.spill_dir = spill_dir
+        self.trace_dir = None
+        self.spilled_count = 0
+
+    def setup(self):
+        base_dir = self.spill_dir
+        if not base_dir:
+            # keep traces in memory-backed storage when available
+            if os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK):
+                base_dir = TMPFS_DIR
+            else:
+                base_dir = tempfile.gettempdir()
+        else:
+            os.makedirs(base_dir, exist_ok=True)
+        self.trace_dir = tempfile.mkdtemp(prefix='graphsignal-traces-', dir=base_dir)
+        logger.debug('Spilling trace data to %s', self.trace_dir)
+
+    def reset_after_fork(self):
+        # the parent removes its trace directory on shutdown, the child
+        # creates its own only if it spills traces
+        self.trace_dir = None
+        self.spilled_count = 0
+
+    def shutdown(self):
+        if self.trace_dir:
+            shutil.rmtree(self.trace_dir, ignore_errors=True)
+            self.trace_dir = None
+
+    def set_trace_data(self, profile, trace_data):
+        if len(trace_data) < self.MIN_TRACE_BYTES:
+            profile.trace_data = trace_data
+            return
+        with self._create_file(profile) as f:
+            f.write(trace_data)
+
+    def set_trace_file(self, profile, file_path, compress=True):
+        # copies the trace file without reading it into memory
+        if not compress and os.path.getsize(file_path) < self.MIN_TRACE_BYTES:
+            with open(file_path, 'rb') as f:
+                profile.trace_data = f.read()
+            return
+        with self._create_file(profile) as f:
+            with open(file_path, 'rb') as in_file:
+                if compress:
+                    with gzip.GzipFile(fileobj=f, mode='wb') as gzip_file:
+                        shutil.copyfileobj(in_file, gzip_file)
+                else:
+                    shutil.copyfileobj(in_file, f)
+
+    def _create_file(self, profile):
+        if self.trace_dir is None:
+            self.setup()
+            # forked multiprocessing workers exit without running atexit handlers
+            multiprocessing.util.Finalize(self, self.shutdown, exitpriority=0)
+        fd, trace_path = tempfile.mkstemp(suffix='.trace.gz', dir=self.trace_dir)
+        profile.trace_data = TRACE_FILE_MARKER + trace_path.encode('utf-8')
+        self.spilled_count += 1
+        return os.fdopen(fd, 'wb')
+
+
+def set_trace_data(profile, trace_data):
+    trace_spill = _trace_spill()
+    if trace_spill:
+        trace_spill.set_trace_data(profile, trace_data)
+    else:
+        profile.trace_data = trace_data
+
+
+def set_trace_file(profile, file_path, compress=True):
+    trace_spill = _trace_spill()
+    if trace_spill:
+        trace_spill.set_trace_file(profile, file_path, compress=compress)
+        return
+    with open(file_path, 'rb') as f:
+        trace_data = f.read()
+    profile.trace_data = gzip.compress(trace_data) if compress else trace_data
+
+
+def trace_file_path(profile):
+    if profile.trace_data.startswith(TRACE_FILE_MARKER):
+        return profile.trace_data[len(TRACE_FILE_MARKER):].decode('utf-8')
+    return None
+
+
+def trace_file_size(profile):
+    trace_path = trace_file_path(profile)
+    if trace_path:
+        try:
+            return os.path.getsize(trace_path)
+        except OSError:
+            pass
+    return 0
+
+
+def load_trace(profile):
+    # replaces the reference with trace data, e.g. before persisting the profile
+    trace_path = trace_file_path(profile)
+    if trace_path:
+        try:
+            with open(trace_path, 'rb') as f:
+                profile.trace_data = f.read()
+        except OSError:
+            logger.debug('Spilled trace file %s not found', trace_path)
+            profile.ClearField('trace_data')
+        _remove_file(trace_path)
+
+
+def remove_trace(profile):
+    trace_path = trace_file_path(profile)
+    if trace_path:
+        _remove_file(trace_path)
+    profile.ClearField('trace_data')
+
+
+def remove_trace_file(profile):
+    # removes the file after upload, the profile is no longer used
+    trace_path = trace_file_path(profile)
+    if trace_path:
+        _remove_file(trace_path)
+
+
+def _remove_file(trace_path):
+    try:
+        os.remove(trace_path)
+    except OSError:
+        pass
+
+
+def _trace_spill():
+    agent = graphsignal._agent
+    if agent:
+        return agent.trace_spill
+    return None
@@ -0,0 +1,159 @@
+import unittest
+import logging
+import sys
+import os
+import gzip
+import tempfile
+import shutil
+import multiprocessing
+from unittest.mock import patch
+
+import graphsignal
+from graphsignal.uploader import Uploader, _encode_upload_request
+from graphsignal.trace_spill import TraceSpill, set_trace_data, set_trace_file, trace_file_path
+from graphsignal.proto import profiles_pb2
+
+logger = logging.getLogger('graphsignal')
+
+
+class TraceSpillTest(unittest.TestCase):
+    def setUp(self):
+        if len(logger.handlers) == 0:
+            logger.addHandler(logging.StreamHandler(sys.stdout))
+        self.spill_dir = tempfile.mkdtemp(prefix='graphsignal-test-')
+        graphsignal.configure(
+            api_key='k1',
+            workload_name='w1',
+            trace_spill_dir=self.spill_dir,
+            debug_mode=True)
+        graphsignal._agent.uploader.clear()
+
+    def tearDown(self):
+        graphsignal._agent.uploader.clear()
+        graphsignal.shutdown()
+        shutil.rmtree(self.spill_dir)
+
+    def test_set_trace_data(self):
+        trace_data = os.urandom(TraceSpill.MIN_TRACE_BYTES)
+        profile = profiles_pb2.MLProfile()
+        set_trace_data(profile, trace_data)
+
+        trace_path = trace_file_path(profile)
+        self.assertTrue(trace_path.startswith(self.spill_dir))
+        with open(trace_path, 'rb') as f:
+            self.assertEqual(f.read(), trace_data)
+        self.assertTrue(profile.ByteSize() < 1000)
+
+        # small traces are kept in memory
+        small_profile = profiles_pb2.MLProfile()
+        set_trace_data(small_profile, b'123')
+        self.assertIsNone(trace_file_path(small_profile))
+        self.assertEqual(small_profile.trace_data, b'123')
+
+    def test_set_trace_file(self):
+        file_path = os.path.join(self.spill_dir, 'trace.json')
+        with open(file_path, 'w') as f:
+            f.write('{"traceEvents": []}' * 10000)
+        profile = profiles_pb2.MLProfile()
+        set_trace_file(profile, file_path)
+
+        with open(trace_file_path(profile), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), b'{"traceEvents": []}' * 10000)
+
+    def test_set_trace_file_in_memory(self):
+        graphsignal._agent.trace_spill = None
+        file_path = os.path.join(self.spill_dir, 'trace.json')
+        with open(file_path, 'w') as f:
+            f.write('{"traceEvents": []}')
+        profile = profiles_pb2.MLProfile()
+        set_trace_file(profile, file_path)
+
+        self.assertEqual(gzip.decompress(profile.trace_data), b'{"traceEvents": []}')
+
+    def test_encode_upload_request(self):
+        trace_data = os.urandom(TraceSpill.MIN_TRACE_BYTES * 3)
+        profile = profiles_pb2.MLProfile()
+        profile.workload_name = 'w1'
+        set_trace_data(profile, trace_data)
+
+        expected_profile = profiles_pb2.MLProfile()
+        expected_profile.workload_name = 'w1'
+        expected_profile.trace_data = trace_data
+        upload_request = profiles_pb2.UploadRequest()
+        upload_request.ml_profiles.append(expected_profile)
+        upload_request.upload_ms = 123
+
+        received_upload_request = profiles_pb2.UploadRequest()
+        received_upload_request.ParseFromString(b''.join(_encode_upload_request([profile], 123)))
+        self.assertEqual(received_upload_request, upload_request)
+
+    @patch.object(Uploader, '_post')
+    def test_flush(self, mocked_post):
+        received = []
+        def side_effect(endpoint, data):
+            upload_request = profiles_pb2.UploadRequest()
+            upload_request.ParseFromString(b''.join(data()))
+            received.extend(upload_request.ml_profiles)
+            return profiles_pb2.UploadResponse().SerializeToString()
+        mocked_post.side_effect = side_effect
+
+        trace_data = os.urandom(TraceSpill.MIN_TRACE_BYTES)
+        profile = profiles_pb2.MLProfile()
+        set_trace_data(profile, trace_data)
+        trace_path = trace_file_path(profile)
+        graphsignal._agent.uploader.upload_profile(profile)
+        graphsignal._agent.uploader.flush()
+
+        self.assertEqual(received[0].trace_data, trace_data)
+        self.assertFalse(os.path.exists(trace_path))
+
+    def test_flush_spool(self):
+        spool_dir = os.path.join(self.spill_dir, 'spool')
+        uploader = Uploader()
+        uploader.configure(spool_dir=spool_dir)
+
+        trace_data = os.urandom(TraceSpill.MIN_TRACE_BYTES)
+        profile = profiles_pb2.MLProfile()
+        set_trace_data(profile, trace_data)
+        trace_path = trace_file_path(profile)
+
+        # spooled profiles keep trace data
+        uploader._write_spool([profile])
+        uploader.shutdown()
+        self.assertFalse(os.path.exists(trace_path))
+        read_profiles = uploader.spool.read_segment(uploader.spool.claim_segments()[0])
+        self.assertEqual(read_profiles[0].trace_data, trace_data)
+
+    def test_shutdown(self):
+        trace_spill = graphsignal._agent.trace_spill
+        profile = profiles_pb2.MLProfile()
+        set_trace_data(profile, os.urandom(TraceSpill.MIN_TRACE_BYTES))
+        self.assertEqual(trace_spill.spilled_count, 1)
+
+        trace_spill.shutdown()
+        self.assertFalse(os.path.exists(trace_file_path(profile)))
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'fork is not supported')
+    def test_fork_pool(self):
+        trace_dir = graphsignal._agent.trace_spill.trace_dir
+        context = multiprocessing.get_context('fork')
+
+        # workers not spilling traces do not create trace directories
+        for _ in range(3):
+            with context.Pool(4) as pool:
+                pool.map(abs, range(8))
+        self.assertEqual(os.listdir(self.spill_dir), [os.path.basename(trace_dir)])
+
+        # trace directories of workers are removed when workers exit
+        with context.Pool(4) as pool:
+            child_trace_dirs = pool.map(_spill_trace, range(4))
+            pool.close()
+            pool.join()
+        self.assertTrue(all(child_trace_dir != trace_dir for child_trace_dir in child_trace_dirs))
+        self.assertEqual(os.listdir(self.spill_dir), [os.path.basename(trace_dir)])
+
+
+def _spill_trace(_):
+    profile = profiles_pb2.MLProfile()
+    set_trace_data(profile, os.urandom(TraceSpill.MIN_TRACE_BYTES))
+    return graphsignal._agent.trace_spill.trace_dir
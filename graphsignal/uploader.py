@@ -4,114 +4,785 @@ import json
 import gzip
 import sys
 import threading
+import random
 import base64
 import logging
+import zlib
 from io import BytesIO
-from urllib.request import urlopen
-from urllib.request import Request
-from urllib.parse import urlencode
+import http.client
+import socket
+from urllib.parse import urlparse, unquote
+from urllib.request import getproxies, proxy_bypass
 from urllib.error import URLError
 from urllib.error import HTTPError
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import graphsignal
 from graphsignal.proto import profiles_pb2
+from graphsignal.profile_spool import ProfileSpool, RECORD_HEADER
+from graphsignal.trace_spill import trace_file_path, trace_file_size, load_trace, remove_trace, remove_trace_file
 
 logger = logging.getLogger('graphsignal')
 
+# UploadRequest is encoded field by field, so that profiles can be
+# serialized and compressed one at a time
+_ML_PROFILES_TAG = bytes([profiles_pb2.UploadRequest.ML_PROFILES_FIELD_NUMBER << 3 | 2])
+_UPLOAD_MS_TAG = bytes([profiles_pb2.UploadRequest.UPLOAD_MS_FIELD_NUMBER << 3 | 0])
+TRACE_READ_BYTES = int(1e6)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    MIN_BACKOFF_SEC = 1
+    MAX_BACKOFF_SEC = 300
+    FAILURE_THRESHOLD = 3
+
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.retry_at = None
+
+    def allow(self):
+        return self.retry_at is None or time.monotonic() >= self.retry_at
+
+    def retry_in_sec(self):
+        if self.retry_at is None:
+            return 0
+        return max(self.retry_at - time.monotonic(), 0)
+
+    def state(self):
+        if self.consecutive_failures < self.FAILURE_THRESHOLD:
+            return CircuitBreaker.CLOSED
+        if self.allow():
+            return CircuitBreaker.HALF_OPEN
+        return CircuitBreaker.OPEN
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.retry_at = None
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures < self.FAILURE_THRESHOLD:
+            # occasional failures are retried on the next flush
+            return
+        # exponential backoff with jitter to avoid synchronized retries
+        backoff_sec = min(
+            self.MIN_BACKOFF_SEC * 2 ** (self.consecutive_failures - self.FAILURE_THRESHOLD),
+            self.MAX_BACKOFF_SEC)
+        self.retry_at = time.monotonic() + random.uniform(backoff_sec / 2, backoff_sec)
+
 
 class Uploader:
     MAX_BUFFER_SIZE = 2500
+    MAX_BUFFER_BYTES = int(100 * 1e6)
+    AUTO_FLUSH_INTERVAL_SEC = 60
+    UPLOAD_TIMEOUT_SEC = 10
+    MAX_UPLOAD_BYTES = int(10 * 1e6)
+    COMPRESSION_CODEC = 'gzip'
+    COMPRESSION_LEVEL = 6
 
     def __init__(self):
         self.profile_api_url = 'https://profile-api.graphsignal.com'
         self.buffer = []
+        self.buffer_bytes = 0
         self.buffer_lock = threading.Lock()
         self.flush_lock = threading.Lock()
+        self.spool = None
+        self.circuit_breaker = CircuitBreaker()
+        self._connection_pool = None
+        self._connection_pool_lock = threading.Lock()
+        self.collector_client = None
+        self.dropped_count = 0
+        self.stripped_count = 0
+        self.coalesced_count = 0
+        self.failed_count = 0
+        self.short_circuited_count = 0
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.compression_time_sec = 0
+        self.last_upload_stats = None
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._worker_stopped = False
+        self._flush_requested = threading.Event()
 
-    def configure(self):
+    def configure(self, spool_dir=None, collector_socket=None):
         if 'GRAPHSIGNAL_PROFILE_API_URL' in os.environ:
             self.profile_api_url = os.environ['GRAPHSIGNAL_PROFILE_API_URL']
 
+        if collector_socket:
+            # profiles are uploaded by the node collector
+            self.collector_client = CollectorClient(collector_socket, timeout=self.UPLOAD_TIMEOUT_SEC)
+
+        if spool_dir:
+            try:
+                self.spool = ProfileSpool(spool_dir)
+                self.spool.setup()
+            except Exception:
+                logger.error('Error setting up profile spool at %s', spool_dir, exc_info=True)
+                self.spool = None
+
+        if self.AUTO_FLUSH_INTERVAL_SEC:
+            self._ensure_worker()
+
+        # replay profiles spooled before restart
+        if self.spool and self.spool.has_segments():
+            self.flush_in_thread()
+
+    def set_flush_interval(self, interval_sec):
+        self.AUTO_FLUSH_INTERVAL_SEC = interval_sec
+        if self._worker:
+            # the worker is waiting with the previous interval
+            self._flush_requested.set()
+        elif interval_sec:
+            self._ensure_worker()
+
     def clear(self):
         with self.buffer_lock:
+            for profile in self.buffer:
+                remove_trace_file(profile)
             self.buffer = []
+            self.buffer_bytes = 0
+
+    def shutdown(self):
+        with self._worker_lock:
+            self._worker_stopped = True
+            worker = self._worker
+            self._worker = None
+        if worker:
+            self._flush_requested.set()
+            worker.join(timeout=10)
+        queue_depth = self.queue_depth()
+        if queue_depth > 0:
+            logger.warning('Dropping %d profiles that could not be uploaded', queue_depth)
+        with self._connection_pool_lock:
+            if self._connection_pool:
+                self._connection_pool.close()
+                self._connection_pool = None
+        if self.collector_client:
+            self.collector_client.close()
+
+    def reset_after_fork(self):
+        # locks may have been held and threads do not exist in the child,
+        # buffered profiles are uploaded by the parent
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self._connection_pool = None
+        self._connection_pool_lock = threading.Lock()
+        if self.collector_client:
+            self.collector_client = CollectorClient(
+                self.collector_client.socket_path, timeout=self.collector_client.timeout)
+        self.dropped_count = 0
+        self.stripped_count = 0
+        self.coalesced_count = 0
+        self.failed_count = 0
+        self.short_circuited_count = 0
+        # the worker is started on first use
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._flush_requested = threading.Event()
 
     def upload_profile(self, profile):
+        profile_bytes = profile.ByteSize()
         with self.buffer_lock:
             self.buffer.append(profile)
-            if len(self.buffer) > self.MAX_BUFFER_SIZE:
-                self.buffer = self.buffer[-self.MAX_BUFFER_SIZE:]
+            self.buffer_bytes += profile_bytes
+            self._evict()
+
+    def _evict(self):
+        if len(self.buffer) > self.MAX_BUFFER_SIZE:
+            for profile in self.buffer[:-self.MAX_BUFFER_SIZE]:
+                self.buffer_bytes -= profile.ByteSize()
+                remove_trace_file(profile)
+            self.dropped_count += len(self.buffer) - self.MAX_BUFFER_SIZE
+            del self.buffer[:-self.MAX_BUFFER_SIZE]
+        if self.MAX_BUFFER_BYTES and self.buffer_bytes > self.MAX_BUFFER_BYTES:
+            self.buffer_bytes, stripped_count, dropped_count = evict_profiles(
+                self.buffer, self.buffer_bytes, self.MAX_BUFFER_BYTES)
+            self.stripped_count += stripped_count
+            self.dropped_count += dropped_count
+
+    def _take_buffer(self):
+        with self.buffer_lock:
+            outgoing = self.buffer
+            self.buffer = []
+            self.buffer_bytes = 0
+        return outgoing
+
+    def _restore_buffer(self, profiles):
+        profiles_bytes = sum(profile.ByteSize() for profile in profiles)
+        with self.buffer_lock:
+            self.buffer[:0] = profiles
+            self.buffer_bytes += profiles_bytes
+            self._evict()
 
     def flush_in_thread(self):
-        threading.Thread(target=self.flush).start()
+        # requests arriving while a flush is pending are served by that flush
+        if self._flush_requested.is_set():
+            self.coalesced_count += 1
+        self._flush_requested.set()
+        self._ensure_worker()
 
-    def flush(self):
-        with self.flush_lock:
-            with self.buffer_lock:
-                if len(self.buffer) == 0:
-                    return
-                outgoing = self.buffer
-                self.buffer = []
+    def start_auto_flush(self):
+        if self.AUTO_FLUSH_INTERVAL_SEC and not self._worker:
+            self._ensure_worker()
+
+    def queue_depth(self):
+        with self.buffer_lock:
+            return len(self.buffer)
+
+    def get_metrics(self):
+        return dict(
+            queue_depth=self.queue_depth(),
+            buffer_bytes=self.buffer_bytes,
+            run_buffer_bytes=self._run_buffer_bytes(),
+            dropped_count=self.dropped_count,
+            stripped_count=self.stripped_count,
+            coalesced_count=self.coalesced_count,
+            spool_bytes=self.spool.size() if self.spool else 0,
+            failed_count=self.failed_count,
+            short_circuited_count=self.short_circuited_count,
+            circuit_state=self.circuit_breaker.state(),
+            consecutive_failures=self.circuit_breaker.consecutive_failures,
+            retry_in_sec=self.circuit_breaker.retry_in_sec(),
+            uncompressed_bytes=self.uncompressed_bytes,
+            compressed_bytes=self.compressed_bytes,
+            compression_time_sec=self.compression_time_sec)
+
+    def _ensure_worker(self):
+        if self._worker:
+            return
+        with self._worker_lock:
+            if self._worker or self._worker_stopped:
+                return
+            self._worker = threading.Thread(target=self._run_worker, name='graphsignal-uploader')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _run_worker(self):
+        while True:
+            # flush when requested or periodically
+            self._flush_requested.wait(timeout=self._next_flush_timeout())
+            self._flush_requested.clear()
+            if self._worker_stopped:
+                return
             try:
-                upload_start = time.time()
-                upload_request = profiles_pb2.UploadRequest()
-                upload_request.ml_profiles.extend(outgoing)
-                upload_request.upload_ms = int(time.time() * 1e3)
-                payload = upload_request.SerializeToString()
-                resp = self._post('profiles', payload)
+                self._collect_profiles()
+                self.flush()
+            except Exception:
+                logger.error('Error in upload worker', exc_info=True)
+
+    def _next_flush_timeout(self):
+        timeout = self.AUTO_FLUSH_INTERVAL_SEC or None
+        # retry pending profiles when backoff ends
+        if self.circuit_breaker.retry_at is not None and self.queue_depth() > 0:
+            retry_in_sec = self.circuit_breaker.retry_in_sec()
+            if timeout is None or retry_in_sec < timeout:
+                timeout = retry_in_sec
+        return timeout
+
+    def _run_buffer_bytes(self):
+        agent = graphsignal._agent
+        if agent and agent.uploader is self and agent.current_run:
+            return agent.current_run.profiles_bytes
+        return 0
+
+    def _collect_profiles(self):
+        agent = graphsignal._agent
+        if agent and agent.uploader is self and agent.current_run:
+            agent.current_run.collect_profiles()
+
+    def flush(self, force=False):
+        # forced flushes, e.g. at shutdown, are attempted even during backoff
+        with self.flush_lock:
+            if not force and not self.circuit_breaker.allow():
+                # endpoint is failing, keep profiles until backoff ends
+                self.short_circuited_count += 1
+                logger.debug('Skipping upload, retrying in %.1f sec', self.circuit_breaker.retry_in_sec())
+                if self.spool:
+                    outgoing = self._take_buffer()
+                    if len(outgoing) > 0:
+                        self._write_spool(outgoing)
+                return
+
+            outgoing = self._take_buffer()
+            unsent = self._upload_batches(outgoing)
+            if len(unsent) > 0:
+                if self.spool:
+                    self._write_spool(unsent)
+                else:
+                    self._restore_buffer(unsent)
+                return
+
+            if self.spool:
+                self._replay_spool()
+
+    def _upload_batches(self, profiles):
+        # uploads profiles in requests of limited size and returns the ones
+        # not accepted, accepted requests are not resent on retries
+        batches = _split_batches(profiles, self.MAX_UPLOAD_BYTES)
+        for idx, batch in enumerate(batches):
+            if not self._upload(batch):
+                return [profile for unsent_batch in batches[idx:] for profile in unsent_batch]
+            for profile in batch:
+                remove_trace_file(profile)
+        return []
+
+    def _upload(self, profiles):
+        cpu_start_sec = time.thread_time()
+        try:
+            upload_start = time.time()
+            if self.collector_client:
+                self.collector_client.send(profiles)
+            else:
+                upload_ms = int(upload_start * 1e3)
+                resp = self._post('profiles', lambda: _encode_upload_request(profiles, upload_ms))
                 upload_response = profiles_pb2.UploadResponse()
                 upload_response.ParseFromString(resp)
-                logger.debug('Upload took %.3f sec (%dB)', time.time() - upload_start, len(payload))
-            except URLError:
-                logger.debug('Failed uploading profiles, will retry', exc_info=True)
-                with self.buffer_lock:
-                    self.buffer[:0] = outgoing
+            logger.debug('Upload took %.3f sec', time.time() - upload_start)
+        except HTTPError as herr:
+            if herr.code >= 500 or herr.code == 429:
+                self._record_failure()
+                return False
+            # rejected requests would be rejected again
+            self.dropped_count += len(profiles)
+            logger.error('Upload rejected with HTTP status %d, dropping %d profiles', herr.code, len(profiles))
+        except (URLError, OSError):
+            # connection errors and timeouts
+            self._record_failure()
+            return False
+        except Exception:
+            logger.error('Error uploading profiles', exc_info=True)
+        finally:
+            self._record_overhead(time.thread_time() - cpu_start_sec)
+        self.circuit_breaker.record_success()
+        return True
+
+    def _record_failure(self):
+        self.failed_count += 1
+        self.circuit_breaker.record_failure()
+        logger.debug('Failed uploading profiles, will retry in %.1f sec',
+            self.circuit_breaker.retry_in_sec(), exc_info=True)
+
+    def _record_overhead(self, cpu_sec):
+        # upload CPU counts towards profiling overhead of the current run
+        agent = graphsignal._agent
+        if agent and agent.uploader is self and agent.current_run:
+            agent.current_run.record_overhead(cpu_sec)
+
+    def _write_spool(self, profiles):
+        try:
+            # spilled trace files do not outlive the process
+            for profile in profiles:
+                load_trace(profile)
+            self.spool.write(profiles)
+            logger.debug('Spooled %d profiles to %s', len(profiles), self.spool.spool_dir)
+        except Exception:
+            logger.error('Error writing profiles to spool, keeping them in memory', exc_info=True)
+            self._restore_buffer(profiles)
+
+    def _replay_spool(self):
+        try:
+            claimed_paths = self.spool.claim_segments()
+        except Exception:
+            logger.error('Error reading spool', exc_info=True)
+            return
+
+        for idx, claimed_path in enumerate(claimed_paths):
+            try:
+                profiles = self.spool.read_segment(claimed_path)
             except Exception:
-                logger.error('Error uploading profiles', exc_info=True)
+                logger.error('Error reading spool segment %s', claimed_path, exc_info=True)
+                self.spool.remove_segment(claimed_path)
+                continue
+
+            unsent = self._upload_batches(profiles)
+            if len(unsent) > 0:
+                if len(unsent) < len(profiles):
+                    # keep only the part of the segment that was not accepted
+                    self._write_spool(unsent)
+                    self.spool.remove_segment(claimed_path)
+                    idx += 1
+                for unsent_path in claimed_paths[idx:]:
+                    self.spool.release_segment(unsent_path)
+                return
+
+            self.spool.remove_segment(claimed_path)
+            logger.debug('Uploaded %d spooled profiles', len(profiles))
 
     def _post(self, endpoint, data):
+        # data is either the payload or a function returning payload chunks,
+        # which are compressed on the fly and sent as a chunked request body
         logger.debug('Posting data to %s/%s',
                      self.profile_api_url, endpoint)
 
+        compressor = self._create_compressor()
+
         api_key_64 = _base64_encode(
             graphsignal._agent.api_key + ':').replace('\n', '')
         headers = {
             'Accept-Encoding': 'gzip',
             'Authorization': "Basic %s" % api_key_64,
             'Content-Type': 'application/octet-stream',
-            'Content-Encoding': 'gzip'
+            'Content-Encoding': compressor.codec
         }
 
-        gzip_out = BytesIO()
-        with gzip.GzipFile(fileobj=gzip_out, mode="w") as out_file:
-            out_file.write(data)
-            out_file.close()
-
-        gzip_out_val = gzip_out.getvalue()
-        if isinstance(gzip_out_val, str):
-            data_gzip = bytearray(gzip_out.getvalue())
+        if callable(data):
+            body = lambda: compressor.compress(data())
         else:
-            data_gzip = gzip_out.getvalue()
-        request = Request(
-            url=self.profile_api_url + '/' + endpoint,
-            data=data_gzip,
-            headers=headers)
-
+            body = b''.join(compressor.compress([data]))
         try:
-            resp = urlopen(request, timeout=10)
-            result_data = resp.read()
-            if resp.info():
-                content_type = resp.info().get('Content-Encoding')
-                if content_type == 'gzip':
-                    result_data = gzip.GzipFile(
-                        '', 'r', 0, BytesIO(result_data)).read()
-            resp.close()
+            status, reason, resp_headers, result_data = self._get_connection_pool().request(
+                'POST', endpoint, body, headers)
+            self._record_compression(compressor)
+            if status >= 400:
+                raise HTTPError(
+                    self.profile_api_url + '/' + endpoint, status, reason, resp_headers, BytesIO(result_data))
+            content_type = resp_headers.get('Content-Encoding')
+            if content_type == 'gzip':
+                result_data = gzip.GzipFile(
+                    '', 'r', 0, BytesIO(result_data)).read()
             return result_data
         except HTTPError as herr:
             logger.debug('Error message from server: %s',
                          herr.read().decode('utf-8'))
             raise herr
 
+    def _create_compressor(self):
+        codec = self.COMPRESSION_CODEC
+        level = self.COMPRESSION_LEVEL
+        if codec == 'zstd' and zstandard is None:
+            logger.debug('zstandard is not installed, using gzip compression')
+            codec = 'gzip'
+        if codec == 'gzip':
+            level = min(max(level, 1), 9)
+        return PayloadCompressor(codec, level)
+
+    def _record_compression(self, compressor):
+        self.uncompressed_bytes += compressor.bytes_in
+        self.compressed_bytes += compressor.bytes_out
+        self.compression_time_sec += compressor.compression_ns / 1e9
+        self.last_upload_stats = dict(
+            codec=compressor.codec,
+            level=compressor.level,
+            bytes_in=compressor.bytes_in,
+            bytes_out=compressor.bytes_out,
+            compression_time_sec=compressor.compression_ns / 1e9)
+        logger.debug('Compressed upload with %s level %d: %dB -> %dB in %.3f sec',
+            compressor.codec, compressor.level, compressor.bytes_in, compressor.bytes_out,
+            compressor.compression_ns / 1e9)
+
+    def _get_connection_pool(self):
+        with self._connection_pool_lock:
+            if self._connection_pool is None or self._connection_pool.base_url != self.profile_api_url:
+                if self._connection_pool:
+                    self._connection_pool.close()
+                self._connection_pool = ConnectionPool(self.profile_api_url, timeout=self.UPLOAD_TIMEOUT_SEC)
+            self._connection_pool.timeout = self.UPLOAD_TIMEOUT_SEC
+            return self._connection_pool
+
+
+class PayloadCompressor:
+    def __init__(self, codec, level):
+        if codec not in ('gzip', 'zstd'):
+            raise ValueError('Unsupported compression codec: {0}'.format(codec))
+        self.codec = codec
+        self.level = level
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compression_ns = 0
+
+    def compress(self, chunks):
+        # counters are reset, the body may be regenerated on request retries
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compression_ns = 0
+
+        compressor = self._create_compressobj()
+        for chunk in chunks:
+            self.bytes_in += len(chunk)
+            start_ns = time.perf_counter_ns()
+            out = compressor.compress(chunk)
+            self.compression_ns += time.perf_counter_ns() - start_ns
+            if out:
+                self.bytes_out += len(out)
+                yield out
+        start_ns = time.perf_counter_ns()
+        out = compressor.flush()
+        self.compression_ns += time.perf_counter_ns() - start_ns
+        self.bytes_out += len(out)
+        yield out
+
+    def _create_compressobj(self):
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level).compressobj()
+        # gzip container
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class ConnectionPool:
+    # Keeps the connection to the API open between uploads. Uploads are
+    # serialized by the flush lock, so one idle connection is enough.
+    def __init__(self, base_url, timeout=None):
+        url = urlparse(base_url)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL scheme: {0}'.format(base_url))
+        self.base_url = base_url
+        self.timeout = timeout
+        self._is_https = url.scheme == 'https'
+        self._host = url.hostname
+        self._port = url.port
+        self._base_path = url.path.rstrip('/')
+        self._origin = '{0}://{1}'.format(url.scheme, url.netloc)
+        self._proxy = _find_proxy(url)
+        self._proxy_headers = {}
+        if self._proxy and self._proxy.username:
+            credentials = '{0}:{1}'.format(unquote(self._proxy.username), unquote(self._proxy.password or ''))
+            self._proxy_headers['Proxy-Authorization'] = 'Basic %s' % _base64_encode(credentials)
+        self._idle = None
+        self._lock = threading.Lock()
+        self.created_count = 0
+        self.reused_count = 0
+
+    def request(self, method, endpoint, body, headers):
+        # body is bytes or a function returning an iterable, which is sent chunked
+        path = self._base_path + '/' + endpoint
+        if self._proxy and not self._is_https:
+            # plain HTTP requests are forwarded by the proxy
+            path = self._origin + path
+            headers = dict(headers, **self._proxy_headers)
+        conn, is_reused = self._acquire()
+        try:
+            try:
+                conn.request(method, path, body=_make_body(body), headers=headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not is_reused:
+                    raise
+                # idle keep-alive connection was closed by the server, retry on a new one
+                conn, _ = self._acquire(reuse=False)
+                conn.request(method, path, body=_make_body(body), headers=headers)
+                resp = conn.getresponse()
+            data = resp.read()
+        except http.client.HTTPException as exc:
+            conn.close()
+            raise URLError(exc)
+        except BaseException:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return resp.status, resp.reason, resp.headers, data
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = None
+        if idle:
+            idle.close()
+
+    def _acquire(self, reuse=True):
+        if reuse:
+            with self._lock:
+                if self._idle:
+                    self.reused_count += 1
+                    conn = self._idle
+                    self._idle = None
+                    return conn, True
+        self.created_count += 1
+        if self._proxy:
+            host, port = self._proxy.hostname, self._proxy.port
+        else:
+            host, port = self._host, self._port
+        if self._is_https:
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+            if self._proxy:
+                # TLS connection to the API through a CONNECT tunnel
+                conn.set_tunnel(self._host, self._port, headers=self._proxy_headers)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _release(self, conn):
+        with self._lock:
+            if self._idle is None:
+                self._idle = conn
+                return
+        conn.close()
+
+
+class CollectorClient:
+    # Profiles are sent to the collector as length-prefixed records. A batch
+    # ends with an empty record, which the collector acknowledges after
+    # accepting the batch.
+    ACK = b'\x01'
+
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._sock = None
+
+    def send(self, profiles):
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._sock = sock
+
+        try:
+            for profile in profiles:
+                # spilled trace files are not shared with the collector
+                load_trace(profile)
+                data = profile.SerializeToString()
+                self._sock.sendall(RECORD_HEADER.pack(len(data)))
+                self._sock.sendall(data)
+            self._sock.sendall(RECORD_HEADER.pack(0))
+            if self._sock.recv(1) != CollectorClient.ACK:
+                raise ConnectionError('Batch not acknowledged by collector')
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def _find_proxy(url):
+    # same HTTP_PROXY, HTTPS_PROXY and NO_PROXY handling as urllib
+    proxy = getproxies().get(url.scheme)
+    if not proxy or proxy_bypass(url.hostname):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    proxy_url = urlparse(proxy)
+    if proxy_url.scheme != 'http' or not proxy_url.hostname:
+        logger.debug('Unsupported proxy %s, connecting directly', proxy)
+        return None
+    return proxy_url
+
+
+def _make_body(body):
+    if callable(body):
+        return body()
+    return body
+
+
+def evict_profiles(profiles, profiles_bytes, max_bytes):
+    # Reduces buffered profiles in place to max_bytes, oldest first. Trace data
+    # is stripped before whole profiles are dropped. Returns the remaining
+    # bytes and the number of stripped and dropped profiles.
+    stripped_count = 0
+    for profile in profiles:
+        if profiles_bytes <= max_bytes:
+            break
+        if profile.trace_data and not trace_file_path(profile):
+            profile_bytes = profile.ByteSize()
+            remove_trace(profile)
+            profiles_bytes -= profile_bytes - profile.ByteSize()
+            stripped_count += 1
+
+    dropped_count = 0
+    while profiles_bytes > max_bytes and dropped_count < len(profiles):
+        profiles_bytes -= profiles[dropped_count].ByteSize()
+        remove_trace_file(profiles[dropped_count])
+        dropped_count += 1
+    del profiles[:dropped_count]
+
+    if stripped_count > 0 or dropped_count > 0:
+        logger.debug('Profile buffer over %d bytes, stripped trace data from %d and dropped %d profiles',
+            max_bytes, stripped_count, dropped_count)
+
+    return profiles_bytes, stripped_count, dropped_count
+
+
+def _split_batches(profiles, max_bytes):
+    # profiles larger than max_bytes are sent in a request of their own
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for profile in profiles:
+        profile_bytes = profile.ByteSize() + trace_file_size(profile)
+        if batch and batch_bytes + profile_bytes > max_bytes:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(profile)
+        batch_bytes += profile_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _encode_upload_request(profiles, upload_ms):
+    for profile in profiles:
+        trace_path = trace_file_path(profile)
+        if trace_path:
+            yield from _encode_spilled_profile(profile, trace_path)
+            continue
+        data = profile.SerializeToString()
+        yield _ML_PROFILES_TAG + _encode_varint(len(data))
+        yield data
+    yield _UPLOAD_MS_TAG + _encode_varint(upload_ms)
+
+
+def _encode_spilled_profile(profile, trace_path):
+    # trace data is read from the file and appended to the serialized profile
+    profile_copy = profiles_pb2.MLProfile()
+    profile_copy.CopyFrom(profile)
+    profile_copy.ClearField('trace_data')
+    data = profile_copy.SerializeToString()
+
+    try:
+        trace_file = open(trace_path, 'rb')
+    except OSError:
+        logger.debug('Spilled trace file %s not found', trace_path)
+        yield _ML_PROFILES_TAG + _encode_varint(len(data))
+        yield data
+        return
+
+    with trace_file:
+        trace_size = os.fstat(trace_file.fileno()).st_size
+        trace_header = (
+            _encode_varint(profiles_pb2.MLProfile.TRACE_DATA_FIELD_NUMBER << 3 | 2) +
+            _encode_varint(trace_size))
+        yield _ML_PROFILES_TAG + _encode_varint(len(data) + len(trace_header) + trace_size)
+        yield data
+        yield trace_header
+        read_size = 0
+        while read_size < trace_size:
+            chunk = trace_file.read(min(TRACE_READ_BYTES, trace_size - read_size))
+            if not chunk:
+                raise Exception('Spilled trace file {0} truncated'.format(trace_path))
+            read_size += len(chunk)
+            yield chunk
+
+
+def _encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
 
 def _base64_encode(s):
     return base64.b64encode(s.encode('utf-8')).decode('utf-8')
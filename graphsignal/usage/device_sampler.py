@@ -0,0 +1,156 @@
+import logging
+import time
+import math
+import threading
+
+import graphsignal
+from graphsignal.usage.process_sampler import RingBuffer
+from graphsignal.usage.pynvml import *
+
+logger = logging.getLogger('graphsignal')
+
+
+class DeviceSampler:
+    # Samples GPU counters in the background, so that profiles get device
+    # usage statistics of exactly the profiled span.
+    SAMPLE_INTERVAL_SEC = 0.1
+    BUFFER_SIZE = 3000
+    SAMPLED_METRICS = [
+        'gpu_utilization_percent',
+        'mem_used',
+        'power_usage_w',
+        'sm_clock_mhz',
+        'pcie_throughput_tx',
+        'pcie_throughput_rx']
+
+    def __init__(self, devices, clock=None):
+        self.sample_count = 0
+        self.cpu_time_sec = 0
+        self._devices = devices
+        self._clock = clock if clock is not None else _timestamp_us
+        self._buffers = {device.index: RingBuffer(self.BUFFER_SIZE, self.SAMPLED_METRICS) for device in devices}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='graphsignal-device-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        has_failed = False
+        while not self._stop_event.wait(self.SAMPLE_INTERVAL_SEC):
+            cpu_start_sec = time.thread_time()
+            try:
+                self.sample()
+            except Exception:
+                # errors are logged once, sampling continues
+                if not has_failed:
+                    has_failed = True
+                    logger.error('Error sampling device usage', exc_info=True)
+            self.cpu_time_sec += time.thread_time() - cpu_start_sec
+
+    def sample(self):
+        for device in self._devices:
+            values = _read_device(device)
+            timestamp_us = self._clock()
+            with self._lock:
+                self._buffers[device.index].append(timestamp_us, values)
+        self.sample_count += 1
+
+    def read(self, profile, device, device_usage):
+        if profile.end_us <= 0:
+            return
+
+        with self._lock:
+            buffer = self._buffers[device.index]
+            window = buffer.window(profile.start_us, profile.end_us)
+            # spans shorter than the interval get the last sample before the span
+            if len(window[self.SAMPLED_METRICS[0]]) == 0:
+                window = buffer.window(profile.start_us - self.SAMPLE_INTERVAL_SEC * 1e6, profile.end_us)
+
+        for name, values in window.items():
+            values = [value for value in values if not math.isnan(value)]
+            if len(values) == 0:
+                continue
+            avg_value = sum(values) / len(values)
+            _add_metric(profile, 'device_{0}_{1}_min'.format(device.index, name), min(values))
+            _add_metric(profile, 'device_{0}_{1}_avg'.format(device.index, name), avg_value)
+            _add_metric(profile, 'device_{0}_{1}_max'.format(device.index, name), max(values))
+
+            # span averages replace values read at span stop
+            if name == 'gpu_utilization_percent':
+                device_usage.gpu_utilization_percent = avg_value
+            elif name == 'power_usage_w':
+                device_usage.power_usage_w = avg_value
+
+
+def _read_device(device):
+    handle = device.handle
+    unsupported = device.unsupported
+    values = [math.nan] * len(DeviceSampler.SAMPLED_METRICS)
+
+    if 'utilization' not in unsupported:
+        try:
+            values[0] = nvmlDeviceGetUtilizationRates(handle).gpu
+        except NVMLError as err:
+            _handle_sample_error(err, device, 'utilization')
+
+    if 'mem' not in unsupported:
+        try:
+            values[1] = nvmlDeviceGetMemoryInfo(handle).used
+        except NVMLError as err:
+            _handle_sample_error(err, device, 'mem')
+
+    if 'power' not in unsupported:
+        try:
+            values[2] = nvmlDeviceGetPowerUsage(handle) / 1000.0
+        except NVMLError as err:
+            _handle_sample_error(err, device, 'power')
+
+    if 'clock' not in unsupported:
+        try:
+            values[3] = nvmlDeviceGetClockInfo(handle, NVML_CLOCK_SM)
+        except NVMLError as err:
+            _handle_sample_error(err, device, 'clock')
+
+    if 'pcie' not in unsupported:
+        try:
+            values[4] = nvmlDeviceGetPcieThroughput(handle, NVML_PCIE_UTIL_TX_BYTES)
+            values[5] = nvmlDeviceGetPcieThroughput(handle, NVML_PCIE_UTIL_RX_BYTES)
+        except NVMLError as err:
+            _handle_sample_error(err, device, 'pcie')
+
+    return values
+
+
+def _handle_sample_error(err, device, counter):
+    # errors are logged once, the sampler runs every interval
+    if err.value == NVML_ERROR_NOT_SUPPORTED:
+        device.unsupported.add(counter)
+        logger.debug('NVML call not supported: %s', counter)
+    elif counter not in device.failed:
+        device.failed.add(counter)
+        logger.error('Error sampling NVML counter: %s', counter, exc_info=True)
+
+
+def _timestamp_us():
+    # same clock as profile start and end timestamps
+    agent = graphsignal._agent
+    if agent and agent.current_run:
+        return agent.current_run.timestamp_us(time.perf_counter_ns())
+    return time.time_ns() // 1000
+
+
+def _add_metric(profile, name, value):
+    metric = profile.metrics.add()
+    metric.name = name
+    metric.value = value
@@ -0,0 +1,120 @@
+import unittest
+import logging
+import sys
+import time
+from unittest.mock import patch
+
+import graphsignal
+from graphsignal.usage.device_sampler import DeviceSampler
+from graphsignal.usage.nvml_reader import NvmlReader
+from graphsignal.usage.fake_nvml_test import FakeNvml
+from graphsignal.proto import profiles_pb2
+
+logger = logging.getLogger('graphsignal')
+
+
+class DeviceSamplerTest(unittest.TestCase):
+    def setUp(self):
+        if len(logger.handlers) == 0:
+            logger.addHandler(logging.StreamHandler(sys.stdout))
+        graphsignal.configure(
+            api_key='k1',
+            workload_name='w1',
+            debug_mode=True)
+
+    def tearDown(self):
+        graphsignal.shutdown()
+
+    def test_span_window(self):
+        fake_nvml = FakeNvml(num_devices=2)
+        with fake_nvml.patch():
+            reader = NvmlReader()
+            reader.setup()
+
+            now_us = 0
+            sampler = DeviceSampler(reader._devices, clock=lambda: now_us)
+            for i in range(50):
+                now_us = (i + 1) * int(DeviceSampler.SAMPLE_INTERVAL_SEC * 1e6)
+                # device is busy between 2s and 3s
+                fake_nvml.gpu_utilization = 100 if 20 <= i < 30 else 0
+                fake_nvml.power_usage_w = 300 if 20 <= i < 30 else 100
+                sampler.sample()
+            reader._sampler = sampler
+
+            profile = profiles_pb2.MLProfile()
+            profile.start_us = 2100000
+            profile.end_us = 3000000
+            reader.read(profile)
+            reader.shutdown()
+
+        metrics = {metric.name: metric.value for metric in profile.metrics}
+        self.assertEqual(metrics['device_0_gpu_utilization_percent_min'], 100)
+        self.assertEqual(metrics['device_1_gpu_utilization_percent_avg'], 100)
+        self.assertEqual(metrics['device_0_power_usage_w_max'], 300)
+        self.assertEqual(metrics['device_0_sm_clock_mhz_avg'], 1400)
+        self.assertEqual(metrics['device_0_mem_used_avg'], 40)
+        self.assertEqual(metrics['device_0_pcie_throughput_tx_avg'], 1000)
+        # span averages instead of the last 10 seconds
+        self.assertEqual(profile.device_usage[0].gpu_utilization_percent, 100)
+        self.assertEqual(profile.device_usage[0].power_usage_w, 300)
+
+    def test_sampler_thread(self):
+        fake_nvml = FakeNvml(num_devices=1)
+        with fake_nvml.patch():
+            reader = NvmlReader(sample_usage=True)
+            reader.setup()
+            try:
+                profile = profiles_pb2.MLProfile()
+                profile.start_us = graphsignal.current_run().timestamp_us(time.perf_counter_ns())
+                time.sleep(DeviceSampler.SAMPLE_INTERVAL_SEC * 3)
+                profile.end_us = graphsignal.current_run().timestamp_us(time.perf_counter_ns())
+                reader.read(profile)
+                sampler = reader._sampler
+            finally:
+                reader.shutdown()
+
+        self.assertTrue(sampler.sample_count >= 2)
+        logger.debug('Device sampler: %.1f us CPU per sample', sampler.cpu_time_sec / sampler.sample_count * 1e6)
+        metrics = {metric.name: metric.value for metric in profile.metrics}
+        self.assertEqual(metrics['device_0_gpu_utilization_percent_avg'], 50)
+        self.assertIsNone(reader._sampler)
+
+    def test_unsupported(self):
+        fake_nvml = FakeNvml(num_devices=1)
+        fake_nvml.nvmlDeviceGetClockInfo = lambda handle, clock_type: fake_nvml.nvmlDeviceGetFanSpeed(handle)
+        with fake_nvml.patch():
+            reader = NvmlReader()
+            reader.setup()
+            devices = reader._devices
+            sampler = DeviceSampler(devices, clock=lambda: 1)
+            sampler.sample()
+            sampler.sample()
+            reader.shutdown()
+
+        # unsupported counters are not sampled again
+        self.assertEqual(fake_nvml.calls['nvmlDeviceGetClockInfo'], 1)
+        self.assertEqual(fake_nvml.calls['nvmlDeviceGetUtilizationRates'], 2)
+        self.assertIn('clock', devices[0].unsupported)
+
+    def test_sample_error(self):
+        calls = []
+        def clock():
+            calls.append(None)
+            if len(calls) <= 3:
+                raise Exception('Ex1')
+            return len(calls)
+
+        fake_nvml = FakeNvml(num_devices=1)
+        with fake_nvml.patch(), patch.object(logger, 'error') as mocked_error:
+            reader = NvmlReader()
+            reader.setup()
+            sampler = DeviceSampler(reader._devices, clock=clock)
+            sampler.SAMPLE_INTERVAL_SEC = 0.005
+            sampler.start()
+            time.sleep(0.2)
+            sampler.stop()
+            reader.shutdown()
+
+        # sampling continues after errors, which are logged once
+        self.assertTrue(sampler.sample_count > 0)
+        mocked_error.assert_called_once()
@@ -0,0 +1,99 @@
+import time
+import types
+import collections
+import contextlib
+from unittest.mock import patch
+
+from graphsignal.usage import nvml_reader
+from graphsignal.usage import device_sampler
+from graphsignal.usage.pynvml import *
+
+
+class FakeNvml:
+    # NVML functions for devices that are not there, counts calls
+    def __init__(self, num_devices=1):
+        self.num_devices = num_devices
+        self.calls = collections.Counter()
+        self.mem_used = 40
+        self.gpu_utilization = 50
+        self.power_usage_w = 200
+        self.compute_processes = []
+        self.graphics_processes = []
+
+    def patch(self):
+        functions = {}
+        for name in dir(self):
+            if name.startswith('nvml'):
+                functions[name] = self._counted(name, getattr(self, name))
+        stack = contextlib.ExitStack()
+        for module in (nvml_reader, device_sampler):
+            stack.enter_context(patch.multiple(module,
+                **{name: func for name, func in functions.items() if hasattr(module, name)}))
+        return stack
+
+    def _counted(self, name, func):
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return func(*args, **kwargs)
+        return counted
+
+    def nvmlInit(self):
+        pass
+
+    def nvmlShutdown(self):
+        pass
+
+    def nvmlDeviceGetCount(self):
+        return self.num_devices
+
+    def nvmlDeviceGetHandleByIndex(self, idx):
+        return idx
+
+    def nvmlDeviceGetPciInfo(self, handle):
+        return types.SimpleNamespace(busId='00000000:0{0}:00.0'.format(handle))
+
+    def nvmlDeviceGetName(self, handle):
+        return 'GPU {0}'.format(handle)
+
+    def nvmlDeviceGetArchitecture(self, handle):
+        return NVML_DEVICE_ARCH_AMPERE
+
+    def nvmlDeviceGetCudaComputeCapability(self, handle):
+        return 8, 0
+
+    def nvmlDeviceGetMemoryInfo(self, handle):
+        return types.SimpleNamespace(total=100, used=self.mem_used)
+
+    def nvmlDeviceGetSamples(self, handle, sample_type, last_seen_us):
+        value = self.gpu_utilization if sample_type == NVML_GPU_UTILIZATION_SAMPLES else 10
+        sample = types.SimpleNamespace(sampleValue=types.SimpleNamespace(uiVal=value))
+        return NVML_VALUE_TYPE_UNSIGNED_INT, [sample]
+
+    def nvmlDeviceGetUtilizationRates(self, handle):
+        return types.SimpleNamespace(gpu=self.gpu_utilization, memory=10)
+
+    def nvmlDeviceGetClockInfo(self, handle, clock_type):
+        return 1400
+
+    def nvmlDeviceGetPcieThroughput(self, handle, counter):
+        return 1000
+
+    def nvmlDeviceGetFieldValues(self, handle, field_ids):
+        return [types.SimpleNamespace(nvmlReturn=NVML_SUCCESS, timestamp=time.time() * 1e6,
+            valueType=NVML_VALUE_TYPE_UNSIGNED_LONG_LONG, value=types.SimpleNamespace(ullVal=0))
+            for _ in field_ids]
+
+    def nvmlDeviceGetTemperature(self, handle, sensor):
+        return 60
+
+    def nvmlDeviceGetPowerUsage(self, handle):
+        return self.power_usage_w * 1000
+
+    def nvmlDeviceGetComputeRunningProcesses(self, handle):
+        return [types.SimpleNamespace(pid=pid, usedGpuMemory=mem) for pid, mem in self.compute_processes]
+
+    def nvmlDeviceGetGraphicsRunningProcesses(self, handle):
+        return [types.SimpleNamespace(pid=pid, usedGpuMemory=mem) for pid, mem in self.graphics_processes]
+
+    def nvmlDeviceGetFanSpeed(self, handle):
+        raise NVMLError(NVML_ERROR_NOT_SUPPORTED)
@@ -3,107 +3,152 @@ import os
 import sys
 import time
 import socket
+import threading
 
 import graphsignal
 from graphsignal.proto import profiles_pb2
+from graphsignal.usage import pynvml
+from graphsignal.usage.device_sampler import DeviceSampler
 from graphsignal.usage.pynvml import *
 
 logger = logging.getLogger('graphsignal')
 
+# inode of the initial PID namespace, see PROC_PID_INIT_INO in Linux
+INIT_PID_NAMESPACE = 'pid:[4026531836]'
+
+class DeviceRecord:
+    __slots__ = [
+        'index',
+        'handle',
+        'static_usage',
+        'unsupported',
+        'failed'
+    ]
+
+    def __init__(self, index, handle):
+        self.index = index
+        self.handle = handle
+        # attributes that do not change, copied into every sample
+        self.static_usage = profiles_pb2.DeviceUsage()
+        # dynamic counters not supported by the device are not polled again
+        self.unsupported = set()
+        # counters failed in the background sampler, logged once
+        self.failed = set()
+
+
 class NvmlReader():
     MIN_SAMPLE_READ_INTERVAL_US = int(10 * 1e6)
 
-    def __init__(self):
+    def __init__(self, sample_usage=False):
         self._is_initialized = False
+        self._pid = None
+        self._host_pid = None
+        self._sample_usage = sample_usage
+        self._sampler = None
+        self._devices = []
         self._last_nvlink_throughput_data_tx = {}
         self._last_nvlink_throughput_data_rx = {}
 
     def setup(self):
         if self._is_initialized:
             return
+        self._pid = os.getpid()
         try:
             nvmlInit()
             self._is_initialized = True
             logger.debug('Initialized NVML')
         except BaseException:
             logger.debug('Error initializing NVML, skipping GPU usage')
+            return
+        try:
+            self._devices = _read_devices()
+        except BaseException:
+            logger.error('Error reading NVML devices', exc_info=True)
+            self._devices = []
+        self._host_pid = _read_host_pid()
+        if self._host_pid is None:
+            logger.debug('Host PID of the process is unknown, skipping per-process device memory')
+        if self._sample_usage and len(self._devices) > 0:
+            self._sampler = DeviceSampler(self._devices)
+            self._sampler.start()
 
     def shutdown(self):
         if not self._is_initialized:
             return
+        if self._pid != os.getpid():
+            # NVML was not initialized in the forked process
+            self._is_initialized = False
+            self._devices = []
+            return
+        if self._sampler:
+            self._sampler.stop()
+            self._sampler = None
         try:
             nvmlShutdown()
             self._is_initialized = False
+            self._devices = []
         except BaseException:
             logger.error('Error shutting down NVML', exc_info=True)
 
+    def reset_after_fork(self):
+        # NVML state is not inherited safely by the child process, it is
+        # initialized again on first use
+        pynvml.libLoadLock = threading.Lock()
+        self._last_nvlink_throughput_data_tx = {}
+        self._last_nvlink_throughput_data_rx = {}
+        # the sampler thread does not exist in the child
+        self._sampler = None
+
+    def _setup_after_fork(self):
+        self._pid = os.getpid()
+        if self._is_initialized:
+            self._is_initialized = False
+            self._devices = []
+            self.setup()
+
     def start(self):
         self.read(profiles_pb2.MLProfile())
 
     def read(self, profile):
+        if self._pid != os.getpid():
+            self._setup_after_fork()
         if not self._is_initialized:
             return
 
         now_us = int(time.time() * 1e6)
 
-        device_count = nvmlDeviceGetCount()
-
-        profile.node_usage.num_devices = device_count
-
-        for idx in range(0, device_count):
-            try:
-                handle = nvmlDeviceGetHandleByIndex(idx)
-            except NVMLError as err:
-                log_nvml_error(err)
-                continue
+        profile.node_usage.num_devices = len(self._devices)
 
+        for device in self._devices:
             device_usage = profile.device_usage.add()
-            device_usage.device_type = profiles_pb2.DeviceType.GPU
-
-            try:
-                pci_info = nvmlDeviceGetPciInfo(handle)
-                device_usage.device_id = pci_info.busId
-            except NVMLError as err:
-                log_nvml_error(err)
-
-            try:
-                device_usage.device_name = nvmlDeviceGetName(handle)
-            except NVMLError as err:
-                log_nvml_error(err)
-
-            try:
-                arch = nvmlDeviceGetArchitecture(handle)
-                if arch == NVML_DEVICE_ARCH_KEPLER:
-                    device_usage.architecture = 'Kepler'
-                elif arch == NVML_DEVICE_ARCH_MAXWELL:
-                    device_usage.architecture = 'Maxwell'
-                elif arch == NVML_DEVICE_ARCH_PASCAL:
-                    device_usage.architecture = 'Pascal'
-                elif arch == NVML_DEVICE_ARCH_VOLTA:
-                    device_usage.architecture = 'Volta'
-                elif arch == NVML_DEVICE_ARCH_TURING:
-                    device_usage.architecture = 'Turing'
-                elif arch == NVML_DEVICE_ARCH_AMPERE:
-                    device_usage.architecture = 'Ampere'
-            except NVMLError as err:
-                log_nvml_error(err)
+            device_usage.CopyFrom(device.static_usage)
+            self._read_dynamic(device, device_usage, now_us)
+            self._read_process_memory(profile, device)
+            if self._sampler:
+                self._sampler.read(profile, device, device_usage)
+
+    def read_samples(self, profile):
+        # sampled usage for a profile of another process, e.g. a worker
+        # sending profiles to the collector
+        if not self._sampler or len(profile.device_usage) != len(self._devices):
+            return
+        for device, device_usage in zip(self._devices, profile.device_usage):
+            self._sampler.read(profile, device, device_usage)
 
-            try:
-                cc_major, cc_minor = nvmlDeviceGetCudaComputeCapability(handle)
-                device_usage.compute_capability.major = cc_major
-                device_usage.compute_capability.minor = cc_minor
-            except NVMLError as err:
-                log_nvml_error(err)
+    def _read_dynamic(self, device, device_usage, now_us):
+        handle = device.handle
+        unsupported = device.unsupported
 
+        if 'mem' not in unsupported:
             try:
                 mem_info = nvmlDeviceGetMemoryInfo(handle)
                 device_usage.mem_total = mem_info.total
                 device_usage.mem_used = mem_info.used
                 device_usage.mem_free = mem_info.total - mem_info.used
             except NVMLError as err:
-                log_nvml_error(err)
-
+                _handle_nvml_error(err, device, 'mem')
 
+        if 'samples' not in unsupported:
             try:
                 last_read_us = max(
                     int(graphsignal.current_run().start_ms * 1e3),
@@ -115,18 +160,23 @@ class NvmlReader():
                 sample_value_type, mem_samples = nvmlDeviceGetSamples(handle, NVML_MEMORY_UTILIZATION_SAMPLES, last_read_us)
                 device_usage.mem_access_percent = _avg_sample_value(sample_value_type, mem_samples)
             except NVMLError as err:
-                log_nvml_error(err)
+                _handle_nvml_error(err, device, 'samples')
 
+        if 'pcie' not in unsupported:
             try:
                 device_usage.pcie_throughput_tx = nvmlDeviceGetPcieThroughput(
                     handle, NVML_PCIE_UTIL_TX_BYTES)
                 device_usage.pcie_throughput_rx = nvmlDeviceGetPcieThroughput(
                     handle, NVML_PCIE_UTIL_RX_BYTES)
             except NVMLError as err:
-                log_nvml_error(err)
+                _handle_nvml_error(err, device, 'pcie')
 
+        if 'nvlink' not in unsupported:
             try:
-                nvlink_throughput_data_tx = nvmlDeviceGetFieldValues(handle, [NVML_FI_DEV_NVLINK_THROUGHPUT_DATA_TX])[0]
+                # both counters in one call
+                nvlink_throughput_data_tx, nvlink_throughput_data_rx = nvmlDeviceGetFieldValues(
+                    handle, [NVML_FI_DEV_NVLINK_THROUGHPUT_DATA_TX, NVML_FI_DEV_NVLINK_THROUGHPUT_DATA_RX])
+                idx = device.index
                 if nvlink_throughput_data_tx.nvmlReturn == NVML_SUCCESS:
                     if idx in self._last_nvlink_throughput_data_tx:
                         last_data = self._last_nvlink_throughput_data_tx[idx]
@@ -137,7 +187,6 @@ class NvmlReader():
                             device_usage.nvlink_throughput_tx_kibs = (value - last_value) / (interval_us * 1e6)
                     self._last_nvlink_throughput_data_tx[idx] = nvlink_throughput_data_tx
 
-                nvlink_throughput_data_rx = nvmlDeviceGetFieldValues(handle, [NVML_FI_DEV_NVLINK_THROUGHPUT_DATA_RX])[0]
                 if nvlink_throughput_data_rx.nvmlReturn == NVML_SUCCESS:
                     if idx in self._last_nvlink_throughput_data_rx:
                         last_data = self._last_nvlink_throughput_data_rx[idx]
@@ -148,26 +197,147 @@ class NvmlReader():
                             device_usage.nvlink_throughput_rx_kibs = (value - last_value) / (interval_us * 1e6)
                     self._last_nvlink_throughput_data_rx[idx] = nvlink_throughput_data_rx
 
+                if (nvlink_throughput_data_tx.nvmlReturn == NVML_ERROR_NOT_SUPPORTED and
+                        nvlink_throughput_data_rx.nvmlReturn == NVML_ERROR_NOT_SUPPORTED):
+                    unsupported.add('nvlink')
             except NVMLError as err:
-                log_nvml_error(err)
+                _handle_nvml_error(err, device, 'nvlink')
 
+        if 'temp' not in unsupported:
             try:
                 device_usage.gpu_temp_c = nvmlDeviceGetTemperature(
                     handle, NVML_TEMPERATURE_GPU)
             except NVMLError as err:
-                log_nvml_error(err)
+                _handle_nvml_error(err, device, 'temp')
 
+        if 'power' not in unsupported:
             try:
                 device_usage.power_usage_w = nvmlDeviceGetPowerUsage(
                     handle) / 1000.0
             except NVMLError as err:
-                log_nvml_error(err)
+                _handle_nvml_error(err, device, 'power')
 
+        if 'fan' not in unsupported:
             try:
                 device_usage.fan_speed_percent = nvmlDeviceGetFanSpeed(
                     handle)
             except NVMLError as err:
-                log_nvml_error(err)
+                _handle_nvml_error(err, device, 'fan')
+
+
+    def _read_process_memory(self, profile, device):
+        # device memory of this process and of other processes sharing the device;
+        # processes using both compute and graphics are listed twice
+        if self._host_pid is None:
+            return
+        process_mem = {}
+        is_read = False
+        for counter, get_processes in (
+                ('compute_processes', nvmlDeviceGetComputeRunningProcesses),
+                ('graphics_processes', nvmlDeviceGetGraphicsRunningProcesses)):
+            if counter in device.unsupported:
+                continue
+            try:
+                for process in get_processes(device.handle):
+                    if process.usedGpuMemory is not None:
+                        process_mem[process.pid] = max(process_mem.get(process.pid, 0), process.usedGpuMemory)
+                is_read = True
+            except NVMLError as err:
+                _handle_nvml_error(err, device, counter)
+        if not is_read:
+            return
+
+        pid = self._host_pid
+        _add_metric(profile, 'device_{0}_process_mem_used'.format(device.index),
+            process_mem.get(pid, 0))
+        _add_metric(profile, 'device_{0}_other_processes_mem_used'.format(device.index),
+            sum(mem for other_pid, mem in process_mem.items() if other_pid != pid))
+        _add_metric(profile, 'device_{0}_other_process_count'.format(device.index),
+            sum(1 for other_pid in process_mem if other_pid != pid))
+
+
+def _read_host_pid():
+    # NVML reports PIDs of the host PID namespace, which differ from
+    # os.getpid() in containers
+    try:
+        if os.readlink('/proc/self/ns/pid') == INIT_PID_NAMESPACE:
+            return os.getpid()
+    except OSError:
+        # no PID namespaces
+        return os.getpid()
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('NSpid:'):
+                    # PIDs from the namespace of /proc to the process namespace
+                    ns_pids = line.split()[1:]
+                    if len(ns_pids) > 1:
+                        return int(ns_pids[0])
+                    break
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _add_metric(profile, name, value):
+    metric = profile.metrics.add()
+    metric.name = name
+    metric.value = value
+
+
+def _read_devices():
+    devices = []
+    device_count = nvmlDeviceGetCount()
+    for idx in range(0, device_count):
+        try:
+            handle = nvmlDeviceGetHandleByIndex(idx)
+        except NVMLError as err:
+            log_nvml_error(err)
+            continue
+
+        device = DeviceRecord(idx, handle)
+        device_usage = device.static_usage
+        device_usage.device_type = profiles_pb2.DeviceType.GPU
+
+        try:
+            pci_info = nvmlDeviceGetPciInfo(handle)
+            device_usage.device_id = pci_info.busId
+        except NVMLError as err:
+            log_nvml_error(err)
+
+        try:
+            device_usage.device_name = nvmlDeviceGetName(handle)
+        except NVMLError as err:
+            log_nvml_error(err)
+
+        try:
+            arch = nvmlDeviceGetArchitecture(handle)
+            if arch == NVML_DEVICE_ARCH_KEPLER:
+                device_usage.architecture = 'Kepler'
+            elif arch == NVML_DEVICE_ARCH_MAXWELL:
+                device_usage.architecture = 'Maxwell'
+            elif arch == NVML_DEVICE_ARCH_PASCAL:
+                device_usage.architecture = 'Pascal'
+            elif arch == NVML_DEVICE_ARCH_VOLTA:
+                device_usage.architecture = 'Volta'
+            elif arch == NVML_DEVICE_ARCH_TURING:
+                device_usage.architecture = 'Turing'
+            elif arch == NVML_DEVICE_ARCH_AMPERE:
+                device_usage.architecture = 'Ampere'
+        except NVMLError as err:
+            log_nvml_error(err)
+
+        try:
+            cc_major, cc_minor = nvmlDeviceGetCudaComputeCapability(handle)
+            device_usage.compute_capability.major = cc_major
+            device_usage.compute_capability.minor = cc_minor
+        except NVMLError as err:
+            log_nvml_error(err)
+
+        devices.append(device)
+
+    logger.debug('Found %d NVML devices', len(devices))
+    return devices
 
 
 def _nvml_value(value_type, value):
@@ -202,6 +372,12 @@ def _avg_sample_value(sample_value_type, samples):
     return 0
 
 
+def _handle_nvml_error(err, device, counter):
+    if err.value == NVML_ERROR_NOT_SUPPORTED:
+        device.unsupported.add(counter)
+    log_nvml_error(err)
+
+
 def log_nvml_error(err):
     if (err.value == NVML_ERROR_NOT_SUPPORTED):
         logger.debug('NVML call not supported', exc_info=True)
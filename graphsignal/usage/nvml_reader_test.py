@@ -1,14 +1,17 @@
 import unittest
 import logging
 import sys
-from unittest.mock import patch, Mock
+import os
+from unittest.mock import patch, Mock, mock_open
 import torch
 from google.protobuf.json_format import MessageToJson
 import pprint
 import time
 
 import graphsignal
+from graphsignal.usage import nvml_reader
 from graphsignal.usage.nvml_reader import NvmlReader
+from graphsignal.usage.fake_nvml_test import FakeNvml
 from graphsignal.proto import profiles_pb2
 
 logger = logging.getLogger('graphsignal')
@@ -68,3 +71,104 @@ class NvmlReaderTest(unittest.TestCase):
             #self.assertTrue(device_usage.fan_speed_percent > 0)
             self.assertTrue(device_usage.gpu_temp_c > 0)
             self.assertTrue(device_usage.power_usage_w > 0)
+
+    def test_read_cached(self):
+        fake_nvml = FakeNvml(num_devices=4)
+        with fake_nvml.patch():
+            reader = NvmlReader()
+            reader.setup()
+            setup_calls = sum(fake_nvml.calls.values())
+
+            num_reads = 100
+            start_ns = time.perf_counter_ns()
+            for _ in range(num_reads):
+                profile = profiles_pb2.MLProfile()
+                reader.read(profile)
+            took_ns = time.perf_counter_ns() - start_ns
+            reader.shutdown()
+
+        read_calls = sum(fake_nvml.calls.values()) - setup_calls - fake_nvml.calls['nvmlShutdown']
+        logger.debug('NVML read with %d devices: %d calls/read, %d ns/read',
+            fake_nvml.num_devices, read_calls / num_reads, took_ns / num_reads)
+
+        # handles and static attributes are read once at setup
+        for name in ('nvmlDeviceGetCount', 'nvmlDeviceGetHandleByIndex', 'nvmlDeviceGetPciInfo',
+                     'nvmlDeviceGetName', 'nvmlDeviceGetArchitecture', 'nvmlDeviceGetCudaComputeCapability'):
+            self.assertTrue(fake_nvml.calls[name] <= fake_nvml.num_devices, name)
+        # unsupported counters are not polled again
+        self.assertEqual(fake_nvml.calls['nvmlDeviceGetFanSpeed'], fake_nvml.num_devices)
+        self.assertEqual(fake_nvml.calls['nvmlDeviceGetFieldValues'], num_reads * fake_nvml.num_devices)
+        self.assertTrue(read_calls <= (num_reads * 10 + 1) * fake_nvml.num_devices)
+
+        self.assertEqual(profile.node_usage.num_devices, 4)
+        device_usage = profile.device_usage[3]
+        self.assertEqual(device_usage.device_type, profiles_pb2.DeviceType.GPU)
+        self.assertEqual(device_usage.device_id, '00000000:03:00.0')
+        self.assertEqual(device_usage.device_name, 'GPU 3')
+        self.assertEqual(device_usage.architecture, 'Ampere')
+        self.assertEqual(device_usage.compute_capability.major, 8)
+        self.assertEqual(device_usage.mem_total, 100)
+        self.assertEqual(device_usage.mem_used, 40)
+        self.assertEqual(device_usage.gpu_utilization_percent, 50)
+        self.assertEqual(device_usage.power_usage_w, 200)
+
+    def test_read_process_memory(self):
+        fake_nvml = FakeNvml(num_devices=2)
+        pid = os.getpid()
+        fake_nvml.compute_processes = [(pid, 1000), (pid + 1, 2000), (pid + 2, 3000), (pid + 3, None)]
+        fake_nvml.graphics_processes = [(pid, 1000), (pid + 4, 500)]
+        with fake_nvml.patch(), patch.object(nvml_reader, '_read_host_pid', return_value=pid):
+            reader = NvmlReader()
+            reader.setup()
+            profile = profiles_pb2.MLProfile()
+            reader.read(profile)
+            reader.shutdown()
+
+        metrics = {metric.name: metric.value for metric in profile.metrics}
+        self.assertEqual(metrics['device_0_process_mem_used'], 1000)
+        self.assertEqual(metrics['device_0_other_processes_mem_used'], 5500)
+        self.assertEqual(metrics['device_0_other_process_count'], 3)
+        self.assertEqual(metrics['device_1_process_mem_used'], 1000)
+
+    def test_read_process_memory_container(self):
+        fake_nvml = FakeNvml(num_devices=1)
+        fake_nvml.compute_processes = [(12345, 1000), (12346, 2000)]
+        with fake_nvml.patch(), patch.object(nvml_reader, '_read_host_pid', return_value=None):
+            reader = NvmlReader()
+            reader.setup()
+            profile = profiles_pb2.MLProfile()
+            reader.read(profile)
+            reader.shutdown()
+
+        # own memory cannot be told apart from other processes
+        metrics = {metric.name: metric.value for metric in profile.metrics}
+        self.assertNotIn('device_0_process_mem_used', metrics)
+        self.assertNotIn('device_0_other_processes_mem_used', metrics)
+        self.assertEqual(fake_nvml.calls['nvmlDeviceGetComputeRunningProcesses'], 0)
+
+    def test_read_host_pid(self):
+        with patch('os.readlink', return_value=nvml_reader.INIT_PID_NAMESPACE):
+            self.assertEqual(nvml_reader._read_host_pid(), os.getpid())
+
+        # process in a container
+        with patch('os.readlink', return_value='pid:[4026532000]'):
+            with patch('builtins.open', mock_open(read_data='Name:\tpython\nNSpid:\t12345\t7\n')):
+                self.assertEqual(nvml_reader._read_host_pid(), 12345)
+            with patch('builtins.open', mock_open(read_data='Name:\tpython\nNSpid:\t7\n')):
+                self.assertIsNone(nvml_reader._read_host_pid())
+
+    def test_read_process_memory_unsupported(self):
+        fake_nvml = FakeNvml(num_devices=1)
+        fake_nvml.nvmlDeviceGetComputeRunningProcesses = fake_nvml.nvmlDeviceGetFanSpeed
+        fake_nvml.nvmlDeviceGetGraphicsRunningProcesses = fake_nvml.nvmlDeviceGetFanSpeed
+        with fake_nvml.patch():
+            reader = NvmlReader()
+            reader.setup()
+            for _ in range(3):
+                profile = profiles_pb2.MLProfile()
+                reader.read(profile)
+            reader.shutdown()
+
+        metrics = {metric.name: metric.value for metric in profile.metrics}
+        self.assertNotIn('device_0_process_mem_used', metrics)
+        self.assertEqual(fake_nvml.calls['nvmlDeviceGetComputeRunningProcesses'], 1)
@@ -8,6 +8,7 @@ import re
 import multiprocessing
 import subprocess
 import socket
+import threading
 try:
     import resource
 except ImportError:
@@ -17,6 +18,7 @@ import graphsignal
 from graphsignal.proto import profiles_pb2
 from graphsignal.proto_utils import parse_semver
 from graphsignal import version
+from graphsignal.usage.process_sampler import ProcessSampler
 
 logger = logging.getLogger('graphsignal')
 
@@ -32,102 +34,157 @@ MEM_FREE_REGEXP = re.compile(r'MemFree:\s+(\d+)\s+kB')
 
 
 class ProcessReader():
-    def __init__(self):
+    STATIC_REFRESH_INTERVAL_SEC = 600
+
+    def __init__(self, sample_usage=False):
+        self._sampler = ProcessSampler() if sample_usage else None
+        self._window_start_sec = None
         self._start_ms = int(time.time() * 1e3)
         self._last_read_sec = None
         self._last_cpu_time_ns = None
+        self._static_profile = None
+        self._static_read_sec = None
+        self._static_refreshing = False
+        self._static_lock = threading.Lock()
+        try:
+            self._cpu_count = multiprocessing.cpu_count()
+        except Exception:
+            self._cpu_count = 1
 
     def setup(self):
-        pass
+        # host and runtime facts do not change between samples, so they are
+        # read once and copied into profiles
+        self._refresh_static()
+        if self._sampler:
+            self._sampler.start()
 
     def shutdown(self):
-        pass
+        if self._sampler:
+            self._sampler.stop()
+
+    def reset_after_fork(self):
+        self._start_ms = int(time.time() * 1e3)
+        self._last_read_sec = None
+        self._last_cpu_time_ns = None
+        # static facts are shared with the parent, a refresh thread is not
+        self._static_refreshing = False
+        self._static_lock = threading.Lock()
+        self._window_start_sec = None
+        if self._sampler:
+            self._sampler.reset_after_fork()
 
     def start(self):
+        if self._sampler:
+            self._sampler.ensure_started()
         self.read(profiles_pb2.MLProfile())
+        self._window_start_sec = time.monotonic()
 
     def read(self, profile):
-        now = time.time()
-        pid = str(os.getpid())
+        now = time.monotonic()
+
+        if self._static_profile is None:
+            self._refresh_static()
+        elif now - self._static_read_sec > self.STATIC_REFRESH_INTERVAL_SEC:
+            self._refresh_static_in_thread()
+        profile.MergeFrom(self._static_profile)
 
         node_usage = profile.node_usage
         process_usage = profile.process_usage
         process_usage.start_ms = self._start_ms
-
-        process_usage.process_id = pid
-
-        if OS_LINUX:
-            cpu_name = _read_cpu_name()
-            if cpu_name:
-                process_usage.cpu_name = cpu_name
-        elif OS_DARWIN:
-            cpu_name = _read_cpu_name_mac()
-            if cpu_name:
-                process_usage.cpu_name = cpu_name
+        process_usage.process_id = str(os.getpid())
 
         if not OS_WIN:
-            cpu_time_ns = _read_cpu_time()
-            if cpu_time_ns is not None:
-                if self._last_cpu_time_ns is not None:
-                    cpu_diff_ns = cpu_time_ns - self._last_cpu_time_ns
-                    interval_ns = (now - self._last_read_sec) * 1e9
-                    cpu_usage = (cpu_diff_ns / interval_ns) * 100
-                    try:
-                        cpu_usage = cpu_usage / multiprocessing.cpu_count()
-                    except Exception:
-                        pass
-                    process_usage.cpu_usage_percent = cpu_usage
-
-                if (self._last_read_sec is None or now - self._last_read_sec > 0):
-                    self._last_read_sec = now
-                    self._last_cpu_time_ns = cpu_time_ns
+            rusage = resource.getrusage(resource.RUSAGE_SELF)
+            cpu_time_ns = int((rusage.ru_utime + rusage.ru_stime) * 1e9)
+            if self._last_cpu_time_ns is not None:
+                cpu_diff_ns = cpu_time_ns - self._last_cpu_time_ns
+                interval_ns = (now - self._last_read_sec) * 1e9
+                cpu_usage = (cpu_diff_ns / interval_ns) * 100
+                cpu_usage = cpu_usage / self._cpu_count
+                process_usage.cpu_usage_percent = cpu_usage
 
-        if not OS_WIN:
-            max_rss = _read_max_rss()
-            if max_rss is not None:
-                process_usage.max_rss = max_rss
+            if (self._last_read_sec is None or now - self._last_read_sec > 0):
+                self._last_read_sec = now
+                self._last_cpu_time_ns = cpu_time_ns
+
+            process_usage.max_rss = rusage.ru_maxrss if OS_DARWIN else rusage.ru_maxrss * 1024
 
         if OS_LINUX:
-            current_rss = _read_current_rss()
+            current_rss, vm_size = _read_proc_status()
             if current_rss is not None:
                 process_usage.current_rss = current_rss
-
-            vm_size = _read_vm_size()
             if vm_size is not None:
                 process_usage.vm_size = vm_size
 
+            mem_total, mem_free = _read_meminfo()
+            if mem_total is not None:
+                node_usage.mem_total = mem_total
+                if mem_free is not None:
+                    node_usage.mem_used = mem_total - mem_free
+
+        # usage sampled in the background since start
+        if self._sampler and self._window_start_sec is not None:
+            self._sampler.read(profile, self._window_start_sec, now)
+            self._window_start_sec = None
+
+    def _refresh_static_in_thread(self):
+        with self._static_lock:
+            if self._static_refreshing:
+                return
+            self._static_refreshing = True
+        thread = threading.Thread(target=self._refresh_static, name='graphsignal-process-reader')
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_static(self):
         try:
-            node_usage.hostname = socket.gethostname()
-            if node_usage.hostname:
-                node_usage.ip_address = socket.gethostbyname(node_usage.hostname)
-        except BaseException:
-            logger.debug('Error reading hostname', exc_info=True)
-
-        mem_total = _read_mem_total()
-        if mem_total is not None:
-            node_usage.mem_total = mem_total
-            mem_free = _read_mem_free()
-            if mem_free is not None:
-                node_usage.mem_used = mem_total - mem_free
+            static_profile = profiles_pb2.MLProfile()
+            _read_static(static_profile)
+            self._static_profile = static_profile
+        finally:
+            self._static_read_sec = time.monotonic()
+            self._static_refreshing = False
+
+
+def _read_static(profile):
+    node_usage = profile.node_usage
+    process_usage = profile.process_usage
+
+    if OS_LINUX:
+        cpu_name = _read_cpu_name()
+        if cpu_name:
+            process_usage.cpu_name = cpu_name
+    elif OS_DARWIN:
+        cpu_name = _read_cpu_name_mac()
+        if cpu_name:
+            process_usage.cpu_name = cpu_name
 
-        try:
-            node_usage.platform = sys.platform
-            node_usage.machine = platform.machine()
-            if not OS_WIN:
-                node_usage.os_name = os.uname().sysname
-                node_usage.os_version = os.uname().release
-        except BaseException:
-            logger.error('Error reading node information', exc_info=True)
+    try:
+        node_usage.hostname = socket.gethostname()
+        if node_usage.hostname:
+            node_usage.ip_address = socket.gethostbyname(node_usage.hostname)
+    except BaseException:
+        logger.debug('Error reading hostname', exc_info=True)
 
-        try:
-            process_usage.runtime = profiles_pb2.ProcessUsage.Runtime.PYTHON
-            process_usage.runtime_version.major = sys.version_info.major
-            process_usage.runtime_version.minor = sys.version_info.minor
-            process_usage.runtime_version.patch = sys.version_info.micro
-            process_usage.runtime_impl = platform.python_implementation()
-            parse_semver(profile.profiler_info.version, version.__version__)
-        except BaseException:
-            logger.error('Error reading process information', exc_info=True)
+    try:
+        node_usage.platform = sys.platform
+        node_usage.machine = platform.machine()
+        if not OS_WIN:
+            uname = os.uname()
+            node_usage.os_name = uname.sysname
+            node_usage.os_version = uname.release
+    except BaseException:
+        logger.error('Error reading node information', exc_info=True)
+
+    try:
+        process_usage.runtime = profiles_pb2.ProcessUsage.Runtime.PYTHON
+        process_usage.runtime_version.major = sys.version_info.major
+        process_usage.runtime_version.minor = sys.version_info.minor
+        process_usage.runtime_version.patch = sys.version_info.micro
+        process_usage.runtime_impl = platform.python_implementation()
+        parse_semver(profile.profiler_info.version, version.__version__)
+    except BaseException:
+        logger.error('Error reading process information', exc_info=True)
 
 
 def _read_cpu_name():
@@ -158,76 +215,28 @@ def _read_cpu_name_mac():
     return None
 
 
-def _read_cpu_time():
-    rusage = resource.getrusage(resource.RUSAGE_SELF)
-    return int((rusage.ru_utime + rusage.ru_stime) * 1e9)  # ns
-
-
-def _read_max_rss():
-    rusage = resource.getrusage(resource.RUSAGE_SELF)
-
-    if OS_DARWIN:
-        return rusage.ru_maxrss
-    else:
-        return rusage.ru_maxrss * 1024
-
-
-def _read_current_rss():
-    pid = os.getpid()
-
-    try:
-        f = open('/proc/{0}/status'.format(os.getpid()))
-        output = f.read()
-        f.close()
-    except Exception:
-        return None
-
-    match = VM_RSS_REGEXP.search(output)
-    if match:
-        return int(float(match.group(1)) * 1e3)
-
-    return None
-
-
-def _read_vm_size():
-    pid = os.getpid()
-
+def _read_proc_status():
     try:
-        f = open('/proc/{0}/status'.format(os.getpid()))
-        output = f.read()
-        f.close()
+        with open('/proc/self/status') as f:
+            output = f.read()
     except Exception:
-        return None
+        return None, None
 
-    match = VM_SIZE_REGEXP.search(output)
-    if match:
-        return int(float(match.group(1)) * 1e3)
+    return _match_kb(VM_RSS_REGEXP, output), _match_kb(VM_SIZE_REGEXP, output)
 
-    return None
 
-def _read_mem_total():
+def _read_meminfo():
     try:
-        f = open('/proc/meminfo')
-        output = f.read()
-        f.close()
+        with open('/proc/meminfo') as f:
+            output = f.read()
     except Exception:
-        return None
-
-    match = MEM_TOTAL_REGEXP.search(output)
-    if match:
-        return int(float(match.group(1)) * 1e3)
+        return None, None
 
-    return None
+    return _match_kb(MEM_TOTAL_REGEXP, output), _match_kb(MEM_FREE_REGEXP, output)
 
-def _read_mem_free():
-    try:
-        f = open('/proc/meminfo')
-        output = f.read()
-        f.close()
-    except Exception:
-        return None
 
-    match = MEM_FREE_REGEXP.search(output)
+def _match_kb(regexp, output):
+    match = regexp.search(output)
     if match:
         return int(float(match.group(1)) * 1e3)
 
@@ -50,3 +50,34 @@ class ProcessReaderTest(unittest.TestCase):
             self.assertTrue(profile.process_usage.current_rss > 0)
             self.assertTrue(profile.process_usage.vm_size > 0)
         self.assertTrue(profile.profiler_info.version.major > 0 or profile.profiler_info.version.minor > 0)
+
+    def test_read_static_cached(self):
+        reader = ProcessReader()
+        with patch('graphsignal.usage.process_reader._read_cpu_name', return_value='cpu1') as mocked_read_cpu_name:
+            reader.setup()
+            num_reads = 100
+            start_ns = time.perf_counter_ns()
+            for _ in range(num_reads):
+                profile = profiles_pb2.MLProfile()
+                reader.read(profile)
+            logger.debug('Process usage read: %d ns/read', (time.perf_counter_ns() - start_ns) / num_reads)
+
+            # static facts are read once
+            mocked_read_cpu_name.assert_called_once()
+            if sys.platform.startswith('linux'):
+                self.assertEqual(profile.process_usage.cpu_name, 'cpu1')
+            self.assertNotEqual(profile.node_usage.hostname, '')
+            self.assertTrue(profile.process_usage.runtime_version.major > 0)
+
+            # and refreshed in the background
+            reader._static_read_sec -= ProcessReader.STATIC_REFRESH_INTERVAL_SEC + 1
+            reader.read(profiles_pb2.MLProfile())
+            for _ in range(100):
+                if mocked_read_cpu_name.call_count == 2 and not reader._static_refreshing:
+                    break
+                time.sleep(0.01)
+            if sys.platform.startswith('linux'):
+                self.assertEqual(mocked_read_cpu_name.call_count, 2)
+            reader.read(profiles_pb2.MLProfile())
+            if sys.platform.startswith('linux'):
+                self.assertEqual(mocked_read_cpu_name.call_count, 2)
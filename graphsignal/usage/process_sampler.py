@@ -0,0 +1,206 @@
+import logging
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from array import array
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger('graphsignal')
+
+OS_LINUX = (sys.platform.startswith('linux'))
+
+
+class RingBuffer:
+    # Fixed-size time series, samples share one timestamp array and
+    # overwrite the oldest samples when full.
+    def __init__(self, capacity, names):
+        self.capacity = capacity
+        self.names = names
+        self._timestamps = array('d', bytes(8 * capacity))
+        self._values = [array('d', bytes(8 * capacity)) for _ in names]
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, values):
+        index = self._next
+        self._timestamps[index] = timestamp
+        for series, value in zip(self._values, values):
+            series[index] = value
+        self._next = (index + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def window(self, start_ts, end_ts):
+        # returns values of samples in the window, oldest first; windows
+        # are recent, so the buffer is scanned from the newest sample
+        indexes = []
+        for i in range(1, self._count + 1):
+            index = (self._next - i) % self.capacity
+            timestamp = self._timestamps[index]
+            if timestamp < start_ts:
+                break
+            if timestamp <= end_ts:
+                indexes.append(index)
+        indexes.reverse()
+        return {name: [series[index] for index in indexes]
+            for name, series in zip(self.names, self._values)}
+
+
+class ProcessSampler:
+    SAMPLE_INTERVAL_SEC = 0.1
+    BUFFER_SIZE = 3000
+    SERIES_POINTS = 20
+    SAMPLED_METRICS = ['cpu_usage_percent', 'rss', 'num_threads', 'ctx_switches_per_sec']
+
+    def __init__(self):
+        self.sample_count = 0
+        self.cpu_time_sec = 0
+        self._buffer = RingBuffer(self.BUFFER_SIZE, self.SAMPLED_METRICS)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._last_sample = None
+        self._stat_fd = None
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        try:
+            self._cpu_count = multiprocessing.cpu_count()
+        except Exception:
+            self._cpu_count = 1
+
+    def start(self):
+        if resource is None:
+            logger.debug('Process usage sampling is not supported on this platform')
+            return
+        self._pid = os.getpid()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='graphsignal-process-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        self._close_stat()
+
+    def reset_after_fork(self):
+        # the sampler thread does not exist in the child
+        self.sample_count = 0
+        self.cpu_time_sec = 0
+        self._buffer.clear()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._last_sample = None
+        # /proc/self was resolved to the parent process when opened
+        self._close_stat()
+        self._thread = None
+
+    def ensure_started(self):
+        # restarts sampling on first use in a forked process
+        if self._pid is not None and self._pid != os.getpid():
+            self.start()
+
+    def _run(self):
+        has_failed = False
+        while not self._stop_event.wait(self.SAMPLE_INTERVAL_SEC):
+            cpu_start_sec = time.thread_time()
+            try:
+                self.sample()
+            except Exception:
+                # errors are logged once, sampling continues
+                if not has_failed:
+                    has_failed = True
+                    logger.error('Error sampling process usage', exc_info=True)
+            self.cpu_time_sec += time.thread_time() - cpu_start_sec
+
+    def sample(self):
+        now = time.monotonic()
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_time_sec = rusage.ru_utime + rusage.ru_stime
+        ctx_switches = rusage.ru_nvcsw + rusage.ru_nivcsw
+
+        rss = num_threads = None
+        if OS_LINUX:
+            rss, num_threads = self._read_proc_stat()
+        if rss is None:
+            rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        if num_threads is None:
+            num_threads = threading.active_count()
+
+        last_sample = self._last_sample
+        self._last_sample = (now, cpu_time_sec, ctx_switches)
+        if last_sample is None or now <= last_sample[0]:
+            return
+        interval_sec = now - last_sample[0]
+        cpu_usage_percent = (cpu_time_sec - last_sample[1]) / interval_sec / self._cpu_count * 100
+        ctx_switches_per_sec = (ctx_switches - last_sample[2]) / interval_sec
+
+        with self._lock:
+            self._buffer.append(now, (cpu_usage_percent, rss, num_threads, ctx_switches_per_sec))
+        self.sample_count += 1
+
+    def _read_proc_stat(self):
+        # the file is kept open and re-read from the start on every sample
+        try:
+            if self._stat_fd is None:
+                self._stat_fd = os.open('/proc/self/stat', os.O_RDONLY)
+            output = os.pread(self._stat_fd, 4096, 0)
+        except OSError:
+            return None, None
+
+        # fields after the command name, which may contain spaces
+        fields = output[output.rfind(b')') + 2:].split()
+        try:
+            return int(fields[21]) * self._page_size, int(fields[17])
+        except (IndexError, ValueError):
+            return None, None
+
+    def _close_stat(self):
+        if self._stat_fd is not None:
+            os.close(self._stat_fd)
+            self._stat_fd = None
+
+    def read(self, profile, start_ts, end_ts):
+        # include the last sample before the window for spans shorter than the interval
+        with self._lock:
+            window = self._buffer.window(start_ts - self.SAMPLE_INTERVAL_SEC, end_ts)
+        for name, values in window.items():
+            if len(values) == 0:
+                continue
+            _add_metric(profile, 'process_{0}_min'.format(name), min(values))
+            _add_metric(profile, 'process_{0}_avg'.format(name), sum(values) / len(values))
+            _add_metric(profile, 'process_{0}_max'.format(name), max(values))
+            param = profile.params.add()
+            param.name = 'process_{0}_series'.format(name)
+            param.value = ','.join('{0:.4g}'.format(value) for value in _downsample(values, self.SERIES_POINTS))
+
+
+def _downsample(values, num_points):
+    # averages consecutive samples into at most num_points points
+    if len(values) <= num_points:
+        return values
+    points = []
+    for i in range(num_points):
+        bucket = values[i * len(values) // num_points:(i + 1) * len(values) // num_points]
+        points.append(sum(bucket) / len(bucket))
+    return points
+
+
+def _add_metric(profile, name, value):
+    metric = profile.metrics.add()
+    metric.name = name
+    metric.value = value
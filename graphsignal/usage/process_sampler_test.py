@@ -0,0 +1,108 @@
+import unittest
+import logging
+import sys
+import time
+from unittest.mock import patch
+
+import graphsignal
+from graphsignal.usage.process_sampler import RingBuffer, ProcessSampler
+from graphsignal.usage.process_reader import ProcessReader
+from graphsignal.proto import profiles_pb2
+
+logger = logging.getLogger('graphsignal')
+
+
+class ProcessSamplerTest(unittest.TestCase):
+    def setUp(self):
+        if len(logger.handlers) == 0:
+            logger.addHandler(logging.StreamHandler(sys.stdout))
+        graphsignal.configure(
+            api_key='k1',
+            workload_name='w1',
+            debug_mode=True)
+
+    def tearDown(self):
+        graphsignal.shutdown()
+
+    def test_ring_buffer(self):
+        buffer = RingBuffer(5, ['a', 'b'])
+        for i in range(8):
+            buffer.append(i, (i, i * 10))
+
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(buffer.window(0, 100), {'a': [3, 4, 5, 6, 7], 'b': [30, 40, 50, 60, 70]})
+        self.assertEqual(buffer.window(4, 6), {'a': [4, 5, 6], 'b': [40, 50, 60]})
+        self.assertEqual(buffer.window(10, 20), {'a': [], 'b': []})
+
+    def test_read(self):
+        sampler = ProcessSampler()
+        start_ts = time.monotonic()
+        for _ in range(50):
+            sampler.sample()
+            sum(range(10000))
+        end_ts = time.monotonic()
+        self.assertEqual(sampler.sample_count, 49)
+
+        profile = profiles_pb2.MLProfile()
+        sampler.read(profile, start_ts, end_ts)
+
+        metrics = {metric.name: metric.value for metric in profile.metrics}
+        params = {param.name: param.value for param in profile.params}
+        self.assertTrue(metrics['process_rss_min'] > 0)
+        self.assertTrue(metrics['process_rss_min'] <= metrics['process_rss_avg'] <= metrics['process_rss_max'])
+        self.assertTrue(metrics['process_num_threads_max'] >= 1)
+        self.assertTrue(metrics['process_cpu_usage_percent_max'] >= 0)
+        self.assertIn('process_ctx_switches_per_sec_avg', metrics)
+        self.assertEqual(len(params['process_cpu_usage_percent_series'].split(',')), ProcessSampler.SERIES_POINTS)
+
+    def test_process_reader(self):
+        reader = ProcessReader(sample_usage=True)
+        reader.setup()
+        try:
+            reader.start()
+            time.sleep(ProcessSampler.SAMPLE_INTERVAL_SEC * 3)
+            profile = profiles_pb2.MLProfile()
+            reader.read(profile)
+        finally:
+            reader.shutdown()
+
+        metrics = {metric.name: metric.value for metric in profile.metrics}
+        self.assertTrue(metrics['process_rss_max'] > 0)
+        self.assertTrue(profile.process_usage.current_rss > 0)
+
+    def test_sample_error(self):
+        sampler = ProcessSampler()
+        sampler.SAMPLE_INTERVAL_SEC = 0.005
+        sample = sampler.sample
+        calls = []
+        def failing_sample():
+            calls.append(None)
+            if len(calls) <= 3:
+                raise Exception('Ex1')
+            sample()
+        sampler.sample = failing_sample
+
+        with patch.object(logger, 'error') as mocked_error:
+            sampler.start()
+            time.sleep(0.2)
+            sampler.stop()
+
+        # sampling continues after errors, which are logged once
+        self.assertTrue(sampler.sample_count > 0)
+        mocked_error.assert_called_once()
+
+    def test_overhead(self):
+        default_interval_sec = ProcessSampler.SAMPLE_INTERVAL_SEC
+        sampler = ProcessSampler()
+        sampler.SAMPLE_INTERVAL_SEC = 0.005
+        sampler.start()
+        time.sleep(0.5)
+        sampler.stop()
+
+        cpu_per_sample_sec = sampler.cpu_time_sec / sampler.sample_count
+        logger.debug('Process sampler: %d samples, %.1f us CPU per sample, %.4f%% CPU at %.1fs interval',
+            sampler.sample_count, cpu_per_sample_sec * 1e6,
+            cpu_per_sample_sec / default_interval_sec * 100, default_interval_sec)
+        self.assertTrue(sampler.sample_count > 10)
+        # under 0.1% CPU at the default interval
+        self.assertTrue(cpu_per_sample_sec < default_interval_sec * 0.001)
@@ -1,39 +1,78 @@
 import logging
 import threading
 import os
-import random
+import time
+import math
+import weakref
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 import graphsignal
 from graphsignal.profile_scheduler import ProfileScheduler
+from graphsignal.quantile_sketch import QuantileSketch
+from graphsignal.uploader import evict_profiles
+from graphsignal.trace_spill import remove_trace_file
 
 logger = logging.getLogger('graphsignal')
 
 
 class InferenceStats:
-    MAX_RESERVOIR_SIZE = 100
+    REPORTED_PERCENTILES = [50, 95, 99, 99.9]
+    MAX_PENDING_DURATIONS = 1024
 
     def __init__(self):
         self.inference_count = 0
         self.sample_count = 0
         self.total_time_us = 0
-        self.time_samples_us = []
+        self._time_sketch_us = QuantileSketch()
+        self._pending_durations_us = []
+
+    @property
+    def time_sketch_us(self):
+        self._flush_durations()
+        return self._time_sketch_us
+
+    def _flush_durations(self):
+        if self._pending_durations_us:
+            self._time_sketch_us.add_many(self._pending_durations_us)
+            self._pending_durations_us = []
 
     def update(self, duration_us, batch_size=None):
         self.inference_count += 1
         if batch_size:
             self.sample_count += batch_size
         self.total_time_us += duration_us
-        if len(self.time_samples_us) < InferenceStats.MAX_RESERVOIR_SIZE:
-            self.time_samples_us.append(duration_us)
+        # durations are added to the sketch in batches to keep
+        # per-span updates cheap
+        pending_durations_us = self._pending_durations_us
+        pending_durations_us.append(duration_us)
+        if len(pending_durations_us) >= self.MAX_PENDING_DURATIONS:
+            self._flush_durations()
+
+    def update_many(self, durations_us, batch_sizes=None):
+        if np is not None:
+            durations_us = np.asarray(durations_us, dtype=np.float64)
+            total_time_us = durations_us.sum().item()
+            if batch_sizes is not None:
+                sample_count = int(np.asarray(batch_sizes).sum())
         else:
-            self.time_samples_us[random.randint(0, InferenceStats.MAX_RESERVOIR_SIZE - 1)] = duration_us
+            total_time_us = sum(durations_us)
+            if batch_sizes is not None:
+                sample_count = int(sum(batch_sizes))
+
+        self.inference_count += len(durations_us)
+        if batch_sizes is not None:
+            self.sample_count += sample_count
+        self.total_time_us += total_time_us
+        self._time_sketch_us.add_many(durations_us)
+
+    def inference_time_percentile_us(self, percentile):
+        return self.time_sketch_us.quantile(percentile / 100)
 
     def inference_time_p95_us(self):
-        num_time_samples = len(self.time_samples_us)
-        if num_time_samples > 0:
-            idx = int(num_time_samples * 95 / 100)
-            return sorted(self.time_samples_us)[idx]
-        return 0
+        return self.inference_time_percentile_us(95)
 
     def inference_time_avg_us(self):
         if self.inference_count > 0 and self.total_time_us > 0:
@@ -50,22 +89,78 @@ class InferenceStats:
             return self.sample_count / (self.total_time_us / 1e6)
         return 0
 
+    def merge(self, other):
+        self.inference_count += other.inference_count
+        self.sample_count += other.sample_count
+        self.total_time_us += other.total_time_us
+        self.time_sketch_us.merge(other.time_sketch_us)
+
+
+class InferenceStatsShard:
+    __slots__ = [
+        'lock',
+        'inference_stats',
+        'span_inference_stats',
+        'total_inference_count'
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inference_stats = InferenceStats()
+        self.span_inference_stats = {}
+        self.total_inference_count = 0
+
+    def stats_for(self, span_name):
+        if span_name is None:
+            return self.inference_stats
+        stats = self.span_inference_stats.get(span_name)
+        if stats is None:
+            stats = self.span_inference_stats[span_name] = InferenceStats()
+        return stats
+
+    def merge(self, other):
+        self.total_inference_count += other.total_inference_count
+        self.inference_stats.merge(other.inference_stats)
+        for span_name, stats in other.span_inference_stats.items():
+            self.stats_for(span_name).merge(stats)
+
+
+class _ThreadMarker:
+    # freed with the thread-local storage when its thread exits
+    __slots__ = ['__weakref__']
+
 
 class WorkloadRun:
     MAX_PROFILES = 25
+    MAX_PROFILES_BYTES = int(50 * 1e6)
+    AUTO_FLUSH_MAX_PROFILES = 10
+    AUTO_FLUSH_MAX_BYTES = int(10 * 1e6)
+    MAX_SPAN_NAMES = 50
+    OTHER_SPAN_NAME = 'other'
+    MAX_SHARDS = 128
 
     def __init__(self):
         self._update_lock = threading.Lock()
+        self._shards_lock = threading.Lock()
+        # stats of exited threads are merged into the retired shard
+        self._retired_shard = InferenceStatsShard()
+        self._shared_shard = None
+        self._shards = [self._retired_shard]
+        self._local = threading.local()
+        self._pid = os.getpid()
         self._profiles = []
+        self._profiles_bytes = 0
+        # wall clock anchor for converting monotonic span timestamps
+        self._anchor_wall_us = time.time_ns() // 1000
+        self._anchor_perf_ns = time.perf_counter_ns()
         self.start_ms = None
         self.run_id = None
         self.tags = None
         self.params = None
         self.metrics = None
-        self.profile_scheduler = ProfileScheduler()
-
-        self.total_inference_count = 0
-        self.reset_inference_stats()
+        self.profile_scheduler = ProfileScheduler(
+            overhead_budget=graphsignal._agent.overhead_budget if graphsignal._agent else None)
+        self._span_schedulers = {}
 
         if 'GRAPHSIGNAL_TAGS' in os.environ:
             env_tags = os.environ['GRAPHSIGNAL_TAGS']
@@ -81,17 +176,149 @@ class WorkloadRun:
                     if pair[0] and pair[1]:
                         self.add_param(pair[0].strip(), pair[1].strip())
 
-    def inc_total_inference_count(self, count=1):
+    def reset_after_fork(self):
+        # stats and profiles of the parent process are reported by the parent
+        self._update_lock = threading.Lock()
+        self._shards_lock = threading.Lock()
+        self._retired_shard = InferenceStatsShard()
+        self._shared_shard = None
+        self._shards = [self._retired_shard]
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._profiles = []
+        self._profiles_bytes = 0
+
+    def span_scheduler(self, span_name):
+        # named spans have their own scheduler and stats, the number of
+        # names is bounded and spans over the limit share one name
+        scheduler = self._span_schedulers.get(span_name)
+        if scheduler is not None:
+            return span_name, scheduler
         with self._update_lock:
-            self.total_inference_count += count
+            if span_name not in self._span_schedulers:
+                if len(self._span_schedulers) >= self.MAX_SPAN_NAMES:
+                    if span_name != self.OTHER_SPAN_NAME:
+                        logger.debug('Too many span names, recording %s as %s', span_name, self.OTHER_SPAN_NAME)
+                    span_name = self.OTHER_SPAN_NAME
+                if span_name not in self._span_schedulers:
+                    self._span_schedulers[span_name] = ProfileScheduler(
+                        overhead_budget=self.profile_scheduler.overhead_budget)
+                    # the overhead budget is split between span names
+                    overhead_shares = len(self._span_schedulers) + 1
+                    self.profile_scheduler.overhead_shares = overhead_shares
+                    for span_scheduler in self._span_schedulers.values():
+                        span_scheduler.overhead_shares = overhead_shares
+            return span_name, self._span_schedulers[span_name]
+
+    def record_overhead(self, overhead_sec):
+        schedulers = [self.profile_scheduler] + list(self._span_schedulers.values())
+        for scheduler in schedulers:
+            scheduler.record_overhead(overhead_sec / len(schedulers))
+
+    def timestamp_us(self, perf_counter_ns):
+        return self._anchor_wall_us + (perf_counter_ns - self._anchor_perf_ns) // 1000
+
+    def _current_shard(self):
+        # each thread updates its own shard, so the shard lock is only
+        # contended when stats are merged
+        try:
+            return self._local.shard
+        except AttributeError:
+            return self._add_shard()
+
+    def _add_shard(self):
+        with self._shards_lock:
+            if len(self._shards) >= self.MAX_SHARDS:
+                # threads over the limit share one shard
+                if self._shared_shard is None:
+                    self._shared_shard = InferenceStatsShard()
+                    self._shards.append(self._shared_shard)
+                self._local.shard = self._shared_shard
+                return self._shared_shard
+            shard = InferenceStatsShard()
+            self._shards.append(shard)
+        marker = self._local.marker = _ThreadMarker()
+        weakref.finalize(marker, self._retire_shard, shard).atexit = False
+        self._local.shard = shard
+        return shard
+
+    def _retire_shard(self, shard):
+        # called when the thread owning the shard exits; in forked children
+        # thread states of the parent are cleared before reset_after_fork,
+        # while locks may be held by threads that no longer exist
+        if self._pid != os.getpid():
+            return
+        with self._shards_lock:
+            if shard not in self._shards:
+                # shard of the parent process
+                return
+            self._shards.remove(shard)
+            with self._retired_shard.lock, shard.lock:
+                self._retired_shard.merge(shard)
 
-    def reset_inference_stats(self):
-        with self._update_lock:
-            self.inference_stats = InferenceStats()
+    def record_inference(self, duration_us, batch_size=None, span_name=None):
+        shard = self._current_shard()
+        with shard.lock:
+            shard.total_inference_count += 1
+            shard.stats_for(span_name).update(duration_us, batch_size=batch_size)
 
-    def update_inference_stats(self, duration_us, batch_size=None):
-        with self._update_lock:
-            self.inference_stats.update(duration_us, batch_size=batch_size)
+    def inc_total_inference_count(self, count=1):
+        shard = self._current_shard()
+        with shard.lock:
+            shard.total_inference_count += count
+
+    def update_inference_stats(self, duration_us, batch_size=None, span_name=None):
+        shard = self._current_shard()
+        with shard.lock:
+            shard.stats_for(span_name).update(duration_us, batch_size=batch_size)
+
+    def update_inference_stats_many(self, durations_us, batch_sizes=None, span_name=None):
+        durations_us, batch_sizes = _filter_durations(durations_us, batch_sizes)
+        if len(durations_us) == 0:
+            return
+        shard = self._current_shard()
+        with shard.lock:
+            shard.total_inference_count += len(durations_us)
+            shard.stats_for(span_name).update_many(durations_us, batch_sizes=batch_sizes)
+
+    @property
+    def total_inference_count(self):
+        with self._shards_lock:
+            total_inference_count = 0
+            for shard in self._shards:
+                total_inference_count += shard.total_inference_count
+        return total_inference_count
+
+    @property
+    def inference_stats(self):
+        return self.span_inference_stats(None)
+
+    def span_inference_stats(self, span_name):
+        merged_stats = InferenceStats()
+        with self._shards_lock:
+            for shard in self._shards:
+                with shard.lock:
+                    merged_stats.merge(shard.stats_for(span_name))
+        return merged_stats
+
+    def reset_inference_stats(self):
+        with self._shards_lock:
+            for shard in self._shards:
+                with shard.lock:
+                    shard.inference_stats = InferenceStats()
+                    shard.span_inference_stats = {}
+
+    def collect_inference_stats(self, span_name=None):
+        merged_stats = InferenceStats()
+        with self._shards_lock:
+            for shard in self._shards:
+                with shard.lock:
+                    if span_name is None:
+                        merged_stats.merge(shard.inference_stats)
+                        shard.inference_stats = InferenceStats()
+                    elif span_name in shard.span_inference_stats:
+                        merged_stats.merge(shard.span_inference_stats.pop(span_name))
+        return merged_stats
 
     def add_tag(self, tag):
         if tag is None or not isinstance(tag, str):
@@ -118,16 +345,38 @@ class WorkloadRun:
         logger.debug('add_metric: %s=%f', name, value)
 
     def add_profile(self, profile):
+        profile_bytes = profile.ByteSize()
         with self._update_lock:
+            for evicted_profile in self._profiles[0:-WorkloadRun.MAX_PROFILES]:
+                self._profiles_bytes -= evicted_profile.ByteSize()
+                remove_trace_file(evicted_profile)
             del self._profiles[0:-WorkloadRun.MAX_PROFILES]
             self._profiles.append(profile)
+            self._profiles_bytes += profile_bytes
+            if self.MAX_PROFILES_BYTES and self._profiles_bytes > self.MAX_PROFILES_BYTES:
+                self._profiles_bytes, _, _ = evict_profiles(
+                    self._profiles, self._profiles_bytes, self.MAX_PROFILES_BYTES)
+            should_flush = (
+                (self.AUTO_FLUSH_MAX_PROFILES and len(self._profiles) >= self.AUTO_FLUSH_MAX_PROFILES) or
+                (self.AUTO_FLUSH_MAX_BYTES and self._profiles_bytes >= self.AUTO_FLUSH_MAX_BYTES))
+
+        # profiles are collected and uploaded by the upload worker
+        if should_flush:
+            graphsignal._agent.uploader.flush_in_thread()
+        else:
+            graphsignal._agent.uploader.start_auto_flush()
 
-    def upload(self, block=False):
+    @property
+    def profiles_bytes(self):
+        return self._profiles_bytes
+
+    def collect_profiles(self):
         with self._update_lock:
             if len(self._profiles) == 0:
-                return
+                return 0
             outgoing_profiles = self._profiles
             self._profiles = []
+            self._profiles_bytes = 0
 
         for profile in outgoing_profiles:
             if self.tags is not None:
@@ -149,10 +398,45 @@ class WorkloadRun:
 
         logger.debug('Uploading %d profiles', len(outgoing_profiles))
 
+        return len(outgoing_profiles)
+
+    def upload(self, block=False):
+        if self.collect_profiles() == 0:
+            return
+
         if block:
             graphsignal._agent.uploader.flush()
         else:
             graphsignal._agent.uploader.flush_in_thread()
 
     def end(self, block=False):
-        self.upload(block=block)
+        if block:
+            # final upload, profiles buffered after failed uploads are retried as well
+            self.collect_profiles()
+            graphsignal._agent.uploader.flush(force=True)
+        else:
+            self.upload()
+
+
+def _filter_durations(durations_us, batch_sizes):
+    # negative, NaN and infinite durations would corrupt the stats
+    if np is not None:
+        durations_us = np.asarray(durations_us, dtype=np.float64)
+        valid = np.isfinite(durations_us) & (durations_us >= 0)
+        invalid_count = len(durations_us) - int(valid.sum())
+        if invalid_count > 0:
+            durations_us = durations_us[valid]
+            if batch_sizes is not None:
+                batch_sizes = np.asarray(batch_sizes)[valid]
+    else:
+        valid = [math.isfinite(duration_us) and duration_us >= 0 for duration_us in durations_us]
+        invalid_count = len(valid) - sum(valid)
+        if invalid_count > 0:
+            durations_us = [duration_us for duration_us, is_valid in zip(durations_us, valid) if is_valid]
+            if batch_sizes is not None:
+                batch_sizes = [batch_size for batch_size, is_valid in zip(batch_sizes, valid) if is_valid]
+
+    if invalid_count > 0:
+        logger.warning('record_inferences: skipped %d negative, NaN or infinite durations', invalid_count)
+
+    return durations_us, batch_sizes
@@ -3,10 +3,13 @@ import logging
 import sys
 import os
 import time
+import threading
 from unittest.mock import patch, Mock
 
 import graphsignal
-from graphsignal.workload_run import WorkloadRun
+from graphsignal.workload_run import WorkloadRun, InferenceStats
+from graphsignal.uploader import Uploader
+from graphsignal.proto import profiles_pb2
 
 logger = logging.getLogger('graphsignal')
 
@@ -52,9 +55,181 @@ class WorkloadRunTest(unittest.TestCase):
         self.assertEqual(wr.inference_stats.inference_rate(), 49999.99999999999)
         self.assertEqual(wr.inference_stats.sample_rate(), 6399999.999999999)
 
+    def test_record_inference(self):
+        wr = WorkloadRun()
+
+        for duration_us in range(1, InferenceStats.MAX_PENDING_DURATIONS * 2 + 2):
+            wr.record_inference(duration_us, batch_size=2)
+        wr.record_inference(10, span_name='s1')
+        self.assertEqual(wr.total_inference_count, InferenceStats.MAX_PENDING_DURATIONS * 2 + 2)
+        stats = wr.inference_stats
+        self.assertEqual(stats.inference_count, InferenceStats.MAX_PENDING_DURATIONS * 2 + 1)
+        self.assertEqual(stats.time_sketch_us.count, InferenceStats.MAX_PENDING_DURATIONS * 2 + 1)
+        self.assertEqual(stats.sample_count, (InferenceStats.MAX_PENDING_DURATIONS * 2 + 1) * 2)
+        self.assertAlmostEqual(stats.inference_time_p95_us(), 0.95 * (InferenceStats.MAX_PENDING_DURATIONS * 2 + 1), delta=25)
+        self.assertEqual(wr.span_inference_stats('s1').inference_count, 1)
+
     def test_inc_total_inference_count(self):
         wr = WorkloadRun()
 
         wr.inc_total_inference_count()
         wr.inc_total_inference_count()
         self.assertEqual(wr.total_inference_count, 2)
+
+    def test_collect_inference_stats(self):
+        wr = WorkloadRun()
+
+        def update():
+            wr.inc_total_inference_count()
+            wr.update_inference_stats(10, batch_size=2)
+
+        update()
+        thread = threading.Thread(target=update)
+        thread.start()
+        thread.join()
+
+        stats = wr.collect_inference_stats()
+        self.assertEqual(stats.inference_count, 2)
+        self.assertEqual(stats.sample_count, 4)
+        self.assertEqual(stats.total_time_us, 20)
+        self.assertEqual(wr.inference_stats.inference_count, 0)
+        self.assertEqual(wr.total_inference_count, 2)
+        # retired shard and shard of the main thread
+        self.assertEqual(len(wr._shards), 2)
+
+    def test_span_inference_stats(self):
+        wr = WorkloadRun()
+
+        def update():
+            wr.update_inference_stats(2, span_name='classify')
+            wr.update_inference_stats(400, span_name='generate')
+        update()
+        thread = threading.Thread(target=update)
+        thread.start()
+        thread.join()
+        wr.update_inference_stats(10)
+
+        self.assertEqual(wr.span_inference_stats('classify').inference_time_avg_us(), 2)
+        self.assertEqual(wr.span_inference_stats('generate').inference_time_avg_us(), 400)
+        self.assertEqual(wr.inference_stats.inference_time_avg_us(), 10)
+
+        stats = wr.collect_inference_stats(span_name='classify')
+        self.assertEqual(stats.inference_count, 2)
+        self.assertEqual(wr.span_inference_stats('classify').inference_count, 0)
+        self.assertEqual(wr.span_inference_stats('generate').inference_count, 2)
+
+    def test_retire_shards(self):
+        wr = WorkloadRun()
+
+        def update():
+            wr.inc_total_inference_count()
+            wr.update_inference_stats(10, span_name='s{0}'.format(threading.get_ident() % 100))
+        for _ in range(2000):
+            thread = threading.Thread(target=update)
+            thread.start()
+            thread.join()
+
+        # stats of exited threads are kept in the retired shard
+        self.assertEqual(len(wr._shards), 1)
+        self.assertEqual(wr.total_inference_count, 2000)
+        self.assertEqual(sum(wr.span_inference_stats('s{0}'.format(i)).inference_count for i in range(100)), 2000)
+
+    def test_max_shards(self):
+        wr = WorkloadRun()
+        wr.MAX_SHARDS = 4
+        started = threading.Barrier(8)
+        stopped = threading.Event()
+
+        def update():
+            wr.update_inference_stats(10)
+            started.wait()
+            stopped.wait()
+        threads = [threading.Thread(target=update) for _ in range(7)]
+        for thread in threads:
+            thread.start()
+        started.wait()
+
+        # live threads over the limit share one shard
+        self.assertEqual(len(wr._shards), 5)
+        self.assertEqual(wr.inference_stats.inference_count, 7)
+        stopped.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(wr.collect_inference_stats().inference_count, 7)
+
+    def test_span_scheduler(self):
+        wr = WorkloadRun()
+        wr.MAX_SPAN_NAMES = 2
+
+        span_name1, scheduler1 = wr.span_scheduler('s1')
+        self.assertEqual(span_name1, 's1')
+        self.assertIs(wr.span_scheduler('s1')[1], scheduler1)
+        span_name2, scheduler2 = wr.span_scheduler('s2')
+        self.assertIsNot(scheduler2, scheduler1)
+
+        # span names over the limit share one scheduler
+        span_name3, scheduler3 = wr.span_scheduler('s3')
+        self.assertEqual(span_name3, WorkloadRun.OTHER_SPAN_NAME)
+        self.assertIs(wr.span_scheduler('s4')[1], scheduler3)
+        self.assertEqual(len(wr._span_schedulers), 3)
+        self.assertEqual(wr.profile_scheduler.overhead_shares, 4)
+        self.assertEqual(scheduler1.overhead_shares, 4)
+
+    def test_update_inference_stats_concurrent(self):
+        num_updates = 20000
+
+        def update(wr, count):
+            for _ in range(count):
+                wr.inc_total_inference_count()
+                wr.update_inference_stats(10, batch_size=1)
+
+        for num_threads in (1, 8, 32):
+            wr = WorkloadRun()
+            threads = [threading.Thread(target=update, args=(wr, num_updates // num_threads))
+                for _ in range(num_threads)]
+            start_ns = time.perf_counter_ns()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            took_ns = time.perf_counter_ns() - start_ns
+
+            logger.debug('Inference stats update with %d threads: %d ns/update',
+                num_threads, took_ns / num_updates)
+
+            expected_count = num_updates // num_threads * num_threads
+            self.assertEqual(wr.total_inference_count, expected_count)
+            self.assertEqual(wr.collect_inference_stats().inference_count, expected_count)
+
+    @patch.object(Uploader, 'flush_in_thread')
+    def test_add_profile_auto_flush(self, mocked_flush_in_thread):
+        wr = WorkloadRun()
+
+        for _ in range(WorkloadRun.AUTO_FLUSH_MAX_PROFILES - 1):
+            wr.add_profile(profiles_pb2.MLProfile())
+        mocked_flush_in_thread.assert_not_called()
+        wr.add_profile(profiles_pb2.MLProfile())
+        mocked_flush_in_thread.assert_called_once()
+
+        wr.collect_profiles()
+        profile = profiles_pb2.MLProfile()
+        profile.trace_data = b'0' * int(WorkloadRun.AUTO_FLUSH_MAX_BYTES)
+        wr.add_profile(profile)
+        self.assertEqual(mocked_flush_in_thread.call_count, 2)
+
+    @patch.object(Uploader, 'flush_in_thread')
+    def test_add_profile_max_bytes(self, mocked_flush_in_thread):
+        wr = WorkloadRun()
+        wr.MAX_PROFILES_BYTES = 2500
+
+        for i in range(3):
+            profile = profiles_pb2.MLProfile()
+            profile.workload_name = 'p{0}'.format(i)
+            profile.trace_data = b'0' * 1000
+            wr.add_profile(profile)
+
+        # trace data of oldest profile is stripped first
+        self.assertEqual([p.workload_name for p in wr._profiles], ['p0', 'p1', 'p2'])
+        self.assertEqual([len(p.trace_data) for p in wr._profiles], [0, 1000, 1000])
+        self.assertEqual(wr.profiles_bytes, sum(p.ByteSize() for p in wr._profiles))
+        self.assertTrue(wr.profiles_bytes <= wr.MAX_PROFILES_BYTES)